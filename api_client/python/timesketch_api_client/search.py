@@ -15,6 +15,8 @@
 import datetime
 import json
 import logging
+import queue
+import threading
 
 import pandas
 
@@ -417,6 +419,11 @@ class Search(resource.SketchResource):
     """Search object."""
 
     DEFAULT_SIZE_LIMIT = 10000
+    # Number of pages fetched ahead while iterating over the results.
+    DEFAULT_PREFETCH_PAGES = 2
+    # Seconds between checks whether the iteration was stopped, while
+    # waiting for room in the prefetch queue.
+    PREFETCH_POLL_INTERVAL = 1
 
     def __init__(self, sketch):
         resource_uri = f"sketches/{sketch.id}/explore/"
@@ -429,6 +436,7 @@ class Search(resource.SketchResource):
         self._indices = "_all"
         self._max_entries = self.DEFAULT_SIZE_LIMIT
         self._name = ""
+        self._profiling = False
         self._query_dsl = ""
         self._query_filter = {}
         self._query_string = ""
@@ -486,6 +494,53 @@ class Search(resource.SketchResource):
                 we want to execute the query or only count the
                 number of events that the query would produce.
         """
+        form_data = self._get_form_data(file_name=file_name, count=count)
+        response = self._post_query(form_data)
+
+        if file_name:
+            with open(file_name, "wb") as fw:
+                fw.write(response.content)
+            return
+
+        response_json = error.get_response_json(response, logger)
+
+        if count:
+            meta = response_json.get("meta", {})
+            self._total_elastic_size = meta.get("total_count", 0)
+            return
+
+        total_count = len(response_json.get("objects", []))
+        for more_response_json in self._scroll_pages(form_data, response_json):
+            more_objects = more_response_json.get("objects", [])
+            total_count += len(more_objects)
+            response_json["objects"].extend(more_objects)
+            more_meta = more_response_json.get("meta", {})
+            added_time = more_meta.get("es_time", 0)
+            response_json["meta"]["es_time"] += added_time
+
+        self._total_elastic_size = response_json.get("meta", {}).get(
+            "es_total_count", 0
+        )
+        if self._total_elastic_size != total_count:
+            logger.info(
+                "%d results were returned, but " "%d records matched the search query",
+                total_count,
+                self._total_elastic_size,
+            )
+
+        self._raw_response = response_json
+
+    def _get_form_data(self, file_name="", count=False):
+        """Returns the form data of a search request.
+
+        Args:
+            file_name (str): optional file name to export the results to.
+            count (bool): optional boolean that determines whether only
+                the number of events is requested.
+
+        Raises:
+            ValueError: if the query filter is not a dict.
+        """
         query_filter = self.query_filter
         if not isinstance(query_filter, dict):
             raise ValueError("Unable to query with a query filter that isn't a dict.")
@@ -496,7 +551,7 @@ class Search(resource.SketchResource):
         if self.scrolling is not None:
             scrolling = self.scrolling
 
-        form_data = {
+        return {
             "query": self._query_string,
             "filter": query_filter,
             "dsl": self._query_dsl,
@@ -504,8 +559,18 @@ class Search(resource.SketchResource):
             "fields": self._return_fields,
             "enable_scroll": scrolling,
             "file_name": file_name,
+            "profile": self._profiling,
         }
 
+    def _post_query(self, form_data):
+        """Sends a search request and returns the response.
+
+        Args:
+            form_data (dict): form data of the search request.
+
+        Raises:
+            ValueError: if the search was not successful.
+        """
         response = self.api.session.post(
             f"{self.api.api_root}/{self.resource_uri}", json=form_data
         )
@@ -513,19 +578,18 @@ class Search(resource.SketchResource):
             error.error_message(
                 response, message="Unable to query results", error=ValueError
             )
+        return response
 
-        if file_name:
-            with open(file_name, "wb") as fw:
-                fw.write(response.content)
-            return
+    def _scroll_pages(self, form_data, response_json):
+        """Yields the pages of the results that follow the first page.
 
-        response_json = error.get_response_json(response, logger)
-
-        if count:
-            meta = response_json.get("meta", {})
-            self._total_elastic_size = meta.get("total_count", 0)
-            return
+        Args:
+            form_data (dict): form data of the search request.
+            response_json (dict): response with the first page of results.
 
+        Yields:
+            Dict with the response of each scroll request.
+        """
         scroll_id = response_json.get("meta", {}).get("scroll_id", "")
         form_data["scroll_id"] = scroll_id
 
@@ -539,32 +603,132 @@ class Search(resource.SketchResource):
                 logger.debug("No scroll ID, will stop.")
                 break
 
-            more_response = self.api.session.post(
-                f"{self.api.api_root}/{self.resource_uri}", json=form_data
-            )
-            if not error.check_return_status(more_response, logger):
-                error.error_message(
-                    response, message="Unable to query results", error=ValueError
-                )
+            more_response = self._post_query(form_data)
             more_response_json = error.get_response_json(more_response, logger)
             count = len(more_response_json.get("objects", []))
             total_count += count
-            response_json["objects"].extend(more_response_json.get("objects", []))
-            more_meta = more_response_json.get("meta", {})
-            added_time = more_meta.get("es_time", 0)
-            response_json["meta"]["es_time"] += added_time
+            yield more_response_json
+
+    def _pages(self):
+        """Yields the response of each page of the results."""
+        form_data = self._get_form_data()
+        if self.scrolling is None:
+            form_data["enable_scroll"] = True
 
+        response_json = error.get_response_json(self._post_query(form_data), logger)
         self._total_elastic_size = response_json.get("meta", {}).get(
             "es_total_count", 0
         )
-        if self._total_elastic_size != total_count:
-            logger.info(
-                "%d results were returned, but " "%d records matched the search query",
-                total_count,
-                self._total_elastic_size,
-            )
+        yield response_json
+        yield from self._scroll_pages(form_data, response_json)
 
-        self._raw_response = response_json
+    def _prefetch_pages(self, prefetch):
+        """Yields the pages of the results, fetched in a background thread.
+
+        At most prefetch pages are kept in memory ahead of the consumer.
+
+        Args:
+            prefetch (int): number of pages to fetch ahead.
+        """
+        pages = queue.Queue(maxsize=prefetch)
+        stopped = threading.Event()
+        done = object()
+
+        def _put(item):
+            """Waits for room in the queue, unless the iteration stopped."""
+            while not stopped.is_set():
+                try:
+                    pages.put(item, timeout=self.PREFETCH_POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def _fetch():
+            """Fetches the pages, and passes on errors to the consumer."""
+            try:
+                for page in self._pages():
+                    if not _put(page):
+                        return
+            except Exception as exc:  # pylint: disable=broad-except
+                _put(exc)
+                return
+            _put(done)
+
+        thread = threading.Thread(target=_fetch, name="search-prefetch", daemon=True)
+        thread.start()
+        try:
+            while True:
+                page = pages.get()
+                if page is done:
+                    return
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+        finally:
+            stopped.set()
+
+    def _get_return_field_list(self):
+        """Returns a list with the fields to return, empty for all fields."""
+        return_fields = self._return_fields
+        if not return_fields:
+            return []
+        if return_fields.startswith("'"):
+            return_fields = return_fields[1:]
+        if return_fields.endswith("'"):
+            return_fields = return_fields[:-1]
+        return [field for field in return_fields.split(",") if field]
+
+    def _get_records(self, objects, timelines, return_field_list):
+        """Returns the events of search results, with their metadata.
+
+        Args:
+            objects (list): events returned by the search API.
+            timelines (dict): names of the timelines, keyed by ID.
+            return_field_list (list): fields to return, empty for all fields.
+
+        Returns:
+            List of dicts, one per event.
+        """
+        return_list = []
+        for result in objects:
+            source = result.get("_source", {})
+            if not return_field_list or "_id" in return_field_list:
+                source["_id"] = result.get("_id")
+            if not return_field_list or "_type" in return_field_list:
+                source["_type"] = result.get("_type")
+            if not return_field_list or "_index" in return_field_list:
+                source["_index"] = result.get("_index")
+            if not return_field_list or "_source" in return_field_list:
+                source["_source"] = timelines.get(result.get("__ts_timeline_id"))
+            if not return_field_list or "__ts_timeline_id" in return_field_list:
+                source["_source"] = timelines.get(result.get("__ts_timeline_id"))
+
+            return_list.append(source)
+        return return_list
+
+    @staticmethod
+    def _to_data_frame(records):
+        """Returns a pandas DataFrame with events.
+
+        Args:
+            records (list): dicts with the events.
+        """
+        data_frame = pandas.DataFrame(records)
+        if "datetime" in data_frame:
+            try:
+                data_frame["datetime"] = pandas.to_datetime(data_frame.datetime)
+            except pandas.errors.OutOfBoundsDatetime:
+                pass
+        elif "timestamp" in data_frame:
+            try:
+                data_frame["datetime"] = pandas.to_datetime(
+                    data_frame.timestamp / 1e6, utc=True, unit="s"
+                )
+            except pandas.errors.OutOfBoundsDatetime:
+                pass
+
+        return data_frame
 
     def add_chip(self, chip):
         """Add a chip to the ..."""
@@ -855,6 +1019,34 @@ class Search(resource.SketchResource):
         self._query_filter["order"] = "desc"
         self.commit()
 
+    @property
+    def profile(self):
+        """Returns a summary of the profile of the search.
+
+        The summary is a list with the timings of each shard, slowest
+        first, and the queries and aggregations that took the most time.
+        It is empty unless profiling was enabled before the search ran.
+        """
+        if not self._raw_response:
+            self._execute_query()
+
+        return self._raw_response.get("meta", {}).get("profile", [])
+
+    @property
+    def profiling(self):
+        """Returns whether the search is profiled."""
+        return self._profiling
+
+    def profiling_disable(self):
+        """Disables profiling of the search."""
+        self._profiling = False
+        self._raw_response = None
+
+    def profiling_enable(self):
+        """Enables profiling of the search by OpenSearch."""
+        self._profiling = True
+        self._raw_response = None
+
     @property
     def query_dsl(self):
         """Property that returns back the query DSL."""
@@ -1073,53 +1265,92 @@ class Search(resource.SketchResource):
         self._scrolling = old_scrolling
         return True
 
-    def to_pandas(self):
-        """Returns a pandas DataFrame with the response of the query."""
-        if not self._raw_response:
-            self._execute_query()
+    def iter_events(self, prefetch=DEFAULT_PREFETCH_PAGES):
+        """Yields the events of the search, one at a time.
 
-        return_list = []
-        timelines = {t.id: t.name for t in self._sketch.list_timelines()}
+        Only the pages that are prefetched are kept in memory, so that
+        searches with more results than fit in memory can be processed.
 
-        return_field_list = []
-        return_fields = self._return_fields
-        if return_fields:
-            if return_fields.startswith("'"):
-                return_fields = return_fields[1:]
-            if return_fields.endswith("'"):
-                return_fields = return_fields[:-1]
-            return_field_list = return_fields.split(",")
-
-        for result in self._raw_response.get("objects", []):
-            source = result.get("_source", {})
-            if not return_fields or "_id" in return_field_list:
-                source["_id"] = result.get("_id")
-            if not return_fields or "_type" in return_field_list:
-                source["_type"] = result.get("_type")
-            if not return_fields or "_index" in return_field_list:
-                source["_index"] = result.get("_index")
-            if not return_fields or "_source" in return_field_list:
-                source["_source"] = timelines.get(result.get("__ts_timeline_id"))
-            if not return_fields or "__ts_timeline_id" in return_field_list:
-                source["_source"] = timelines.get(result.get("__ts_timeline_id"))
+        Args:
+            prefetch (int): number of pages that are fetched in the
+                background while the events are processed. Set to 0
+                to fetch the pages only when they are needed.
 
-            return_list.append(source)
+        Yields:
+            Dict with an event, with the same fields as a row of
+            to_pandas.
+        """
+        for page in self.iter_pages(prefetch=prefetch):
+            yield from page
 
-        data_frame = pandas.DataFrame(return_list)
-        if "datetime" in data_frame:
-            try:
-                data_frame["datetime"] = pandas.to_datetime(data_frame.datetime)
-            except pandas.errors.OutOfBoundsDatetime:
-                pass
-        elif "timestamp" in data_frame:
-            try:
-                data_frame["datetime"] = pandas.to_datetime(
-                    data_frame.timestamp / 1e6, utc=True, unit="s"
+    def iter_pages(
+        self, as_pandas=False, as_arrow=False, prefetch=DEFAULT_PREFETCH_PAGES
+    ):
+        """Yields the results of the search, one page at a time.
+
+        The results are scrolled through while the pages are processed,
+        keeping at most prefetch pages in memory ahead of the caller. The
+        number of events in a page is the size of the query filter, the
+        return fields are selected by the server.
+
+        Args:
+            as_pandas (bool): yield each page as a pandas DataFrame.
+            as_arrow (bool): yield each page as a pyarrow Table, which
+                requires pyarrow to be installed.
+            prefetch (int): number of pages that are fetched in the
+                background while a page is processed. Set to 0 to
+                fetch the pages only when they are needed.
+
+        Yields:
+            A list of dicts with the events of each page, a DataFrame
+            if as_pandas is set or a pyarrow Table if as_arrow is set.
+
+        Raises:
+            ValueError: if both as_pandas and as_arrow are set, or if the
+                search was not successful.
+            ImportError: if as_arrow is set and pyarrow is not installed.
+        """
+        if as_pandas and as_arrow:
+            raise ValueError("Only one of as_pandas and as_arrow can be set.")
+
+        pyarrow = None
+        if as_arrow:
+            # pylint: disable=import-outside-toplevel
+            import pyarrow
+
+        timelines = {t.id: t.name for t in self._sketch.list_timelines()}
+        return_field_list = self._get_return_field_list()
+
+        if prefetch:
+            pages = self._prefetch_pages(prefetch)
+        else:
+            pages = self._pages()
+
+        for page in pages:
+            records = self._get_records(
+                page.get("objects", []), timelines, return_field_list
+            )
+            if as_pandas:
+                yield self._to_data_frame(records)
+            elif as_arrow:
+                yield pyarrow.Table.from_pandas(
+                    self._to_data_frame(records), preserve_index=False
                 )
-            except pandas.errors.OutOfBoundsDatetime:
-                pass
+            else:
+                yield records
 
-        return data_frame
+    def to_pandas(self):
+        """Returns a pandas DataFrame with the response of the query."""
+        if not self._raw_response:
+            self._execute_query()
+
+        timelines = {t.id: t.name for t in self._sketch.list_timelines()}
+        return_list = self._get_records(
+            self._raw_response.get("objects", []),
+            timelines,
+            self._get_return_field_list(),
+        )
+        return self._to_data_frame(return_list)
 
     @property
     def updated_at(self):
@@ -55,6 +55,75 @@ class SearchTest(unittest.TestCase):
         objects = search_dict.get("objects", [])
         self.assertEqual(len(objects), 1)
 
+    def test_profiling(self):
+        """Test requesting the profile of a search."""
+        search_obj = search.Search(sketch=self.sketch)
+        search_obj.query_string = "*"
+        self.assertFalse(search_obj.profiling)
+
+        search_obj.profiling_enable()
+        self.assertTrue(search_obj.profiling)
+        with mock.patch.object(
+            self.api_client.session, "post", wraps=self.api_client.session.post
+        ) as post:
+            self.assertEqual(search_obj.profile, [])
+        self.assertTrue(post.call_args[1]["json"]["profile"])
+
+        search_obj.profiling_disable()
+        self.assertFalse(search_obj.profiling)
+
+    def test_iter_pages(self):
+        """Test iterating over the pages of the results."""
+        search_obj = search.Search(sketch=self.sketch)
+        search_obj.query_string = "*"
+
+        def _page(event_ids, scroll_id="scroll"):
+            """Returns a mock response with a page of events."""
+            objects = [
+                {"_id": event_id, "_index": "test", "_source": {"message": event_id}}
+                for event_id in event_ids
+            ]
+            response = mock.Mock(status_code=200)
+            response.json.return_value = {
+                "meta": {"scroll_id": scroll_id, "es_total_count": 3, "es_time": 1},
+                "objects": objects,
+            }
+            return response
+
+        responses = [_page(["a", "b"]), _page(["c"]), _page([])]
+        with mock.patch.object(
+            self.api_client.session, "post", side_effect=responses
+        ) as post:
+            pages = list(search_obj.iter_pages())
+        self.assertEqual(
+            [[event["_id"] for event in page] for page in pages],
+            [
+                ["a", "b"],
+                ["c"],
+                [],
+            ],
+        )
+        self.assertTrue(post.call_args_list[0][1]["json"]["enable_scroll"])
+        self.assertEqual(post.call_args_list[1][1]["json"]["scroll_id"], "scroll")
+
+        responses = [_page(["a", "b"]), _page(["c"]), _page([])]
+        with mock.patch.object(self.api_client.session, "post", side_effect=responses):
+            pages = list(search_obj.iter_pages(as_pandas=True, prefetch=0))
+        self.assertEqual(list(pages[0]["message"]), ["a", "b"])
+
+        responses = [_page(["a", "b"]), _page(["c"]), _page([])]
+        with mock.patch.object(self.api_client.session, "post", side_effect=responses):
+            messages = [event["message"] for event in search_obj.iter_events()]
+        self.assertEqual(messages, ["a", "b", "c"])
+
+        # Errors while fetching pages in the background reach the caller.
+        failed = mock.Mock(status_code=500, text="error", reason="Server Error")
+        failed.json.return_value = {"message": "error"}
+        responses = [_page(["a", "b"]), failed]
+        with mock.patch.object(self.api_client.session, "post", side_effect=responses):
+            with self.assertRaises(ValueError):
+                list(search_obj.iter_pages())
+
     def test_range_chip(self):
         """Test date range chip."""
         chip = search.DateRangeChip()
@@ -0,0 +1,571 @@
+# Copyright 2022 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks of Timesketch that run without an OpenSearch cluster.
+
+The benchmarks run against a synthetic timeline, served by an in-memory
+OpenSearch client, and an in-memory SQLite database. Results are written
+as JSON to be able to compare runs over time.
+
+Example way of running the benchmarks, from the root of the repository:
+
+  $ python -m benchmarks.run_benchmarks --events 100000 --output results.json
+
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import mock
+
+from benchmarks import synthetic
+from timesketch.app import create_app
+from timesketch.lib import utils
+from timesketch.lib.aggregators import manager as aggregator_manager
+from timesketch.lib.analyzers import manager as analyzer_manager
+from timesketch.lib.datastores.opensearch import OpenSearchDataStore
+from timesketch.lib.testlib import TestConfig
+from timesketch.models import db_session
+from timesketch.models.sketch import Analysis
+from timesketch.models.sketch import SearchHistory
+from timesketch.models.sketch import SearchIndex
+from timesketch.models.sketch import Sketch
+from timesketch.models.sketch import Timeline
+from timesketch.models.user import User
+
+try:
+    from timesketch_import_client import importer
+except ImportError:
+    importer = None
+
+
+logger = logging.getLogger("timesketch.benchmarks")
+
+DEFAULT_EVENTS = 10000
+DEFAULT_REPEAT = 3
+DEFAULT_HISTORY_NODES = 1000
+DEFAULT_ANALYZERS = [
+    "browser_search",
+    "domain",
+    "feature_extraction",
+    "ntfs_timestomp",
+    "tagger",
+]
+# Number of queries built per run of the query building benchmark.
+QUERY_ITERATIONS = 1000
+
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name):
+    """Decorator that registers a benchmark.
+
+    A benchmark is called with the context once per run and returns the
+    number of items, eg. events, that were processed.
+
+    Args:
+        name: Name of the benchmark.
+    """
+
+    def decorator(function):
+        BENCHMARKS[name] = function
+        return function
+
+    return decorator
+
+
+class BenchmarkConfig(TestConfig):
+    """Config for running benchmarks."""
+
+    DEBUG = False
+    OPENSEARCH_HOST = "synthetic"
+
+
+class BenchmarkContext(object):
+    """Data shared by the benchmarks.
+
+    Attributes:
+        events: List of generated event dicts.
+        csv_path: Path to the events written as CSV.
+        jsonl_path: Path to the events written as JSONL.
+        analyzers: List of names of analyzers to run.
+        history_nodes: Number of nodes in the search history tree.
+        user: User that owns the sketch.
+        sketch: Sketch with the synthetic timeline.
+        searchindex: Search index of the synthetic timeline.
+        timeline: The synthetic timeline.
+        search_history: Root node of the search history tree.
+    """
+
+    def __init__(self, events, directory, analyzers, history_nodes):
+        """Initialize the context.
+
+        Args:
+            events: List of generated event dicts.
+            directory: Path of a directory to write the timeline files to.
+            analyzers: List of names of analyzers to run.
+            history_nodes: Number of nodes in the search history tree.
+        """
+        self.events = events
+        self.analyzers = analyzers
+        self.history_nodes = history_nodes
+
+        self.csv_path = os.path.join(directory, "timeline.csv")
+        with open(self.csv_path, "w", encoding="utf-8", newline="") as fh:
+            synthetic.write_csv(events, fh)
+        self.jsonl_path = os.path.join(directory, "timeline.jsonl")
+        with open(self.jsonl_path, "w", encoding="utf-8") as fh:
+            synthetic.write_jsonl(events, fh)
+
+        self.user = User.get_or_create(username="benchmark")
+        self.sketch = Sketch.get_or_create(
+            name="benchmark", description="benchmark", user=self.user
+        )
+        self.searchindex = SearchIndex.get_or_create(
+            name=synthetic.SyntheticClient.index_name,
+            description="benchmark",
+            index_name=synthetic.SyntheticClient.index_name,
+            user=self.user,
+        )
+        self.searchindex.set_status(status="ready")
+        self.timeline = Timeline(
+            name="benchmark",
+            user=self.user,
+            sketch=self.sketch,
+            searchindex=self.searchindex,
+        )
+        self.timeline.set_status(status="ready")
+        db_session.add_all([self.sketch, self.searchindex, self.timeline])
+        db_session.commit()
+
+        self.search_history = _create_search_history(self)
+
+
+@benchmark("read_and_validate_csv")
+def read_csv(context):
+    """Reads the timeline as CSV."""
+    with open(context.csv_path, "r", encoding="utf-8") as fh:
+        return sum(1 for _ in utils.read_and_validate_csv(fh))
+
+
+@benchmark("read_and_validate_jsonl")
+def read_jsonl(context):
+    """Reads the timeline as JSONL."""
+    with open(context.jsonl_path, "r", encoding="utf-8") as fh:
+        return sum(1 for _ in utils.read_and_validate_jsonl(fh))
+
+
+@benchmark("build_query")
+def build_query(context):
+    """Builds queries with query strings, chips and timeline filters."""
+    datastore = OpenSearchDataStore(host="synthetic")
+    query_filter = {
+        "chips": [
+            {
+                "field": "data_type",
+                "value": "fs:stat",
+                "type": "term",
+                "operator": "must",
+                "active": True,
+            },
+            {
+                "field": "",
+                "value": "2022-01-01T00:00:00,2022-12-31T23:59:59",
+                "type": "datetime_range",
+                "operator": "must",
+                "active": True,
+            },
+            {
+                "field": "",
+                "value": "__ts_star",
+                "type": "label",
+                "operator": "must",
+                "active": True,
+            },
+        ],
+        "order": "asc",
+        "size": 40,
+    }
+    query_strings = ["*", "password OR malware", 'url:"google.com" AND user*']
+    for iteration in range(QUERY_ITERATIONS):
+        datastore.build_query(
+            sketch_id=context.sketch.id,
+            query_string=query_strings[iteration % len(query_strings)],
+            query_filter=query_filter,
+            timeline_ids=[context.timeline.id],
+        )
+    return QUERY_ITERATIONS
+
+
+if importer:
+
+    class _DiscardingStreamer(importer.ImportStreamer):
+        """Import streamer that discards the data instead of uploading it."""
+
+        # pylint: disable=unused-argument
+        def _upload_data_buffer(self, end_stream, retry_count=0):
+            self._reset()
+
+        def _upload_data_frame(self, data_frame, end_stream, retry_count=0):
+            pass
+
+    def _get_streamer():
+        """Returns a configured import streamer that discards all data."""
+        sketch = mock.Mock()
+        sketch.api.api_root = "synthetic"
+        sketch.id = 1
+        streamer = _DiscardingStreamer()
+        streamer.set_sketch(sketch)
+        streamer.set_timeline_name("benchmark")
+        streamer.set_timestamp_description("Benchmark Time")
+        return streamer
+
+    @benchmark("import_streamer_dict")
+    def import_streamer_dict(context):
+        """Adds the events one dict at a time to an import streamer."""
+        streamer = _get_streamer()
+        for event in context.events:
+            streamer.add_dict(dict(event))
+        streamer.flush()
+        return len(context.events)
+
+    @benchmark("import_streamer_csv")
+    def import_streamer_csv(context):
+        """Adds the timeline as a CSV file to an import streamer."""
+        streamer = _get_streamer()
+        streamer.add_file(context.csv_path)
+        streamer.flush()
+        return len(context.events)
+
+
+@benchmark("analyzers")
+def run_analyzers(context):
+    """Runs analyzers, each reading all events of the timeline."""
+    events = 0
+    for analyzer_name in context.analyzers:
+        events += _run_analyzer(context, analyzer_name)
+    return events
+
+
+def _run_analyzer(context, analyzer_name):
+    """Runs an analyzer on the synthetic timeline.
+
+    Args:
+        context: The benchmark context.
+        analyzer_name: Name of the analyzer.
+
+    Returns:
+        Number of events read by the analyzer.
+    """
+    analyzer_class = analyzer_manager.AnalysisManager.get_analyzer(analyzer_name)
+    kwargs_list = analyzer_class.get_kwargs() or [{}]
+    if isinstance(kwargs_list, dict):
+        kwargs_list = [kwargs_list]
+
+    for kwargs in kwargs_list:
+        analysis = Analysis(
+            name=analyzer_name,
+            description="benchmark",
+            analyzer_name=analyzer_name,
+            parameters=json.dumps(kwargs),
+            user=context.user,
+            sketch=context.sketch,
+            timeline=context.timeline,
+            searchindex=context.searchindex,
+        )
+        db_session.add(analysis)
+        db_session.commit()
+
+        analyzer = analyzer_class(
+            index_name=context.searchindex.index_name,
+            sketch_id=context.sketch.id,
+            timeline_id=context.timeline.id,
+            **kwargs
+        )
+        analyzer.run_wrapper(analysis.id)
+        if analysis.get_status.status != "DONE":
+            raise RuntimeError(
+                "Analyzer {0:s} failed: {1!s}".format(analyzer_name, analysis.result)
+            )
+    return len(context.events) * len(kwargs_list)
+
+
+@benchmark("search_history_build_tree")
+def build_search_history_tree(context):
+    """Builds the tree of the search history of the sketch."""
+    root = context.search_history
+    root.build_tree(root, {})
+    return context.history_nodes
+
+
+def _create_search_history(context):
+    """Creates a search history tree, where some searches branch off.
+
+    Args:
+        context: The benchmark context.
+
+    Returns:
+        The root node of the tree (instance of SearchHistory).
+    """
+    root = SearchHistory(user=context.user, sketch=context.sketch)
+    nodes = [root]
+    parent = root
+    for index in range(1, context.history_nodes):
+        # Every tenth search branches off from an earlier search.
+        if index % 10 == 0:
+            parent = nodes[index // 2]
+        node = SearchHistory(
+            user=context.user,
+            sketch=context.sketch,
+            query_string="query {0:d}".format(index),
+            query_filter=json.dumps({"size": 40, "order": "asc"}),
+            parent=parent,
+        )
+        nodes.append(node)
+        parent = node
+    db_session.add_all(nodes)
+    db_session.commit()
+    return root
+
+
+@benchmark("aggregators")
+def run_aggregators(context):
+    """Runs the terms aggregators and renders their charts."""
+    aggregations = [
+        ("field_bucket", {"field": "domain", "limit": 100}),
+        ("field_bucket", {"field": "hostname", "limit": 100}),
+        (
+            "query_bucket",
+            {"field": "username", "query_string": "data_type:syslog*", "limit": 100},
+        ),
+    ]
+    for aggregator_name, parameters in aggregations:
+        aggregator_class = aggregator_manager.AggregatorManager.get_aggregator(
+            aggregator_name
+        )
+        aggregator = aggregator_class(
+            sketch_id=context.sketch.id, timeline_ids=[context.timeline.id]
+        )
+        result = aggregator.run(**parameters)
+        result.to_chart(chart_name="table")
+        result.to_dict()
+    return len(aggregations)
+
+
+def get_git_revision():
+    """Returns the git revision of the code, or None if not available."""
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode("utf-8")
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(name, function, context, repeat):
+    """Runs a benchmark and returns the result.
+
+    Args:
+        name: Name of the benchmark.
+        function: Function of the benchmark.
+        context: The benchmark context.
+        repeat: Number of times to run the benchmark.
+
+    Returns:
+        Dict with the timings of the benchmark.
+    """
+    seconds = []
+    items = 0
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        items = function(context)
+        seconds.append(time.perf_counter() - start_time)
+
+    fastest = min(seconds)
+    return {
+        "name": name,
+        "items": items,
+        "seconds": seconds,
+        "min_seconds": fastest,
+        "median_seconds": statistics.median(seconds),
+        "items_per_second": items / fastest if fastest else None,
+    }
+
+
+def run_benchmarks(
+    events=DEFAULT_EVENTS,
+    seed=synthetic.DEFAULT_SEED,
+    cardinality=synthetic.DEFAULT_CARDINALITY,
+    repeat=DEFAULT_REPEAT,
+    names=None,
+    analyzers=None,
+    history_nodes=DEFAULT_HISTORY_NODES,
+):
+    """Runs benchmarks against a synthetic timeline.
+
+    Args:
+        events: Number of events in the timeline.
+        seed: Seed of the timeline generator.
+        cardinality: Number of distinct values of fields like the hostname.
+        repeat: Number of times to run each benchmark.
+        names: Optional list of names of benchmarks to run, defaults to all.
+        analyzers: Optional list of names of analyzers to run.
+        history_nodes: Number of nodes in the search history tree.
+
+    Returns:
+        Dict with the parameters, environment and results of the run.
+    """
+    names = names or list(BENCHMARKS.keys())
+    unknown = set(names) - set(BENCHMARKS.keys())
+    if unknown:
+        raise ValueError("Unknown benchmarks: {0:s}".format(", ".join(sorted(unknown))))
+
+    synthetic.SyntheticClient.events = synthetic.generate_events(
+        events, seed=seed, cardinality=cardinality
+    )
+    app = create_app(BenchmarkConfig)
+    results = []
+    with app.app_context(), tempfile.TemporaryDirectory() as directory, mock.patch(
+        "timesketch.lib.datastores.opensearch.OpenSearch", synthetic.SyntheticClient
+    ):
+        context = BenchmarkContext(
+            synthetic.SyntheticClient.events,
+            directory,
+            analyzers or DEFAULT_ANALYZERS,
+            history_nodes,
+        )
+        for name in names:
+            logger.info("Running benchmark: {0:s}".format(name))
+            result = run_benchmark(name, BENCHMARKS[name], context, repeat)
+            logger.info("{0:s}: {1:.3f} seconds".format(name, result["min_seconds"]))
+            results.append(result)
+
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "parameters": {
+            "events": events,
+            "seed": seed,
+            "cardinality": cardinality,
+            "repeat": repeat,
+            "analyzers": analyzers or DEFAULT_ANALYZERS,
+            "history_nodes": history_nodes,
+        },
+        "environment": {
+            "git_revision": get_git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processors": os.cpu_count(),
+        },
+        "results": results,
+    }
+
+
+def main(argv=None):
+    """Runs the benchmarks from the command line."""
+    arguments = argparse.ArgumentParser(
+        description=(
+            "Run benchmarks of Timesketch against a synthetic timeline, "
+            "without an OpenSearch cluster."
+        )
+    )
+    arguments.add_argument(
+        "--events",
+        type=int,
+        default=DEFAULT_EVENTS,
+        help="Number of events in the synthetic timeline.",
+    )
+    arguments.add_argument(
+        "--seed",
+        type=int,
+        default=synthetic.DEFAULT_SEED,
+        help="Seed of the timeline generator.",
+    )
+    arguments.add_argument(
+        "--cardinality",
+        type=int,
+        default=synthetic.DEFAULT_CARDINALITY,
+        help="Number of distinct hosts, users, domains and files.",
+    )
+    arguments.add_argument(
+        "--repeat",
+        type=int,
+        default=DEFAULT_REPEAT,
+        help="Number of times to run each benchmark.",
+    )
+    arguments.add_argument(
+        "--benchmark",
+        dest="names",
+        action="append",
+        choices=list(BENCHMARKS.keys()),
+        help="Benchmark to run, can be repeated. Defaults to all benchmarks.",
+    )
+    arguments.add_argument(
+        "--analyzer",
+        dest="analyzers",
+        action="append",
+        help="Analyzer to run, can be repeated. Defaults to: {0:s}".format(
+            ", ".join(DEFAULT_ANALYZERS)
+        ),
+    )
+    arguments.add_argument(
+        "--history_nodes",
+        type=int,
+        default=DEFAULT_HISTORY_NODES,
+        help="Number of searches in the search history tree.",
+    )
+    arguments.add_argument(
+        "--output",
+        default="",
+        help="Path of the JSON file to write results to, defaults to stdout.",
+    )
+    options = arguments.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    # The analyzers log every run, only show the progress of the benchmarks.
+    logging.getLogger("timesketch").setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    report = run_benchmarks(
+        events=options.events,
+        seed=options.seed,
+        cardinality=options.cardinality,
+        repeat=options.repeat,
+        names=options.names,
+        analyzers=options.analyzers,
+        history_nodes=options.history_nodes,
+    )
+
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+# Copyright 2022 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the benchmarks."""
+
+import unittest
+
+from benchmarks import run_benchmarks
+
+
+class TestRunBenchmarks(unittest.TestCase):
+    """Tests for running the benchmarks."""
+
+    def test_run_analyzers(self):
+        """Test that the default analyzers run against the synthetic client."""
+        results = run_benchmarks.run_benchmarks(
+            events=200, repeat=1, names=["analyzers"]
+        )
+        self.assertEqual(
+            results["parameters"]["analyzers"], run_benchmarks.DEFAULT_ANALYZERS
+        )
+        (result,) = results["results"]
+        self.assertEqual(result["name"], "analyzers")
+        self.assertGreater(result["items"], 0)
@@ -0,0 +1,461 @@
+# Copyright 2022 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Synthetic timelines and an in-memory OpenSearch client for benchmarks.
+
+The generated events look like the output of plaso: browser history,
+file system, Windows event log and syslog entries. The same seed, number
+of events and cardinality always generate the same timeline.
+"""
+
+import collections
+import csv
+import datetime
+import itertools
+import json
+import random
+
+from opensearchpy.serializer import JSONSerializer
+
+DEFAULT_SEED = 1234
+DEFAULT_CARDINALITY = 100
+# Microseconds since epoch of the first event, 2022-01-01T00:00:00.
+DEFAULT_START_TIMESTAMP = 1640995200000000
+
+# Columns of generated CSV files, fields missing in an event are empty.
+CSV_FIELDS = [
+    "message",
+    "datetime",
+    "timestamp",
+    "timestamp_desc",
+    "data_type",
+    "source_short",
+    "parser",
+    "hostname",
+    "username",
+    "url",
+    "domain",
+    "filename",
+    "file_reference",
+    "event_identifier",
+    "source_name",
+    "computer_name",
+    "logon_id",
+]
+
+SEARCH_ENGINES = [
+    ("https://www.google.com/search?q={0:s}", "www.google.com"),
+    ("https://www.bing.com/search?q={0:s}", "www.bing.com"),
+    ("https://duckduckgo.com/?q={0:s}", "duckduckgo.com"),
+]
+TIMESTAMP_DESCRIPTIONS = [
+    "Content Modification Time",
+    "Last Access Time",
+    "Metadata Modification Time",
+    "Creation Time",
+]
+EVTX_EVENT_IDS = [4624, 4634, 4625, 4688, 7045]
+WORDS = [
+    "timeline",
+    "forensic",
+    "password",
+    "report",
+    "invoice",
+    "malware",
+    "download",
+    "update",
+    "backup",
+    "login",
+]
+
+
+class TimelineGenerator(object):
+    """Generates deterministic plaso-like events.
+
+    Attributes:
+        cardinality: Number of distinct values of fields like the hostname,
+            username, domain or filename.
+        seed: Seed of the random number generator.
+    """
+
+    def __init__(
+        self,
+        seed=DEFAULT_SEED,
+        cardinality=DEFAULT_CARDINALITY,
+        start_timestamp=DEFAULT_START_TIMESTAMP,
+    ):
+        """Initialize the generator.
+
+        Args:
+            seed: Seed of the random number generator.
+            cardinality: Number of distinct values of fields like the
+                hostname, username, domain or filename.
+            start_timestamp: Timestamp of the first event in microseconds
+                since epoch.
+        """
+        self.seed = seed
+        self.cardinality = max(1, cardinality)
+        self._start_timestamp = start_timestamp
+
+        pools = random.Random(seed)
+        self._hosts = ["host-{0:04d}".format(i) for i in range(self.cardinality)]
+        self._users = ["user{0:04d}".format(i) for i in range(self.cardinality)]
+        self._domains = [
+            "site-{0:04d}.example.{1:s}".format(i, pools.choice(["com", "net", "org"]))
+            for i in range(self.cardinality)
+        ]
+        self._files = [
+            "C:\\Users\\{0:s}\\Documents\\{1:s}-{2:04d}.{3:s}".format(
+                pools.choice(self._users),
+                pools.choice(WORDS),
+                i,
+                pools.choice(["docx", "exe", "pdf", "zip"]),
+            )
+            for i in range(self.cardinality)
+        ]
+
+    def _browser_event(self, rng):
+        """Returns the fields of a browser history event."""
+        if rng.random() < 0.3:
+            url_format, domain = rng.choice(SEARCH_ENGINES)
+            terms = "+".join(rng.sample(WORDS, rng.randint(1, 3)))
+            url = url_format.format(terms)
+        else:
+            domain = rng.choice(self._domains)
+            url = "https://{0:s}/{1:s}/{2:d}".format(
+                domain, rng.choice(WORDS), rng.randrange(self.cardinality)
+            )
+        return {
+            "message": "{0:s} (visited {1:d} times)".format(url, rng.randint(1, 20)),
+            "timestamp_desc": "Last Visited Time",
+            "data_type": "chrome:history:page_visited",
+            "source_short": "WEBHIST",
+            "parser": "sqlite/chrome_27_history",
+            "url": url,
+            "domain": domain,
+        }
+
+    def _file_event(self, rng):
+        """Returns the fields of a file system event."""
+        file_number = rng.randrange(len(self._files))
+        filename = self._files[file_number]
+        return {
+            "message": "TSK:{0:s} Type: file".format(filename),
+            "timestamp_desc": rng.choice(TIMESTAMP_DESCRIPTIONS),
+            "data_type": "fs:stat",
+            "source_short": "FILE",
+            "parser": "filestat",
+            "filename": filename,
+            "file_reference": "{0:d}-{1:d}".format(file_number + 64, rng.randint(1, 3)),
+        }
+
+    def _evtx_event(self, rng):
+        """Returns the fields of a Windows event log event."""
+        event_identifier = rng.choice(EVTX_EVENT_IDS)
+        username = rng.choice(self._users)
+        return {
+            "message": "[{0:d} / 0x{0:04x}] Source Name: "
+            "Microsoft-Windows-Security-Auditing Strings: ['{1:s}']".format(
+                event_identifier, username
+            ),
+            "timestamp_desc": "Content Modification Time",
+            "data_type": "windows:evtx:record",
+            "source_short": "EVT",
+            "parser": "winevtx",
+            "event_identifier": event_identifier,
+            "source_name": "Microsoft-Windows-Security-Auditing",
+            "computer_name": rng.choice(self._hosts),
+            "logon_id": "0x{0:x}".format(rng.randrange(self.cardinality * 16)),
+        }
+
+    def _syslog_event(self, rng):
+        """Returns the fields of a syslog event."""
+        return {
+            "message": "[sshd, pid: {0:d}] Accepted publickey for {1:s} "
+            "from 10.0.{2:d}.{3:d} port {4:d} ssh2".format(
+                rng.randint(100, 65535),
+                rng.choice(self._users),
+                rng.randrange(256),
+                rng.randrange(256),
+                rng.randint(1024, 65535),
+            ),
+            "timestamp_desc": "Content Modification Time",
+            "data_type": "syslog:line",
+            "source_short": "LOG",
+            "parser": "syslog",
+        }
+
+    def generate(self, count):
+        """Generates events.
+
+        Args:
+            count: Number of events to generate.
+
+        Yields:
+            Dict with the fields of an event, in timestamp order.
+        """
+        rng = random.Random(self.seed)
+        builders = [
+            self._browser_event,
+            self._file_event,
+            self._evtx_event,
+            self._syslog_event,
+        ]
+        timestamp = self._start_timestamp
+        for _ in range(count):
+            timestamp += rng.randint(0, 120 * 10**6)
+            event = rng.choice(builders)(rng)
+            event["timestamp"] = timestamp
+            event["datetime"] = (
+                datetime.datetime.utcfromtimestamp(timestamp / 10**6).isoformat()
+                + "+00:00"
+            )
+            event["hostname"] = rng.choice(self._hosts)
+            event["username"] = rng.choice(self._users)
+            yield event
+
+
+def generate_events(count, seed=DEFAULT_SEED, cardinality=DEFAULT_CARDINALITY):
+    """Returns a list of generated events.
+
+    Args:
+        count: Number of events to generate.
+        seed: Seed of the random number generator.
+        cardinality: Number of distinct values of fields like the hostname.
+    """
+    return list(TimelineGenerator(seed, cardinality).generate(count))
+
+
+def write_csv(events, file_object):
+    """Writes events to a CSV file.
+
+    Args:
+        events: Iterable of event dicts.
+        file_object: File-like object opened for writing text.
+    """
+    writer = csv.DictWriter(
+        file_object, fieldnames=CSV_FIELDS, restval="", extrasaction="ignore"
+    )
+    writer.writeheader()
+    for event in events:
+        writer.writerow(event)
+
+
+def write_jsonl(events, file_object):
+    """Writes events to a JSONL file.
+
+    Args:
+        events: Iterable of event dicts.
+        file_object: File-like object opened for writing text.
+    """
+    for event in events:
+        file_object.write(json.dumps(event))
+        file_object.write("\n")
+
+
+class _SyntheticTransport(object):
+    """Transport of the synthetic client, only used to serialize actions."""
+
+    serializer = JSONSerializer()
+
+
+class _SyntheticIndices(object):
+    """Index API of the synthetic client."""
+
+    # pylint: disable=unused-argument
+    def refresh(self, index=None, **kwargs):
+        """Refreshing is not needed."""
+        return {}
+
+    def exists(self, index=None, **kwargs):
+        """All indices exist."""
+        return True
+
+    def get_field_mapping(self, index=None, fields=None, **kwargs):
+        """Returns no mappings, all fields are treated as keywords."""
+        return {}
+
+
+class _SyntheticTasks(object):
+    """Task API of the synthetic client, all tasks have completed."""
+
+    # pylint: disable=unused-argument
+    def get(self, task_id=None, **kwargs):
+        """Returns a completed task that updated no events."""
+        return {"completed": True, "response": {"updated": 0, "failures": []}}
+
+    def cancel(self, task_id=None, **kwargs):
+        """Cancelling is not needed."""
+        return {}
+
+
+class SyntheticClient(object):
+    """OpenSearch client that serves a list of events from memory.
+
+    Queries are not evaluated, every search matches all events. Sorting,
+    scrolling, terms and composite aggregations and counts are supported,
+    all writes are accepted and discarded.
+
+    Attributes:
+        events: List of event dicts served by all clients.
+        requests: Counter with the number of requests per API.
+    """
+
+    events = []
+    index_name = "synthetic"
+    requests = collections.Counter()
+
+    # pylint: disable=unused-argument
+    def __init__(self, *args, **kwargs):
+        """Initialize the client, the arguments are ignored."""
+        self.indices = _SyntheticIndices()
+        self.tasks = _SyntheticTasks()
+        self.transport = _SyntheticTransport()
+        self._scrolls = {}
+        self._scroll_ids = itertools.count()
+
+    def info(self):
+        """Returns the version of the cluster."""
+        return {"version": {"number": "2.4.0"}}
+
+    def _get_hits(self, positions, start, size):
+        """Returns a page of hits."""
+        hits = []
+        for position in positions[start : start + size]:
+            hits.append(
+                {
+                    "_id": "event-{0:d}".format(position),
+                    "_index": self.index_name,
+                    "_type": "_doc",
+                    "_source": dict(self.events[position]),
+                    "sort": [position],
+                }
+            )
+        return hits
+
+    def _get_positions(self, sort):
+        """Returns the positions of events in the order of a sort clause."""
+        fields = []
+        for clause in sort or []:
+            field = next(iter(clause)) if isinstance(clause, dict) else clause
+            if field not in ("_doc", "_score"):
+                fields.append(field.replace(".keyword", ""))
+        positions = list(range(len(self.events)))
+        if fields:
+            positions.sort(
+                key=lambda position: tuple(
+                    str(self.events[position].get(field, "")) for field in fields
+                )
+            )
+        return positions
+
+    def _aggregate(self, aggregations):
+        """Returns the result of terms and composite aggregations."""
+        results = {}
+        for name, spec in aggregations.items():
+            if "terms" in spec:
+                field = spec["terms"]["field"].replace(".keyword", "")
+                counter = collections.Counter(
+                    event.get(field) for event in self.events if field in event
+                )
+                results[name] = {
+                    "buckets": [
+                        {"key": key, "doc_count": count}
+                        for key, count in counter.most_common(
+                            spec["terms"].get("size", 10)
+                        )
+                    ]
+                }
+            elif "composite" in spec and not spec["composite"].get("after"):
+                source = spec["composite"]["sources"][0]
+                key_name, terms = next(iter(source.items()))
+                field = terms["terms"]["field"].replace(".keyword", "")
+                counter = collections.Counter(
+                    event.get(field) for event in self.events if field in event
+                )
+                results[name] = {
+                    "buckets": [
+                        {"key": {key_name: key}, "doc_count": count}
+                        for key, count in sorted(counter.items(), key=str)
+                    ]
+                }
+            else:
+                results[name] = {"buckets": []}
+        return results
+
+    def search(self, body=None, index=None, size=None, scroll=None, **kwargs):
+        """Returns all events, paged and sorted as requested."""
+        self.requests["search"] += 1
+        body = body or {}
+        total = {"value": len(self.events), "relation": "eq"}
+        aggregations = body.get("aggregations") or body.get("aggs")
+        if aggregations:
+            return {
+                "took": 0,
+                "hits": {"total": total, "hits": []},
+                "aggregations": self._aggregate(aggregations),
+            }
+
+        if size is None:
+            size = body.get("size", 10)
+        positions = self._get_positions(body.get("sort"))
+        result = {"took": 0, "hits": {"total": total, "hits": []}}
+        if not size:
+            return result
+
+        result["hits"]["hits"] = self._get_hits(positions, 0, size)
+        if scroll:
+            scroll_id = str(next(self._scroll_ids))
+            self._scrolls[scroll_id] = (positions, size, size)
+            result["_scroll_id"] = scroll_id
+        return result
+
+    def scroll(self, scroll_id=None, **kwargs):
+        """Returns the next page of a scroll."""
+        self.requests["scroll"] += 1
+        positions, start, size = self._scrolls.get(scroll_id, ([], 0, 0))
+        self._scrolls[scroll_id] = (positions, start + size, size)
+        return {
+            "_scroll_id": scroll_id,
+            "hits": {"hits": self._get_hits(positions, start, size)},
+        }
+
+    def clear_scroll(self, scroll_id=None, **kwargs):
+        """Forgets a scroll."""
+        self._scrolls.pop(scroll_id, None)
+        return {}
+
+    def count(self, body=None, index=None, **kwargs):
+        """Returns the number of events."""
+        self.requests["count"] += 1
+        return {"count": len(self.events)}
+
+    def bulk(self, body=None, **kwargs):
+        """Accepts all actions."""
+        self.requests["bulk"] += 1
+        return {"took": 0, "errors": False, "items": []}
+
+    def update(self, **kwargs):
+        """Accepts an update."""
+        self.requests["update"] += 1
+        return {}
+
+    def update_by_query(self, **kwargs):
+        """Accepts an update by query, that runs as a task."""
+        self.requests["update_by_query"] += 1
+        return {"task": "synthetic:{0:d}".format(self.requests["update_by_query"])}
+
+    def delete(self, **kwargs):
+        """Accepts a delete."""
+        self.requests["delete"] += 1
+        return {}
@@ -0,0 +1,76 @@
+# Copyright 2022 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the synthetic timeline generator."""
+
+import io
+import unittest
+
+from benchmarks import synthetic
+from timesketch.lib import utils
+
+
+class TestSynthetic(unittest.TestCase):
+    """Tests for the synthetic timelines and client."""
+
+    def test_generate_events(self):
+        """Test that timelines are reproducible and readable."""
+        events = synthetic.generate_events(500, seed=42, cardinality=10)
+        self.assertEqual(len(events), 500)
+        self.assertEqual(
+            events, synthetic.generate_events(500, seed=42, cardinality=10)
+        )
+        self.assertNotEqual(
+            events, synthetic.generate_events(500, seed=43, cardinality=10)
+        )
+        self.assertLessEqual(len({event["hostname"] for event in events}), 10)
+        timestamps = [event["timestamp"] for event in events]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+        csv_file = io.StringIO()
+        synthetic.write_csv(events, csv_file)
+        csv_file.seek(0)
+        self.assertEqual(len(list(utils.read_and_validate_csv(csv_file))), 500)
+
+        jsonl_file = io.StringIO()
+        synthetic.write_jsonl(events, jsonl_file)
+        jsonl_file.seek(0)
+        self.assertEqual(len(list(utils.read_and_validate_jsonl(jsonl_file))), 500)
+
+    def test_client(self):
+        """Test scrolling, sorting and aggregating in the synthetic client."""
+        client = synthetic.SyntheticClient()
+        client.events = synthetic.generate_events(25, cardinality=3)
+
+        result = client.search(body={"size": 10}, scroll="1m")
+        hits = result["hits"]["hits"]
+        while True:
+            page = client.scroll(scroll_id=result["_scroll_id"])["hits"]["hits"]
+            if not page:
+                break
+            hits.extend(page)
+        self.assertEqual(len(hits), 25)
+        self.assertEqual(hits[0]["_source"], client.events[0])
+
+        result = client.search(
+            body={"size": 25, "sort": [{"hostname.keyword": {"order": "asc"}}]}
+        )
+        hostnames = [hit["_source"]["hostname"] for hit in result["hits"]["hits"]]
+        self.assertEqual(hostnames, sorted(hostnames))
+
+        result = client.search(
+            body={"aggs": {"hosts": {"terms": {"field": "hostname.keyword"}}}},
+            size=0,
+        )
+        buckets = result["aggregations"]["hosts"]["buckets"]
+        self.assertEqual(sum(bucket["doc_count"] for bucket in buckets), 25)
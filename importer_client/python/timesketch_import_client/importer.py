@@ -70,6 +70,7 @@ class ImportStreamer(object):
         self._sketch = None
         self._timeline_id = None
         self._timeline_name = None
+        self._total_file_size = 0
         self._upload_context = ""
 
         self._chunk = 1
@@ -257,6 +258,10 @@ class ImportStreamer(object):
         if self._index:
             data["index_name"] = self._index
 
+        # Lets the server size the index by the whole file, not the chunk.
+        if self._total_file_size:
+            data["total_file_size"] = self._total_file_size
+
         if self._upload_context:
             data["context"] = self._upload_context
 
@@ -337,6 +342,10 @@ class ImportStreamer(object):
         if self._index:
             data["index_name"] = self._index
 
+        # Lets the server size the index by the whole file, not the chunk.
+        if self._total_file_size:
+            data["total_file_size"] = self._total_file_size
+
         if self._upload_context:
             data["context"] = self._upload_context
 
@@ -642,6 +651,9 @@ class ImportStreamer(object):
         if not self._data_label:
             self._data_label = file_ending
 
+        if file_ending in ("csv", "jsonl"):
+            self._total_file_size = os.path.getsize(filepath)
+
         if file_ending == "csv":
             if self._csv_delimiter:
                 delimiter = self._csv_delimiter
@@ -36,6 +36,7 @@ from timesketch.lib.definitions import HTTP_STATUS_CODE_BAD_REQUEST
 from timesketch.lib.definitions import HTTP_STATUS_CODE_FORBIDDEN
 from timesketch.lib.definitions import HTTP_STATUS_CODE_NOT_FOUND
 from timesketch.lib.aggregators import manager as aggregator_manager
+from timesketch.lib.errors import SearchRejectedError
 from timesketch.models import db_session
 from timesketch.models.sketch import Aggregation
 from timesketch.models.sketch import AggregationGroup
@@ -508,6 +509,8 @@ class AggregationExploreResource(resources.ResourceMixin, Resource):
                         ",".join(indices), aggregator_parameters
                     ),
                 )
+            except SearchRejectedError as exc:
+                utils.abort_rejected_search(exc)
             except ValueError as exc:
                 abort(
                     HTTP_STATUS_CODE_BAD_REQUEST,
@@ -535,10 +538,19 @@ class AggregationExploreResource(resources.ResourceMixin, Resource):
                 meta["vega_chart_title"] = chart_title
 
         elif aggregation_dsl:
-            # pylint: disable=unexpected-keyword-arg
-            result = self.datastore.client.search(
-                index=",".join(sketch_indices), body=aggregation_dsl, size=0
-            )
+            try:
+                result = self.datastore.aggregate(
+                    list(sketch_indices),
+                    aggregation_dsl,
+                    search_id=request.json.get("search_id"),
+                )
+            except SearchRejectedError as exc:
+                utils.abort_rejected_search(exc)
+            except ValueError as exc:
+                abort(
+                    HTTP_STATUS_CODE_BAD_REQUEST,
+                    "Unable to run the aggregation, with error: {0!s}".format(exc),
+                )
 
             meta = {
                 "es_time": result.get("took", 0),
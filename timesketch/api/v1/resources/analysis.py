@@ -98,7 +98,7 @@ class AnalyzerSessionActiveListResource(resources.ResourceMixin, Resource):
                 HTTP_STATUS_CODE_FORBIDDEN, "User does not have read access to sketch"
             )
 
-        counter = collections.Counter(PENDING=0, STARTED=0, ERROR=0, DONE=0)
+        counter = collections.Counter(PENDING=0, DEFERRED=0, STARTED=0, ERROR=0, DONE=0)
         session_ids = set()
 
         active_sessions = sketch.get_active_analysis_sessions()
@@ -207,6 +207,7 @@ class EventCreateResource(resources.ResourceMixin, Resource):
                 self.datastore.import_event(
                     index_name, event_type, event, flush_interval=1
                 )
+                self.datastore.flush_queued_events()
 
                 timeline = Timeline.get_or_create(
                     name=searchindex.name,
@@ -31,14 +31,17 @@ from flask_login import current_user
 
 from timesketch.api.v1 import export
 from timesketch.api.v1 import resources
+from timesketch.api.v1.utils import abort_rejected_search
 from timesketch.lib import forms
 from timesketch.lib import utils
 from timesketch.lib.utils import get_validated_indices
+from timesketch.lib.datastores.opensearch import summarize_profile
 from timesketch.lib.definitions import DEFAULT_SOURCE_FIELDS
 from timesketch.lib.definitions import HTTP_STATUS_CODE_BAD_REQUEST
 from timesketch.lib.definitions import HTTP_STATUS_CODE_FORBIDDEN
 from timesketch.lib.definitions import HTTP_STATUS_CODE_NOT_FOUND
 from timesketch.lib.definitions import METRICS_NAMESPACE
+from timesketch.lib.errors import SearchRejectedError
 from timesketch.models import db_session
 from timesketch.models.sketch import Event
 from timesketch.models.sketch import Sketch
@@ -103,6 +106,9 @@ class ExploreResource(resources.ResourceMixin, Resource):
         query_filter = request.json.get("filter", {})
         parent = request.json.get("parent", None)
         incognito = request.json.get("incognito", False)
+        profile = bool(request.json.get("profile", False))
+        # ID chosen by the client, to cancel the search with a DELETE request.
+        search_id = request.json.get("search_id")
 
         return_field_string = form.fields.data
         if return_field_string:
@@ -186,7 +192,10 @@ class ExploreResource(resources.ResourceMixin, Resource):
                     indices=indices,
                     timeline_ids=timeline_ids,
                     count=True,
+                    search_id=search_id,
                 )
+            except SearchRejectedError as e:
+                abort_rejected_search(e)
             except ValueError as e:
                 abort(HTTP_STATUS_CODE_BAD_REQUEST, str(e))
 
@@ -208,16 +217,19 @@ class ExploreResource(resources.ResourceMixin, Resource):
             }
             with zipfile.ZipFile(file_object, mode="w") as zip_file:
                 zip_file.writestr("METADATA", data=json.dumps(form_data))
-                fh = export.query_to_filehandle(
-                    query_string=form.query.data,
-                    query_dsl=query_dsl,
-                    query_filter=query_filter,
-                    indices=indices,
-                    sketch=sketch,
-                    datastore=self.datastore,
-                    return_fields=return_fields,
-                    timeline_ids=timeline_ids,
-                )
+                try:
+                    fh = export.query_to_filehandle(
+                        query_string=form.query.data,
+                        query_dsl=query_dsl,
+                        query_filter=query_filter,
+                        indices=indices,
+                        sketch=sketch,
+                        datastore=self.datastore,
+                        return_fields=return_fields,
+                        timeline_ids=timeline_ids,
+                    )
+                except SearchRejectedError as e:
+                    abort_rejected_search(e)
                 fh.seek(0)
                 zip_file.writestr("query_results.csv", fh.read())
             file_object.seek(0)
@@ -238,7 +250,11 @@ class ExploreResource(resources.ResourceMixin, Resource):
                     return_fields=return_fields,
                     enable_scroll=enable_scroll,
                     timeline_ids=timeline_ids,
+                    profile=profile,
+                    search_id=search_id,
                 )
+            except SearchRejectedError as e:
+                abort_rejected_search(e)
             except ValueError as e:
                 abort(HTTP_STATUS_CODE_BAD_REQUEST, str(e))
 
@@ -390,6 +406,7 @@ class ExploreResource(resources.ResourceMixin, Resource):
             "count_over_time": count_over_time,
             "scroll_id": result.get("_scroll_id", ""),
             "search_node": search_node,
+            "timed_out": result.get("timed_out", False),
         }
 
         # Elasticsearch version 7.x returns total hits as a dictionary.
@@ -397,9 +414,46 @@ class ExploreResource(resources.ResourceMixin, Resource):
         if isinstance(meta["es_total_count"], dict):
             meta["es_total_count"] = meta["es_total_count"].get("value", 0)
 
+        # Summary of where the time of the search was spent, per shard.
+        if profile and result.get("profile"):
+            meta["profile"] = summarize_profile(result["profile"])
+
         schema = {"meta": meta, "objects": result["hits"]["hits"]}
         return jsonify(schema)
 
+    @login_required
+    def delete(self, sketch_id):
+        """Handles DELETE request to the resource.
+
+        Cancels a running search of the user, eg. when the user navigates
+        away before the search has finished.
+
+        Args:
+            sketch_id: Integer primary key for a sketch database model
+
+        Returns:
+            JSON with the number of search tasks that were cancelled.
+        """
+        sketch = Sketch.query.get_with_acl(sketch_id)
+        if not sketch:
+            abort(HTTP_STATUS_CODE_NOT_FOUND, "No sketch found with this ID.")
+
+        if not sketch.has_permission(current_user, "read"):
+            abort(
+                HTTP_STATUS_CODE_FORBIDDEN,
+                "User does not have read access controls on sketch.",
+            )
+
+        search_id = (request.get_json(silent=True) or {}).get("search_id")
+        if not search_id:
+            search_id = request.args.get("search_id")
+        if not search_id:
+            abort(HTTP_STATUS_CODE_BAD_REQUEST, "A search ID is required.")
+
+        cancelled = self.datastore.cancel_search(search_id)
+        schema = {"meta": {"cancelled": cancelled}, "objects": []}
+        return jsonify(schema)
+
 
 class QueryResource(resources.ResourceMixin, Resource):
     """Resource to get a query."""
@@ -211,6 +211,7 @@ class ExploreResourceTest(BaseTest):
                 "query_result_count": 0,
                 "query_string": "test",
             },
+            "timed_out": False,
         },
         "objects": [
             {
@@ -29,6 +29,7 @@ import altair as alt
 from timesketch.lib import ontology
 from timesketch.lib.aggregators import manager as aggregator_manager
 from timesketch.lib.definitions import HTTP_STATUS_CODE_BAD_REQUEST
+from timesketch.lib.definitions import HTTP_STATUS_CODE_TOO_MANY_REQUESTS
 from timesketch.models import db_session
 from timesketch.models.sketch import View
 
@@ -50,6 +51,20 @@ def bad_request(message):
     return response
 
 
+def abort_rejected_search(error):
+    """Aborts a request with a search that was not admitted.
+
+    Searches rejected because the user runs too many searches can be
+    retried later, expensive searches need to be changed.
+
+    Args:
+        error: SearchRejectedError raised by the datastore.
+    """
+    if error.reason == "concurrency":
+        abort(HTTP_STATUS_CODE_TOO_MANY_REQUESTS, str(error))
+    abort(HTTP_STATUS_CODE_BAD_REQUEST, str(error))
+
+
 def get_sketch_attributes(sketch):
     """Returns a dict with all attributes of a sketch."""
     attributes = {}
@@ -30,6 +30,7 @@ from flask_restful import Api
 from flask_wtf import CSRFProtect
 
 from timesketch.api.v1.routes import API_ROUTES as V1_API_ROUTES
+from timesketch.lib import tracing
 from timesketch.lib.errors import ApiHTTPError
 from timesketch.models import configure_engine
 from timesketch.models import init_db
@@ -123,6 +124,12 @@ def create_app(config=None, v2=False):
         except ImportError:
             pass
 
+    # Setup tracing of requests, tasks, OpenSearch and SQL calls.
+    if tracing.configure_tracing(app.config):
+        app.before_request(tracing.start_request_span)
+        app.after_request(tracing.record_response)
+        app.teardown_request(tracing.end_request_span)
+
     # Setup the database.
     configure_engine(app.config["SQLALCHEMY_DATABASE_URI"])
     db = init_db()
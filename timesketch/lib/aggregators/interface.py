@@ -373,12 +373,8 @@ class BaseAggregator(object):
         Returns:
             OpenSearch aggregation result.
         """
-        # pylint: disable=unexpected-keyword-arg, no-value-for-parameter
-
         try:
-            aggregation = self.opensearch.client.search(
-                index=self.indices, body=aggregation_spec, size=0
-            )
+            aggregation = self.opensearch.aggregate(self.indices, aggregation_spec)
         except opensearchpy.NotFoundError:
             logger.error("Unable to find indices: {0:s}".format(",".join(self.indices)))
             raise
@@ -217,6 +217,12 @@ class BrowserSearchSketchPlugin(interface.BaseAnalyzer):
             String with summary of the analyzer result
         """
         query = 'source_short:"WEBHIST" OR source:"WEBHIST"'
+        # Only fetch events with URLs that one of the filters can match.
+        query, _ = utils.add_regex_prefilter(
+            "url",
+            [expression for _, expression, _, _ in self._URL_FILTERS],
+            query_string=query,
+        )
         return_fields = ["url", "datetime"]
         search_emoji = emojis.get_emoji("MAGNIFYING_GLASS")
 
@@ -2,7 +2,6 @@
 from __future__ import unicode_literals
 
 import collections
-import uuid
 
 from timesketch.lib import emojis
 from timesketch.lib.analyzers import interface
@@ -61,7 +60,10 @@ class ChainSketchPlugin(interface.BaseAnalyzer):
         number_of_base_events = 0
         number_of_chains = 0
         counter = collections.Counter()
-        events_to_update = {}
+        # Only the chains are kept for every event, keyed by the index name
+        # and event ID, the events themselves are not kept around.
+        chains_to_add = collections.defaultdict(list)
+        event_types = {}
 
         # TODO: Have each plugin run in a separate task.
         # TODO: Add a time limit for each plugins run to prevent it from
@@ -81,27 +83,22 @@ class ChainSketchPlugin(interface.BaseAnalyzer):
                 return_fields=return_fields,
             )
 
-            for event in events:
-                if not chain_plugin.process_chain(event):
-                    continue
-                chain_id = uuid.uuid4().hex
+            base_events = [
+                event for event in events if chain_plugin.process_chain(event)
+            ]
 
-                chained_events = chain_plugin.build_chain(
-                    base_event=event, chain_id=chain_id
-                )
+            for event, chain_id, chained_events in chain_plugin.build_chains(
+                base_events
+            ):
                 number_chained_events = len(chained_events)
                 if not number_chained_events:
                     continue
 
                 for chained_event in chained_events:
-                    chained_id = chained_event.get("event_id")
-                    if chained_id not in events_to_update:
-                        default = {"event": chained_event.get("event"), "chains": []}
-                        events_to_update[chained_id] = default
-
-                    events_to_update[chained_id]["chains"].append(
-                        chained_event.get("chain")
-                    )
+                    linked_event = chained_event.get("event")
+                    key = (linked_event.index_name, linked_event.event_id)
+                    event_types[key] = linked_event.event_type
+                    chains_to_add[key].append(chained_event.get("chain"))
 
                 number_of_base_events += 1
 
@@ -114,18 +111,19 @@ class ChainSketchPlugin(interface.BaseAnalyzer):
                     "is_base": True,
                     "leafs": number_chained_events,
                 }
-                if event.event_id not in events_to_update:
-                    default = {"event": event, "chains": []}
-                    events_to_update[event.event_id] = default
-                events_to_update[event.event_id]["chains"].append(chain)
+                key = (event.index_name, event.event_id)
+                event_types[key] = event.event_type
+                chains_to_add[key].append(chain)
                 number_of_chains += 1
 
-        for event_update in events_to_update.values():
-            event = event_update.get("event")
-            attributes = {"chains": event_update.get("chains")}
-            event.add_attributes(attributes)
-            event.add_emojis([link_emoji])
-            event.commit()
+        for (index_name, event_id), chains in chains_to_add.items():
+            event_type = event_types[(index_name, event_id)]
+            self.update_buffer.add_attributes(
+                index_name, event_id, event_type, {"chains": chains}
+            )
+            self.update_buffer.add_emojis(
+                index_name, event_id, event_type, [link_emoji]
+            )
 
         chain_string = " - ".join(
             [
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 """This file contains an interface for chain analyzer plugins."""
 import abc
+import collections
+import uuid
 
 from timesketch.lib import emojis
 
@@ -72,6 +74,95 @@ class BaseChainPlugin(object):
             )
         return events
 
+    def build_chains(self, base_events):
+        """Returns chains of events for a list of base events.
+
+        Plugins that implement get_join_keys and get_candidate_events are
+        correlated in a single pass: the join keys of all base events are
+        collected, the candidate events are fetched once and then joined
+        to the base events locally. Other plugins fall back to calling
+        build_chain for every base event.
+
+        Args:
+            base_events: a list of base events (instances of Event).
+
+        Yields:
+            A tuple with the base event, the chain UUID and a list of dicts
+            with the chain and event attached.
+        """
+        batched_events = []
+        join_keys = set()
+        for base_event in base_events:
+            chain_id = uuid.uuid4().hex
+            event_keys = self.get_join_keys(base_event)
+            if event_keys is None:
+                yield base_event, chain_id, self.build_chain(base_event, chain_id)
+                continue
+
+            event_keys = set(event_keys)
+            join_keys.update(event_keys)
+            batched_events.append((base_event, chain_id, event_keys))
+
+        if not batched_events:
+            return
+
+        candidates = collections.defaultdict(list)
+        for join_key, event in self.get_candidate_events(join_keys):
+            candidates[join_key].append(event)
+
+        for base_event, chain_id, event_keys in batched_events:
+            events = []
+            seen_event_ids = set()
+            for join_key in event_keys:
+                for event in candidates.get(join_key, []):
+                    if event.event_id in seen_event_ids:
+                        continue
+                    seen_event_ids.add(event.event_id)
+                    chain = {
+                        "chain_id": chain_id,
+                        "plugin": self.NAME,
+                        "is_base": False,
+                    }
+                    events.append(
+                        {
+                            "event_id": event.event_id,
+                            "event": event,
+                            "chain": chain,
+                        }
+                    )
+            yield base_event, chain_id, events
+
+    def get_join_keys(self, base_event):
+        """Returns the keys used to join a base event to chained events.
+
+        Args:
+            base_event: the base event of the chain (instance of Event).
+
+        Returns:
+            A list of join keys, or None if the plugin does not support
+            batched correlation. By default this returns None.
+        """
+        if base_event:
+            return None
+        return None
+
+    def get_candidate_events(self, join_keys):
+        """Yields events that can be chained to base events with the keys.
+
+        This is only called for plugins that support batched correlation,
+        which override it to fetch the candidate events for all keys at
+        once. By default no events are yielded.
+
+        Args:
+            join_keys: a set of join keys collected from all base events.
+
+        Yields:
+            A tuple with a join key and an event (instance of Event) that
+            is linked to the base events with that join key.
+        """
+        del join_keys  # Unused by the default implementation.
+        yield from ()
+
     @abc.abstractmethod
     def get_chained_events(self, base_event):
         """Yields an event that is chained or linked to the base event.
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 """This file contains the plugin for executables in Windows prefetch files."""
 
+import collections
+
 from timesketch.lib.analyzers.chain_plugins import interface
 from timesketch.lib.analyzers.chain_plugins import manager
 
@@ -30,6 +32,84 @@ class WinPrefetchChainPlugin(interface.BaseChainPlugin):
         target = base_event.source.get("executable", "")
         return target.lower().endswith(".exe")
 
+    def get_join_keys(self, base_event):
+        """Returns the keys used to join a base event to chained events.
+
+        Args:
+            base_event: the base event of the chain (instance of Event).
+
+        Returns:
+            A list with the lower case executable name.
+        """
+        target = base_event.source.get("executable", "")
+        if not target:
+            return []
+        return [target.lower()]
+
+    def get_candidate_events(self, join_keys):
+        """Yields events that can be chained to base events with the keys.
+
+        All URL and LNK events that mention an executable are fetched once
+        and matched locally against every executable name.
+
+        Args:
+            join_keys: a set of lower case executable names.
+
+        Yields:
+            A tuple with the executable name and an event (instance of Event)
+            that refers to that executable.
+        """
+        if not join_keys:
+            return
+
+        targets_by_length = collections.defaultdict(set)
+        for target in join_keys:
+            targets_by_length[len(target)].add(target)
+
+        searches = [
+            ('url:"*exe*"', "url"),
+            ("parser:lnk", "link_target"),
+        ]
+        for search_query, field in searches:
+            events = self.analyzer_object.event_stream(
+                search_query, return_fields=[field]
+            )
+            for event in events:
+                value = event.source.get(field, "")
+                if not isinstance(value, str):
+                    continue
+                for target in self._find_targets(value.lower(), targets_by_length):
+                    yield target, event
+
+    @staticmethod
+    def _find_targets(value, targets_by_length):
+        """Returns the executable names that are contained in a string.
+
+        All executable names end with ".exe", so each occurrence of ".exe"
+        in the value is checked against the names of every length that end
+        at that position.
+
+        Args:
+            value: a lower case string.
+            targets_by_length: a dict with the length as a key and a set of
+                lower case executable names of that length as a value.
+
+        Returns:
+            A set of executable names found in the value.
+        """
+        found = set()
+        position = value.find(".exe")
+        while position != -1:
+            end = position + 4
+            for length, targets in targets_by_length.items():
+                if length > end:
+                    continue
+                candidate = value[end - length : end]
+                if candidate in targets:
+                    found.add(candidate)
+            position = value.find(".exe", position + 1)
+        return found
+
     def get_chained_events(self, base_event):
         """Yields an event that is chained or linked to the base event.
 
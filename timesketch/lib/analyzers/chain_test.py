@@ -11,6 +11,7 @@ from timesketch.lib import testlib
 from timesketch.lib.analyzers import chain
 from timesketch.lib.analyzers.chain_plugins import interface
 from timesketch.lib.analyzers.chain_plugins import manager
+from timesketch.lib.analyzers.chain_plugins import win_prefetch
 
 
 class FakeEvent(object):
@@ -18,6 +19,8 @@ class FakeEvent(object):
 
     def __init__(self, source_dict):
         self.event_id = uuid.uuid4().hex
+        self.event_type = "generic_event"
+        self.index_name = "test_index"
         self.attributes = {}
         self.emojis = []
         self.source = source_dict
@@ -44,6 +47,8 @@ class FakeAnalyzer(chain.ChainSketchPlugin):
         indices=None,
         return_fields=None,
         scroll=True,
+        force_refresh=False,
+        sort_fields=None,
     ):
         """Yields few test events."""
         event_one = FakeEvent({"url": "http://minsida.biz", "stuff": "foo"})
@@ -112,6 +117,31 @@ class FakeChainPlugin(interface.BaseChainPlugin):
                 yield event
 
 
+class FakeBatchChainPlugin(interface.BaseChainPlugin):
+    """Fake chain plugin that supports batched correlation."""
+
+    NAME = "fake_batch_chain"
+    DESCRIPTION = "Fake batched plugin for the chain analyzer."
+    SEARCH_QUERY = "give me all the data"
+    EVENT_FIELDS = ["url"]
+    CANDIDATE_QUERIES = 0
+
+    def get_join_keys(self, base_event):
+        """Returns the URL as the join key."""
+        return [base_event.source.get("url", "")]
+
+    def get_candidate_events(self, join_keys):
+        """Yields candidate events for all the URLs."""
+        FakeBatchChainPlugin.CANDIDATE_QUERIES += 1
+        yield "http://minsida.biz", FakeEvent({"a": "q"})
+        yield "http://minsida.biz", FakeEvent({"b": "w"})
+        yield "http://onnursida.biz", FakeEvent({"c": "e"})
+
+    def get_chained_events(self, base_event):
+        """Not used, since the plugin supports batched correlation."""
+        raise NotImplementedError
+
+
 class TestChainAnalyzer(testlib.BaseTest):
     """Tests the functionality of the analyzer."""
 
@@ -144,12 +174,45 @@ class TestChainAnalyzer(testlib.BaseTest):
 
         link_emoji = emojis.get_emoji("LINK")
         for event in plugin.ALL_EVENTS:
-            attributes = event.attributes
-            chains = attributes.get("chains", [])
+            update = analyzer.update_buffer.get(event.index_name, event.event_id)
+            chains = update.attributes.get("chains", [])
+            self.assertTrue(chains)
             for event_chain in chains:
                 plugin = event_chain.get("plugin", "")
                 self.assertEqual(plugin, "fake_chain")
 
-            event_emojis = event.emojis
-            self.assertEqual(len(event_emojis), 1)
-            self.assertEqual(event_emojis[0], link_emoji)
+            self.assertEqual(update.emojis, {link_emoji})
+
+    @mock.patch(
+        "timesketch.lib.analyzers.interface.OpenSearchDataStore", testlib.MockDataStore
+    )
+    def test_get_batched_chains(self):
+        """Test the chain with a plugin that supports batched correlation."""
+        for plugin in manager.ChainPluginsManager.get_plugins(None):
+            manager.ChainPluginsManager.deregister_plugin(plugin)
+
+        manager.ChainPluginsManager.register_plugin(FakeBatchChainPlugin)
+
+        analyzer = FakeAnalyzer("test_index", sketch_id=1)
+        analyzer.datastore.client = mock.Mock()
+
+        analyzer_result = analyzer.run()
+        expected_result = (
+            "2 base events annotated with a chain UUID for 2 chains "
+            "for a total of 3 events. [fake_batch_chain] 3"
+        )
+        self.assertEqual(analyzer_result, expected_result)
+        self.assertEqual(FakeBatchChainPlugin.CANDIDATE_QUERIES, 1)
+
+    def test_find_prefetch_targets(self):
+        """Test matching executable names in strings."""
+        targets_by_length = {7: {"cmd.exe"}, 9: {"setup.exe"}}
+        find_targets = getattr(win_prefetch.WinPrefetchChainPlugin, "_find_targets")
+        self.assertEqual(
+            find_targets("c:\\windows\\cmd.exe", targets_by_length), {"cmd.exe"}
+        )
+        self.assertEqual(
+            find_targets("http://x.biz/setup.exe?cmd.exe", targets_by_length),
+            {"cmd.exe", "setup.exe"},
+        )
+        self.assertEqual(find_targets("http://x.biz/a.exe", targets_by_length), set())
@@ -31,44 +31,55 @@ class DomainSketchPlugin(interface.BaseAnalyzer):
         Returns:
             String with summary of the analyzer result
         """
-        query = (
-            '{"query": { "bool": { "should": [ '
-            '{ "exists" : { "field" : "url" }}, '
-            '{ "exists" : { "field" : "domain" }} ] } } }'
-        )
-
-        return_fields = ["domain", "url"]
-
-        events = self.event_stream("", query_dsl=query, return_fields=return_fields)
-
-        domains = {}
-        domain_counter = collections.Counter()
-        tld_counter = collections.Counter()
-        cdn_counter = collections.Counter()
-
-        for event in events:
-            domain = event.source.get("domain")
-
-            if not domain:
-                url = event.source.get("url")
-                if not url:
-                    continue
-                domain = utils.get_domain_from_url(url)
-
+        # Events that have a domain attribute are counted and updated by the
+        # domain, those that only have a URL by the URL. The domain of
+        # those is extracted from the URL and added to the event.
+        url_only_query = {
+            "query": {
+                "bool": {
+                    "filter": [{"exists": {"field": "url"}}],
+                    "must_not": [{"exists": {"field": "domain"}}],
+                }
+            }
+        }
+
+        # The url field is mapped dynamically, values longer than the
+        # ignore_above limit of url.keyword are only in the source of the
+        # events, which are read for those events.
+        long_url_query = {
+            "query": {
+                "bool": {
+                    "filter": [{"exists": {"field": "url"}}],
+                    "must_not": [
+                        {"exists": {"field": "domain"}},
+                        {"exists": {"field": "url.keyword"}},
+                    ],
+                }
+            }
+        }
+
+        domain_counter = self.get_term_counts("domain.keyword")
+
+        url_domains = {}
+        url_counter = self.get_term_counts("url.keyword", query_dsl=url_only_query)
+        for url, count in url_counter.items():
+            domain = utils.get_domain_from_url(url)
             if not domain:
                 continue
+            url_domains[url] = domain
+            domain_counter[domain] += count
 
-            domain_counter[domain] += 1
-            domains.setdefault(domain, [])
-            domains[domain].append(event)
-
-            tld = ".".join(domain.split(".")[-2:])
-            tld_counter[tld] += 1
+        for event in self.event_stream(query_dsl=long_url_query, return_fields=["url"]):
+            domain = utils.get_domain_from_url(event.source.get("url", ""))
+            if domain:
+                domain_counter[domain] += 1
 
         # Exit early if there are no domains in the data set to analyze.
         if not domain_counter:
             return "No domains to analyze."
 
+        tlds = set(".".join(domain.split(".")[-2:]) for domain in domain_counter)
+
         domain_count_array = numpy.array(list(domain_counter.values()))
         try:
             domain_20th_percentile = int(numpy.percentile(domain_count_array, 20))
@@ -87,41 +98,49 @@ class DomainSketchPlugin(interface.BaseAnalyzer):
             else:
                 domain_85th_percentile = 100
 
-        common_domains = [
-            x for x, y in domain_counter.most_common() if y >= domain_85th_percentile
-        ]
-        rare_domains = [
-            x for x, y in domain_counter.most_common() if y <= domain_20th_percentile
-        ]
-
-        for domain, count in iter(domain_counter.items()):
+        cdn_counter = collections.Counter()
+        domain_updates = {}
+        for domain, count in domain_counter.items():
             tags_to_add = []
+            new_attributes = {"domain": domain, "domain_count": count}
 
             cdn_provider = utils.get_cdn_provider(domain)
             if cdn_provider:
                 tags_to_add.append("known-cdn")
                 cdn_counter[cdn_provider] += 1
+                new_attributes["cdn_provider"] = cdn_provider
 
-            if domain in rare_domains:
+            if count <= domain_20th_percentile:
                 tags_to_add.append("rare-domain")
 
-            for event in domains.get(domain, []):
-                event.add_tags(tags_to_add)
+            if count >= domain_85th_percentile:
+                new_attributes["is_common_domain"] = True
 
-                new_attributes = {"domain": domain, "domain_count": count}
-                if domain in common_domains:
-                    new_attributes["is_common_domain"] = True
-                if cdn_provider:
-                    new_attributes["cdn_provider"] = cdn_provider
-                event.add_attributes(new_attributes)
+            domain_updates[domain] = {
+                "tags": tags_to_add,
+                "attributes": new_attributes,
+            }
 
-                # Commit the event to the datastore.
-                event.commit()
+        self.update_by_terms("domain.keyword", domain_updates)
+
+        url_updates = {
+            url: domain_updates[domain] for url, domain in url_domains.items()
+        }
+        self.update_by_terms("url.keyword", url_updates, query_dsl=url_only_query)
+
+        for event in self.event_stream(query_dsl=long_url_query, return_fields=["url"]):
+            domain = utils.get_domain_from_url(event.source.get("url", ""))
+            update = domain_updates.get(domain)
+            if not update:
+                continue
+            event.add_attributes(update["attributes"])
+            event.add_tags(update["tags"])
+            event.commit()
 
         return (
             "{0:d} domains discovered ({1:d} TLDs) and {2:d} known "
             "CDN networks found."
-        ).format(len(domains), len(tld_counter), len(cdn_counter))
+        ).format(len(domain_counter), len(tlds), len(cdn_counter))
 
 
 manager.AnalysisManager.register_analyzer(DomainSketchPlugin)
@@ -1,6 +1,8 @@
 """Tests for DomainPlugin."""
 from __future__ import unicode_literals
 
+import collections
+
 import mock
 
 from timesketch.lib.analyzers import domain
@@ -20,3 +22,47 @@ class TestDomainPlugin(BaseTest):
         analyzer = domain.DomainSketchPlugin(index_name, sketch_id)
         self.assertEqual(analyzer.index_name, index_name)
         self.assertEqual(analyzer.sketch.id, sketch_id)
+
+    @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
+    def test_domain_analyzer_run(self):
+        """Test that domains are counted and tagged using aggregations."""
+        analyzer = domain.DomainSketchPlugin("test", 1)
+        term_counts = {
+            "domain.keyword": collections.Counter(
+                {"www.example.com": 1, "cdn.akamaihd.net": 10}
+            ),
+            "url.keyword": collections.Counter({"https://www.example.com/a": 2}),
+        }
+
+        # An URL too long for url.keyword is read from the event source.
+        long_url_event = mock.Mock()
+        long_url_event.source = {"url": "https://www.example.com/" + "a" * 300}
+
+        with mock.patch.object(
+            analyzer, "get_term_counts", side_effect=lambda f, **kw: term_counts[f]
+        ), mock.patch.object(
+            analyzer, "event_stream", return_value=[long_url_event]
+        ), mock.patch.object(
+            analyzer, "update_by_terms"
+        ) as mock_update:
+            result = analyzer.run()
+
+        self.assertEqual(
+            result, "2 domains discovered (2 TLDs) and 1 known CDN networks found."
+        )
+        domain_updates = mock_update.call_args_list[0][0][1]
+        self.assertEqual(
+            domain_updates["www.example.com"]["attributes"]["domain_count"], 4
+        )
+        long_url_event.add_attributes.assert_called_once_with(
+            domain_updates["www.example.com"]["attributes"]
+        )
+        long_url_event.commit.assert_called_once()
+        self.assertIn("known-cdn", domain_updates["cdn.akamaihd.net"]["tags"])
+
+        field, url_updates = mock_update.call_args_list[1][0]
+        self.assertEqual(field, "url.keyword")
+        self.assertEqual(
+            url_updates["https://www.example.com/a"],
+            domain_updates["www.example.com"],
+        )
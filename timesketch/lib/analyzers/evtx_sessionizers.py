@@ -3,6 +3,8 @@ log."""
 
 from __future__ import unicode_literals
 import re
+
+from flask import current_app
 import opensearchpy.exceptions
 
 from timesketch.lib.analyzers import manager
@@ -18,6 +20,21 @@ class WinEVTXSessionizerSketchPlugin(SessionizerSketchPlugin):
     Windows EVTX logs, where a session begins with some defined start event and
     ends with some defined end event or a startup event."""
 
+    def __init__(self, index_name, sketch_id, timeline_id=None):
+        """Initialize the analyzer.
+
+        Args:
+            index_name: OpenSearch index name.
+            sketch_id: Sketch ID.
+            timeline_id: The timeline ID.
+        """
+        super().__init__(index_name, sketch_id, timeline_id=timeline_id)
+        # Add a single view with a facet of the sessions instead of a view
+        # for each session.
+        self._collapse_views = current_app.config.get(
+            "ANALYZERS_COLLAPSE_ENTITY_VIEWS", False
+        )
+
     def run(self):
         """Entry point for the analyzer. Create sessions consisting of a start
         and end event.
@@ -49,6 +66,13 @@ class WinEVTXSessionizerSketchPlugin(SessionizerSketchPlugin):
                 processed,
             ) = self.processSessions(events, session_num, login_events)
 
+        if session_num and self._collapse_views:
+            self.sketch.add_faceted_view(
+                "{0:s}s".format(self.session_type.replace("_", " ").capitalize()),
+                self.NAME,
+                "session_id.{0:s}".format(self.session_type),
+            )
+
         msg = "Sessionizing completed, number of sessions created: {0:d}"
         return msg.format(session_num)
 
@@ -90,10 +114,13 @@ class WinEVTXSessionizerSketchPlugin(SessionizerSketchPlugin):
                     self.annotateEvent(event, [session_id])
                     start_events[logon_id] = session_id
 
-                    view_query = 'session_id.{0:s}:"{1:s}"'.format(
-                        self.session_type, session_id
-                    )
-                    self.sketch.add_view(session_id, self.NAME, query_string=view_query)
+                    if not self._collapse_views:
+                        view_query = 'session_id.{0:s}:"{1:s}"'.format(
+                            self.session_type, session_id
+                        )
+                        self.sketch.queue_view(
+                            session_id, self.NAME, query_string=view_query
+                        )
                     session_num += 1
 
                 elif event_id in self.end_events:
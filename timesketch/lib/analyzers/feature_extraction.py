@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 
 import logging
 
+from flask import current_app
 import six
 
 from timesketch.lib import emojis
@@ -155,6 +156,7 @@ class FeatureExtractionSketchPlugin(interface.BaseAnalyzer):
         self.index_name = index_name
         self._feature_name = kwargs.get("feature")
         self._feature_config = kwargs.get("feature_config")
+        self._feature_configs = kwargs.get("feature_configs")
         super().__init__(index_name, sketch_id, timeline_id=timeline_id)
 
     def run(self):
@@ -163,6 +165,8 @@ class FeatureExtractionSketchPlugin(interface.BaseAnalyzer):
         Returns:
             String with summary of the analyzer result.
         """
+        if self._feature_configs:
+            return self.extract_features(self._feature_configs)
         return self.extract_feature(self._feature_name, self._feature_config)
 
     @staticmethod
@@ -208,101 +212,140 @@ class FeatureExtractionSketchPlugin(interface.BaseAnalyzer):
             return ",".join(extracted_value)
         return extracted_value[0]
 
-    def extract_feature(self, name, config):
-        """Extract features from events.
+    @staticmethod
+    def _get_feature(config):
+        """Returns a dict with the settings of a feature extraction.
 
         Args:
-            name: String with the name describing the feature to be extracted.
             config: A dict that contains the configuration for the feature
                 extraction. See data/features.yaml for fields and further
                 documentation of what needs to be defined.
 
         Returns:
-            String with summary of the analyzer result.
+            Dict with the parsed configuration of the feature extraction or
+            None if the configuration is incomplete.
         """
-        query = config.get("query_string")
-        query_dsl = config.get("query_dsl")
         attribute = config.get("attribute")
-        store_type_list = config.get("store_type_list", False)
-        keep_multimatch = config.get("keep_multimatch", False)
-        overwrite_store_as = config.get("overwrite_store_as", True)
-        overwrite_and_merge_store_as = config.get("overwrite_and_merge_store_as", False)
-
         if not attribute:
             logger.warning("No attribute defined.")
-            return ""
+            return None
 
         store_as = config.get("store_as")
         if not store_as:
             logger.warning("No attribute defined to store results in.")
-            return ""
-
-        tags = config.get("tags", [])
+            return None
 
         expression_string = config.get("re")
         if not expression_string:
             logger.warning("No regular expression defined.")
-            return ""
+            return None
 
         expression = utils.compile_regular_expression(
             expression_string=expression_string, expression_flags=config.get("re_flags")
         )
+        if not expression:
+            return None
 
         emoji_names = config.get("emojis", [])
-        emojis_to_add = [emojis.get_emoji(x) for x in emoji_names]
 
-        return_fields = [attribute, store_as]
-
-        events = self.event_stream(
-            query_string=query, query_dsl=query_dsl, return_fields=return_fields
+        query_string = config.get("query_string")
+        query_dsl = config.get("query_dsl")
+        # Only search for events the regular expression can match, the
+        # query of the view is left as is.
+        search_query_string, search_query_dsl = utils.add_regex_prefilter(
+            attribute, [expression], query_string=query_string, query_dsl=query_dsl
         )
 
-        event_counter = 0
-        for event in events:
-            attribute_field = event.source.get(attribute)
-            if isinstance(attribute_field, six.text_type):
-                attribute_value = attribute_field
-            elif isinstance(attribute_field, (list, tuple)):
-                attribute_value = ",".join(attribute_field)
-            elif isinstance(attribute_field, (int, float)):
-                attribute_value = attribute_field
-            else:
-                attribute_value = None
-
-            if not attribute_value:
-                continue
+        return {
+            "query_string": query_string,
+            "query_dsl": query_dsl,
+            "search": {
+                "query_string": search_query_string,
+                "query_dsl": search_query_dsl,
+            },
+            "attribute": attribute,
+            "store_as": store_as,
+            "store_type_list": config.get("store_type_list", False),
+            "keep_multimatch": config.get("keep_multimatch", False),
+            "overwrite_store_as": config.get("overwrite_store_as", True),
+            "overwrite_and_merge_store_as": config.get(
+                "overwrite_and_merge_store_as", False
+            ),
+            "tags": config.get("tags", []),
+            "expression": expression,
+            "emojis": [emojis.get_emoji(x) for x in emoji_names],
+            "aggregate": config.get("aggregate", False),
+            "create_view": config.get("create_view", False),
+            "event_counter": 0,
+        }
+
+    def _extract_event(self, event, feature):
+        """Extract a feature from an event, without committing it.
+
+        The extracted value is also set in the source of the event, so
+        that later feature extractions on the same event see it.
 
-            result = expression.findall(attribute_value)
-            if not result:
-                continue
-            result = list(set(result))
+        Args:
+            event: Event object that matched the query of the feature.
+            feature: Dict with the settings of the feature extraction, see
+                _get_feature.
+        """
+        attribute_field = event.source.get(feature["attribute"])
+        if isinstance(attribute_field, six.text_type):
+            attribute_value = attribute_field
+        elif isinstance(attribute_field, (list, tuple)):
+            attribute_value = ",".join(attribute_field)
+        elif isinstance(attribute_field, (int, float)):
+            attribute_value = attribute_field
+        else:
+            attribute_value = None
+
+        if not attribute_value:
+            return
+
+        result = feature["expression"].findall(attribute_value)
+        if not result:
+            return
+        result = list(set(result))
+
+        feature["event_counter"] += 1
+        store_as = feature["store_as"]
+        store_as_current_val = event.source.get(store_as)
+        if store_as_current_val and not feature["overwrite_store_as"]:
+            return
+        store_type_list = feature["store_type_list"]
+        if isinstance(store_as_current_val, six.text_type):
+            store_type_list = False
+        elif isinstance(store_as_current_val, (list, tuple)):
+            store_type_list = True
+        new_value = self._get_attribute_value(
+            store_as_current_val,
+            result,
+            feature["keep_multimatch"],
+            feature["overwrite_and_merge_store_as"],
+            store_type_list,
+        )
+        if not new_value:
+            return
+        event.add_attributes({store_as: new_value})
+        event.source[store_as] = new_value
+        event.add_emojis(feature["emojis"])
+        event.add_tags(feature["tags"])
 
-            event_counter += 1
-            store_as_current_val = event.source.get(store_as)
-            if store_as_current_val and not overwrite_store_as:
-                continue
-            if isinstance(store_as_current_val, six.text_type):
-                store_type_list = False
-            elif isinstance(store_as_current_val, (list, tuple)):
-                store_type_list = True
-            new_value = self._get_attribute_value(
-                store_as_current_val,
-                result,
-                keep_multimatch,
-                overwrite_and_merge_store_as,
-                store_type_list,
-            )
-            if not new_value:
-                continue
-            event.add_attributes({store_as: new_value})
-            event.add_emojis(emojis_to_add)
-            event.add_tags(tags)
+    def _finish_feature(self, name, feature):
+        """Creates the view of a feature extraction and returns its summary.
 
-            # Commit the event to the datastore.
-            event.commit()
+        Args:
+            name: String with the name describing the extracted feature.
+            feature: Dict with the settings of the feature extraction, see
+                _get_feature.
 
-        aggregate_results = config.get("aggregate", False)
-        create_view = config.get("create_view", False)
+        Returns:
+            String with summary of the feature extraction result.
+        """
+        event_counter = feature["event_counter"]
+        aggregate_results = feature["aggregate"]
+        create_view = feature["create_view"]
 
         # If aggregation is turned on, we automatically create an aggregation.
         if aggregate_results:
@@ -310,10 +353,14 @@ class FeatureExtractionSketchPlugin(interface.BaseAnalyzer):
 
         if create_view and event_counter:
             view = self.sketch.add_view(
-                name, self.NAME, query_string=query, query_dsl=query_dsl
+                name,
+                self.NAME,
+                query_string=feature["query_string"],
+                query_dsl=feature["query_dsl"],
             )
 
             if aggregate_results:
+                store_as = feature["store_as"]
                 params = {
                     "field": store_as,
                     "limit": 20,
@@ -332,17 +379,93 @@ class FeatureExtractionSketchPlugin(interface.BaseAnalyzer):
             name, event_counter
         )
 
+    def extract_feature(self, name, config):
+        """Extract features from events.
+
+        Args:
+            name: String with the name describing the feature to be extracted.
+            config: A dict that contains the configuration for the feature
+                extraction. See data/features.yaml for fields and further
+                documentation of what needs to be defined.
+
+        Returns:
+            String with summary of the analyzer result.
+        """
+        feature = self._get_feature(config)
+        if not feature:
+            return ""
+
+        return_fields = [feature["attribute"], feature["store_as"]]
+
+        events = self.event_stream(
+            query_string=feature["search"]["query_string"],
+            query_dsl=feature["search"]["query_dsl"],
+            return_fields=return_fields,
+        )
+
+        for event in events:
+            self._extract_event(event, feature)
+            # Commit the event to the datastore.
+            event.commit()
+
+        return self._finish_feature(name, feature)
+
+    def extract_features(self, configs):
+        """Extract several features from events in one search.
+
+        The queries of all feature extractions are combined into a single
+        search, each event is processed by every feature extraction whose
+        query it matched, in the order of the configuration. Results and
+        views are the same as running each feature extraction on its own.
+
+        Args:
+            configs: Dict with the name of each feature as key and its
+                configuration as value, see data/features.yaml.
+
+        Returns:
+            String with summary of the analyzer result.
+        """
+        features = {}
+        return_fields = set()
+        for name, config in configs.items():
+            feature = self._get_feature(config)
+            if not feature:
+                continue
+            if not (feature["query_string"] or feature["query_dsl"]):
+                logger.warning("No query defined for feature: {0:s}".format(name))
+                continue
+            features[name] = feature
+            return_fields.update([feature["attribute"], feature["store_as"]])
+
+        searches = {name: feature["search"] for name, feature in features.items()}
+        events = self.multi_query_stream(searches, return_fields=list(return_fields))
+        for event in events:
+            matched_queries = set(event.matched_queries)
+            for name, feature in features.items():
+                if name in matched_queries:
+                    self._extract_event(event, feature)
+            # Commit the event to the datastore.
+            event.commit()
+
+        return "\n".join(
+            self._finish_feature(name, feature) for name, feature in features.items()
+        )
+
     @staticmethod
     def get_kwargs():
         """Get kwargs for the analyzer.
 
         Returns:
-            List of features to search for.
+            List of features to search for. If ANALYZERS_SINGLE_PASS is
+            enabled all features are extracted by a single analyzer.
         """
         features_config = interface.get_yaml_config("features.yaml")
         if not features_config:
             return "Unable to parse the config features file."
 
+        if current_app.config.get("ANALYZERS_SINGLE_PASS", True):
+            return [{"feature_configs": features_config}]
+
         features_kwargs = [
             {"feature": feature, "feature_config": config}
             for feature, config in features_config.items()
@@ -165,3 +165,55 @@ class TestFeatureExtractionPlugin(BaseTest):
         )
 
         self.assertEqual(new_val, "hello2")
+
+    @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
+    def test_extract_features(self):
+        """Test extracting several features in a single search."""
+        config = yaml.safe_load(
+            """
+        ip_from_message:
+          query_string: 'message:from'
+          attribute: 'message'
+          store_as: 'found_ip'
+          re: 'from ([0-9\\.]+)'
+        ip_to_message:
+          query_dsl: '{"query": {"match": {"message": "to"}}}'
+          attribute: 'message'
+          store_as: 'found_ip'
+          re: 'to ([0-9\\.]+)'
+          overwrite_and_merge_store_as: true
+          tags: ['ip']
+        incomplete:
+          query_string: '*'
+          """
+        )
+        analyzer = feature_extraction.FeatureExtractionSketchPlugin(
+            "test_index", 1, feature_configs=config
+        )
+        analyzer.datastore.client = mock.Mock()
+        analyzer.datastore.import_event(
+            "blah", "_doc", {"message": "from 10.0.0.1 to 10.0.0.2"}, "0"
+        )
+        hits = [dict(analyzer.datastore.event_store["0"])]
+        hits[0]["matched_queries"] = ["ip_to_message", "ip_from_message"]
+
+        with mock.patch.object(
+            analyzer.datastore, "search_stream", return_value=iter(hits)
+        ) as mock_search:
+            message = analyzer.run()
+
+        self.assertEqual(mock_search.call_count, 1)
+        clauses = mock_search.call_args[1]["query_dsl"]["query"]["bool"]["should"]
+        self.assertEqual(len(clauses), 2)
+        self.assertEqual(clauses[1]["bool"]["_name"], "ip_to_message")
+        self.assertEqual(clauses[1]["bool"]["must"], [{"match": {"message": "to"}}])
+
+        # The second feature merges with the value stored by the first.
+        source = analyzer.datastore.event_store["0"]["_source"]
+        self.assertEqual(source["found_ip"], "10.0.0.1,10.0.0.2")
+        self.assertEqual(analyzer.update_buffer.get("blah", "0").tags, {"ip"})
+        self.assertEqual(
+            message,
+            "Feature extraction [ip_from_message] extracted 1 features.\n"
+            "Feature extraction [ip_to_message] extracted 1 features.",
+        )
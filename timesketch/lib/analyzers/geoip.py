@@ -16,10 +16,14 @@
 
 import os
 import ipaddress
+import json
 import logging
+import sqlite3
+import time
 
 from collections import defaultdict
-from typing import Tuple, Union
+from concurrent import futures
+from typing import Dict, Iterable, Tuple, Union
 
 from flask import current_app
 
@@ -40,9 +44,153 @@ class GeoIPClientError(Exception):
     """An error raised by the GeoIP client"""
 
 
+class GeoIpCache(object):
+    """An on-disk cache of IP address geolocations, shared between analyzers.
+
+    Geolocations are stored in a SQLite database, keyed by the IP address and
+    the version of the data that was used to look it up, eg. the build epoch
+    of a MaxMind database. The least recently used entries are evicted once
+    the cache holds more than the maximum number of entries.
+    """
+
+    DEFAULT_MAX_ENTRIES = 1000000
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        """Initialize the cache.
+
+        Args:
+            path: Path to the SQLite database file of the cache.
+            max_entries: Maximum number of geolocations to keep.
+        """
+        self._path = path
+        self._max_entries = max_entries
+        self._connection = None
+
+    def _create_file(self):
+        """Create the cache database file, readable only by its owner.
+
+        Raises:
+            OSError: If the file is a symbolic link, or is owned or writable
+                by another user.
+        """
+        file_descriptor = os.open(
+            self._path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600
+        )
+        try:
+            stat_result = os.fstat(file_descriptor)
+        finally:
+            os.close(file_descriptor)
+
+        # Refuse a cache that someone else could have filled with false
+        # geolocations.
+        if stat_result.st_uid != os.getuid() or stat_result.st_mode & 0o022:
+            raise OSError(
+                "Cache {0:s} is owned or writable by another user".format(self._path)
+            )
+
+    def __enter__(self):
+        """Open the cache database."""
+        self._create_file()
+        self._connection = sqlite3.connect(self._path, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS geolocation ("
+            "ip_address TEXT NOT NULL, version TEXT NOT NULL, "
+            "response TEXT, last_used REAL NOT NULL, "
+            "PRIMARY KEY (ip_address, version))"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS geolocation_last_used "
+            "ON geolocation (last_used)"
+        )
+        self._connection.commit()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the cache database."""
+        self._connection.close()
+        self._connection = None
+
+    def get_many(self, ip_addresses: Iterable[str], version: str) -> Dict:
+        """Get cached geolocations of IP addresses.
+
+        Args:
+            ip_addresses: IP addresses to look up.
+            version: Version of the geolocation data.
+
+        Returns:
+            Dict with the IP addresses found in the cache as keys and the
+            geolocation tuple, or None if the IP address was not resolvable,
+            as values.
+        """
+        results = {}
+        ip_addresses = list(ip_addresses)
+        # Stay below the SQLite limit of variables in a single statement.
+        for index in range(0, len(ip_addresses), 500):
+            batch = ip_addresses[index : index + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = self._connection.execute(
+                "SELECT ip_address, response FROM geolocation WHERE version = ? "
+                "AND ip_address IN ({0:s})".format(placeholders),
+                [version] + batch,
+            )
+            for ip_address, response in rows:
+                response = json.loads(response)
+                results[ip_address] = tuple(response) if response else None
+
+        now = time.time()
+        self._connection.executemany(
+            "UPDATE geolocation SET last_used = ? "
+            "WHERE ip_address = ? AND version = ?",
+            [(now, ip_address, version) for ip_address in results],
+        )
+        self._connection.commit()
+        return results
+
+    def set_many(self, responses: Dict, version: str):
+        """Store geolocations of IP addresses and evict old entries.
+
+        Args:
+            responses: Dict with IP addresses as keys and the geolocation
+                tuple, or None if the IP address was not resolvable, as
+                values.
+            version: Version of the geolocation data.
+        """
+        now = time.time()
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO geolocation VALUES (?, ?, ?, ?)",
+            [
+                (ip_address, version, json.dumps(response), now)
+                for ip_address, response in responses.items()
+            ],
+        )
+        (count,) = self._connection.execute(
+            "SELECT COUNT(*) FROM geolocation"
+        ).fetchone()
+        if count > self._max_entries:
+            self._connection.execute(
+                "DELETE FROM geolocation WHERE rowid IN (SELECT rowid FROM "
+                "geolocation ORDER BY last_used LIMIT ?)",
+                (count - self._max_entries,),
+            )
+        self._connection.commit()
+
+
 class GeoIpClientAdapter(object):
     """Base adapter interface for a third party geolocation service."""
 
+    # Number of lookups that can be done concurrently.
+    MAX_CONCURRENT_LOOKUPS = 1
+
+    def cache_version(self) -> Union[str, None]:
+        """Returns the version of the geolocation data, used for caching.
+
+        Returns:
+            A string that changes when the geolocation data changes, or None
+            if lookups should not be cached.
+        """
+        return None
+
     def __enter__(self):
         """Initialise and open a new a client (self) for performing IP address
         lookups against a database or service.
@@ -95,6 +243,10 @@ class MaxMindGeoDbClient(geoip2.database.Reader, GeoIpClientAdapter):
         """Close and clean up client."""
         return super().__exit__(exc_type, exc_value, traceback)
 
+    def cache_version(self) -> Union[str, None]:
+        """Returns the build epoch of the database, used for caching."""
+        return "db:{0:d}".format(self.metadata().build_epoch)
+
     def ip2geo(self, ip_address) -> Union[Tuple[str, str, str, str, str], None]:
         """Perform a IP to geolocation lookup.
 
@@ -133,6 +285,8 @@ class MaxMindGeoDbClient(geoip2.database.Reader, GeoIpClientAdapter):
 class MaxMindGeoWebClient(geoip2.webservice.Client, GeoIpClientAdapter):
     """A GeoIP client using the MaxMind web service api."""
 
+    MAX_CONCURRENT_LOOKUPS = 8
+
     def __init__(self):
         self._account_id = current_app.config.get("MAXMIND_WEB_ACCOUNT_ID")
         self._license_key = current_app.config.get("MAXMIND_WEB_LICENSE_KEY")
@@ -145,6 +299,10 @@ class MaxMindGeoWebClient(geoip2.webservice.Client, GeoIpClientAdapter):
             raise GeoIPClientError("MaxMind host not set.")
         super().__init__(self._account_id, self._license_key, host=self._host)
 
+    def cache_version(self) -> Union[str, None]:
+        """Returns the current month, so cached lookups expire monthly."""
+        return time.strftime("web:%Y-%m", time.gmtime())
+
     def __enter__(self):
         """Initialise and open a new a client (self) for performing IP address
         lookups against a database or service.
@@ -265,7 +423,9 @@ class BaseGeoIpAnalyzer(interface.BaseAnalyzer):
 
         events = self.event_stream(query_string=query, return_fields=return_fields)
 
-        ip_addresses = defaultdict(lambda: defaultdict(list))
+        # Only the distinct IP addresses and the fields they were found in
+        # are kept, the events are updated by field and IP address below.
+        ip_addresses = defaultdict(set)
 
         for event in events:
             for ip_address_field in self.IP_FIELDS:
@@ -284,15 +444,20 @@ class BaseGeoIpAnalyzer(interface.BaseAnalyzer):
                             )
                         )
                         continue
-                    ip_addresses[ip_addr][ip_address_field].append(event)
+                    ip_addresses[ip_addr].add(ip_address_field)
 
         try:
             client = self.GEOIP_CLIENT()  # pylint: disable=E1102
         except GeoIPClientError as error:
             return f"GeoIP Client error - {error}"
 
+        responses = self._get_geolocations(client, list(ip_addresses))
+
+        field_updates = defaultdict(dict)
         for ip_address, ip_address_fields in ip_addresses.items():
-            response = client.ip2geo(ip_address)
+            response = responses.get(ip_address)
+            if response is None:
+                continue
 
             try:
                 iso_code, latitude, longitude, country_name, city_name = response
@@ -314,27 +479,79 @@ class BaseGeoIpAnalyzer(interface.BaseAnalyzer):
                     )
                 )
 
-            for ip_address_field, events in ip_address_fields.items():
-                for event in events:
+            for ip_address_field in ip_address_fields:
+                new_attributes = {}
+                if latitude and longitude:
+                    new_attributes[f"{ip_address_field}_latitude"] = latitude
+                    new_attributes[f"{ip_address_field}_longitude"] = longitude
+                if iso_code:
+                    new_attributes[f"{ip_address_field}_iso_code"] = iso_code
+                if city_name:
+                    new_attributes[f"{ip_address_field}_city"] = city_name
+
+                update = {"attributes": new_attributes}
+                if flag_emoji:
+                    update["emojis"] = [flag_emoji]
+                if country_name:
+                    update["tags"] = [country_name]
+                field_updates[ip_address_field][ip_address] = update
+
+        for ip_address_field, updates in field_updates.items():
+            self.update_by_terms(f"{ip_address_field}.keyword", updates)
 
-                    new_attributes = {}
-                    if latitude and longitude:
-                        new_attributes[f"{ip_address_field}_latitude"] = latitude
-                        new_attributes[f"{ip_address_field}_longitude"] = longitude
-                    if iso_code:
-                        new_attributes[f"{ip_address_field}_iso_code"] = iso_code
-                    if city_name:
-                        new_attributes[f"{ip_address_field}_city"] = city_name
-                    event.add_attributes(new_attributes)
+        return f"Found {len(ip_addresses)} IP address(es)."
 
-                    if flag_emoji:
-                        event.add_emojis([flag_emoji])
+    def _get_geolocations(self, client, ip_addresses):
+        """Geolocate IP addresses, using the on-disk cache if configured.
 
-                    if country_name:
-                        event.add_tags([country_name])
-                    event.commit()
+        Args:
+            client: An instance of a GeoIpClientAdapter.
+            ip_addresses: List of IP addresses to geolocate.
 
-        return f"Found {len(ip_addresses)} IP address(es)."
+        Returns:
+            Dict with IP addresses as keys and the geolocation tuple, or
+            None if the IP address was not resolvable, as values.
+        """
+        cache_path = current_app.config.get("GEOIP_CACHE_PATH")
+        version = client.cache_version() if cache_path else None
+        if not version:
+            return self._lookup(client, ip_addresses)
+
+        max_entries = current_app.config.get(
+            "GEOIP_CACHE_MAX_ENTRIES", GeoIpCache.DEFAULT_MAX_ENTRIES
+        )
+        try:
+            with GeoIpCache(cache_path, max_entries=max_entries) as cache:
+                responses = cache.get_many(ip_addresses, version)
+                missing = [ip for ip in ip_addresses if ip not in responses]
+                new_responses = self._lookup(client, missing)
+                cache.set_many(new_responses, version)
+        except (OSError, sqlite3.Error) as error:
+            logger.warning("Unable to use the GeoIP cache: {0!s}".format(error))
+            return self._lookup(client, ip_addresses)
+
+        responses.update(new_responses)
+        return responses
+
+    @staticmethod
+    def _lookup(client, ip_addresses):
+        """Geolocate IP addresses using a GeoIP client.
+
+        Args:
+            client: An instance of a GeoIpClientAdapter.
+            ip_addresses: List of IP addresses to geolocate.
+
+        Returns:
+            Dict with IP addresses as keys and the geolocation tuple, or
+            None if the IP address was not resolvable, as values.
+        """
+        max_workers = getattr(client, "MAX_CONCURRENT_LOOKUPS", 1)
+        if max_workers <= 1 or len(ip_addresses) <= 1:
+            return {ip: client.ip2geo(ip) for ip in ip_addresses}
+
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            responses = executor.map(client.ip2geo, ip_addresses)
+            return dict(zip(ip_addresses, responses))
 
 
 class MaxMindDbGeoIPAnalyzer(BaseGeoIpAnalyzer):
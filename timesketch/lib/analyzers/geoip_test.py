@@ -15,8 +15,12 @@
 """Tests for GeoIP analyzer."""
 from __future__ import unicode_literals
 
+import os
+import tempfile
+
 import mock
 
+from timesketch.lib.analyzers.geoip import GeoIpCache
 from timesketch.lib.analyzers.geoip import MaxMindDbGeoIPAnalyzer
 from timesketch.lib.analyzers.geoip import MaxMindDbWebIPAnalyzer
 
@@ -29,6 +33,16 @@ from timesketch.lib.testlib import MockDataStore
 from timesketch.lib.analyzers.base_sessionizer_test import _create_mock_event
 
 
+def _get_added_attributes(mock_update):
+    """Returns all attributes added with a mocked update_by_terms."""
+    attributes = {}
+    for call in mock_update.call_args_list:
+        _, updates = call[0]
+        for update in updates.values():
+            attributes.update(update["attributes"])
+    return attributes
+
+
 class MockReader(object):
     """A mock implementation of a GeoLite2 database reader"""
 
@@ -91,14 +105,15 @@ class TestMaxMindDbGeoIPAnalyzer(BaseTest):
             source_attrs={ip_field: "8.8.8.8" for ip_field in IP_FIELDS},
         )
 
-        message = analyzer.run()
-        event = analyzer.datastore.event_store["0"]
+        with mock.patch.object(analyzer, "update_by_terms") as mock_update:
+            message = analyzer.run()
+        attributes = _get_added_attributes(mock_update)
 
         for ip_field in IP_FIELDS:
-            self.assertTrue("{0}_latitude".format(ip_field) in event["_source"])
-            self.assertTrue("{0}_longitude".format(ip_field) in event["_source"])
-            self.assertTrue("{0}_iso_code".format(ip_field) in event["_source"])
-            self.assertTrue("{0}_city".format(ip_field) in event["_source"])
+            self.assertTrue("{0}_latitude".format(ip_field) in attributes)
+            self.assertTrue("{0}_longitude".format(ip_field) in attributes)
+            self.assertTrue("{0}_iso_code".format(ip_field) in attributes)
+            self.assertTrue("{0}_city".format(ip_field) in attributes)
         self.assertEqual(message, "Found 1 IP address(es).")
 
     @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
@@ -132,14 +147,15 @@ class TestMaxMindDbGeoIPAnalyzer(BaseTest):
             source_attrs={ip_field: "2001:4860:4860::8888" for ip_field in IP_FIELDS},
         )
 
-        message = analyzer.run()
-        event = analyzer.datastore.event_store["0"]
+        with mock.patch.object(analyzer, "update_by_terms") as mock_update:
+            message = analyzer.run()
+        attributes = _get_added_attributes(mock_update)
 
         for ip_field in IP_FIELDS:
-            self.assertTrue("{0}_latitude".format(ip_field) in event["_source"])
-            self.assertTrue("{0}_longitude".format(ip_field) in event["_source"])
-            self.assertTrue("{0}_iso_code".format(ip_field) in event["_source"])
-            self.assertTrue("{0}_city".format(ip_field) in event["_source"])
+            self.assertTrue("{0}_latitude".format(ip_field) in attributes)
+            self.assertTrue("{0}_longitude".format(ip_field) in attributes)
+            self.assertTrue("{0}_iso_code".format(ip_field) in attributes)
+            self.assertTrue("{0}_city".format(ip_field) in attributes)
         self.assertEqual(message, "Found 1 IP address(es).")
 
     @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
@@ -153,13 +169,14 @@ class TestMaxMindDbGeoIPAnalyzer(BaseTest):
             analyzer.datastore, 0, 1, source_attrs={"ip_address": "127.0.0.1"}
         )
 
-        message = analyzer.run()
-        event = analyzer.datastore.event_store["0"]
+        with mock.patch.object(analyzer, "update_by_terms") as mock_update:
+            message = analyzer.run()
+        attributes = _get_added_attributes(mock_update)
 
-        self.assertTrue("ip_address_latitude" not in event["_source"])
-        self.assertTrue("ip_address_longitude" not in event["_source"])
-        self.assertTrue("ip_address_iso_code" not in event["_source"])
-        self.assertTrue("ip_address_city" not in event["_source"])
+        self.assertTrue("ip_address_latitude" not in attributes)
+        self.assertTrue("ip_address_longitude" not in attributes)
+        self.assertTrue("ip_address_iso_code" not in attributes)
+        self.assertTrue("ip_address_city" not in attributes)
         self.assertEqual(message, "Found 0 IP address(es).")
 
     @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
@@ -171,13 +188,14 @@ class TestMaxMindDbGeoIPAnalyzer(BaseTest):
 
         _create_mock_event(analyzer.datastore, 0, 1, source_attrs={"ip_address": None})
 
-        message = analyzer.run()
-        event = analyzer.datastore.event_store["0"]
+        with mock.patch.object(analyzer, "update_by_terms") as mock_update:
+            message = analyzer.run()
+        attributes = _get_added_attributes(mock_update)
 
-        self.assertTrue("ip_address_latitude" not in event["_source"])
-        self.assertTrue("ip_address_longitude" not in event["_source"])
-        self.assertTrue("ip_address_iso_code" not in event["_source"])
-        self.assertTrue("ip_address_city" not in event["_source"])
+        self.assertTrue("ip_address_latitude" not in attributes)
+        self.assertTrue("ip_address_longitude" not in attributes)
+        self.assertTrue("ip_address_iso_code" not in attributes)
+        self.assertTrue("ip_address_city" not in attributes)
         self.assertEqual(message, "Found 0 IP address(es).")
 
     @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
@@ -187,9 +205,11 @@ class TestMaxMindDbGeoIPAnalyzer(BaseTest):
         analyzer.GEOIP_CLIENT = MockReader
         analyzer.datastore.client = mock.Mock()
 
-        message = analyzer.run()
+        with mock.patch.object(analyzer, "update_by_terms") as mock_update:
+            message = analyzer.run()
 
         self.assertEqual(message, "Found 0 IP address(es).")
+        mock_update.assert_not_called()
 
     @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
     @mock.patch("geoip2.database.Reader", MockReader)
@@ -206,13 +226,14 @@ class TestMaxMindDbGeoIPAnalyzer(BaseTest):
             source_attrs={"ip_address": ["8.8.8.8", "8.8.4.4"]},
         )
 
-        message = analyzer.run()
-        event = analyzer.datastore.event_store["0"]
+        with mock.patch.object(analyzer, "update_by_terms") as mock_update:
+            message = analyzer.run()
+        attributes = _get_added_attributes(mock_update)
 
-        self.assertTrue("ip_address_latitude" in event["_source"])
-        self.assertTrue("ip_address_longitude" in event["_source"])
-        self.assertTrue("ip_address_iso_code" in event["_source"])
-        self.assertTrue("ip_address_city" in event["_source"])
+        self.assertTrue("ip_address_latitude" in attributes)
+        self.assertTrue("ip_address_longitude" in attributes)
+        self.assertTrue("ip_address_iso_code" in attributes)
+        self.assertTrue("ip_address_city" in attributes)
         self.assertEqual(message, "Found 2 IP address(es).")
 
     @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
@@ -230,13 +251,14 @@ class TestMaxMindDbGeoIPAnalyzer(BaseTest):
             source_attrs={"ip_address": ["8.8.8.8", "2001:4860:4860::8844"]},
         )
 
-        message = analyzer.run()
-        event = analyzer.datastore.event_store["0"]
+        with mock.patch.object(analyzer, "update_by_terms") as mock_update:
+            message = analyzer.run()
+        attributes = _get_added_attributes(mock_update)
 
-        self.assertTrue("ip_address_latitude" in event["_source"])
-        self.assertTrue("ip_address_longitude" in event["_source"])
-        self.assertTrue("ip_address_iso_code" in event["_source"])
-        self.assertTrue("ip_address_city" in event["_source"])
+        self.assertTrue("ip_address_latitude" in attributes)
+        self.assertTrue("ip_address_longitude" in attributes)
+        self.assertTrue("ip_address_iso_code" in attributes)
+        self.assertTrue("ip_address_city" in attributes)
         self.assertEqual(message, "Found 2 IP address(es).")
 
 
@@ -283,14 +305,15 @@ class TestMaxMindDbWebIPAnalyzer(BaseTest):
             source_attrs={ip_field: "8.8.8.8" for ip_field in IP_FIELDS},
         )
 
-        message = analyzer.run()
-        event = analyzer.datastore.event_store["0"]
+        with mock.patch.object(analyzer, "update_by_terms") as mock_update:
+            message = analyzer.run()
+        attributes = _get_added_attributes(mock_update)
 
         for ip_field in IP_FIELDS:
-            self.assertTrue("{0}_latitude".format(ip_field) in event["_source"])
-            self.assertTrue("{0}_longitude".format(ip_field) in event["_source"])
-            self.assertTrue("{0}_iso_code".format(ip_field) in event["_source"])
-            self.assertTrue("{0}_city".format(ip_field) in event["_source"])
+            self.assertTrue("{0}_latitude".format(ip_field) in attributes)
+            self.assertTrue("{0}_longitude".format(ip_field) in attributes)
+            self.assertTrue("{0}_iso_code".format(ip_field) in attributes)
+            self.assertTrue("{0}_city".format(ip_field) in attributes)
         self.assertEqual(message, "Found 1 IP address(es).")
 
     @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
@@ -324,14 +347,15 @@ class TestMaxMindDbWebIPAnalyzer(BaseTest):
             source_attrs={ip_field: "2001:4860:4860::8888" for ip_field in IP_FIELDS},
         )
 
-        message = analyzer.run()
-        event = analyzer.datastore.event_store["0"]
+        with mock.patch.object(analyzer, "update_by_terms") as mock_update:
+            message = analyzer.run()
+        attributes = _get_added_attributes(mock_update)
 
         for ip_field in IP_FIELDS:
-            self.assertTrue("{0}_latitude".format(ip_field) in event["_source"])
-            self.assertTrue("{0}_longitude".format(ip_field) in event["_source"])
-            self.assertTrue("{0}_iso_code".format(ip_field) in event["_source"])
-            self.assertTrue("{0}_city".format(ip_field) in event["_source"])
+            self.assertTrue("{0}_latitude".format(ip_field) in attributes)
+            self.assertTrue("{0}_longitude".format(ip_field) in attributes)
+            self.assertTrue("{0}_iso_code".format(ip_field) in attributes)
+            self.assertTrue("{0}_city".format(ip_field) in attributes)
         self.assertEqual(message, "Found 1 IP address(es).")
 
     @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
@@ -345,13 +369,14 @@ class TestMaxMindDbWebIPAnalyzer(BaseTest):
             analyzer.datastore, 0, 1, source_attrs={"ip_address": "127.0.0.1"}
         )
 
-        message = analyzer.run()
-        event = analyzer.datastore.event_store["0"]
+        with mock.patch.object(analyzer, "update_by_terms") as mock_update:
+            message = analyzer.run()
+        attributes = _get_added_attributes(mock_update)
 
-        self.assertTrue("ip_address_latitude" not in event["_source"])
-        self.assertTrue("ip_address_longitude" not in event["_source"])
-        self.assertTrue("ip_address_iso_code" not in event["_source"])
-        self.assertTrue("ip_address_city" not in event["_source"])
+        self.assertTrue("ip_address_latitude" not in attributes)
+        self.assertTrue("ip_address_longitude" not in attributes)
+        self.assertTrue("ip_address_iso_code" not in attributes)
+        self.assertTrue("ip_address_city" not in attributes)
         self.assertEqual(message, "Found 0 IP address(es).")
 
     @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
@@ -363,13 +388,14 @@ class TestMaxMindDbWebIPAnalyzer(BaseTest):
 
         _create_mock_event(analyzer.datastore, 0, 1, source_attrs={"ip_address": None})
 
-        message = analyzer.run()
-        event = analyzer.datastore.event_store["0"]
+        with mock.patch.object(analyzer, "update_by_terms") as mock_update:
+            message = analyzer.run()
+        attributes = _get_added_attributes(mock_update)
 
-        self.assertTrue("ip_address_latitude" not in event["_source"])
-        self.assertTrue("ip_address_longitude" not in event["_source"])
-        self.assertTrue("ip_address_iso_code" not in event["_source"])
-        self.assertTrue("ip_address_city" not in event["_source"])
+        self.assertTrue("ip_address_latitude" not in attributes)
+        self.assertTrue("ip_address_longitude" not in attributes)
+        self.assertTrue("ip_address_iso_code" not in attributes)
+        self.assertTrue("ip_address_city" not in attributes)
         self.assertEqual(message, "Found 0 IP address(es).")
 
     @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
@@ -379,9 +405,11 @@ class TestMaxMindDbWebIPAnalyzer(BaseTest):
         analyzer.GEOIP_CLIENT = MockReader
         analyzer.datastore.client = mock.Mock()
 
-        message = analyzer.run()
+        with mock.patch.object(analyzer, "update_by_terms") as mock_update:
+            message = analyzer.run()
 
         self.assertEqual(message, "Found 0 IP address(es).")
+        mock_update.assert_not_called()
 
     @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
     @mock.patch("geoip2.database.Reader", MockReader)
@@ -398,13 +426,14 @@ class TestMaxMindDbWebIPAnalyzer(BaseTest):
             source_attrs={"ip_address": ["8.8.8.8", "8.8.4.4"]},
         )
 
-        message = analyzer.run()
-        event = analyzer.datastore.event_store["0"]
+        with mock.patch.object(analyzer, "update_by_terms") as mock_update:
+            message = analyzer.run()
+        attributes = _get_added_attributes(mock_update)
 
-        self.assertTrue("ip_address_latitude" in event["_source"])
-        self.assertTrue("ip_address_longitude" in event["_source"])
-        self.assertTrue("ip_address_iso_code" in event["_source"])
-        self.assertTrue("ip_address_city" in event["_source"])
+        self.assertTrue("ip_address_latitude" in attributes)
+        self.assertTrue("ip_address_longitude" in attributes)
+        self.assertTrue("ip_address_iso_code" in attributes)
+        self.assertTrue("ip_address_city" in attributes)
         self.assertEqual(message, "Found 2 IP address(es).")
 
     @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
@@ -422,11 +451,80 @@ class TestMaxMindDbWebIPAnalyzer(BaseTest):
             source_attrs={"ip_address": ["8.8.8.8", "2001:4860:4860::8844"]},
         )
 
-        message = analyzer.run()
-        event = analyzer.datastore.event_store["0"]
+        with mock.patch.object(analyzer, "update_by_terms") as mock_update:
+            message = analyzer.run()
+        attributes = _get_added_attributes(mock_update)
 
-        self.assertTrue("ip_address_latitude" in event["_source"])
-        self.assertTrue("ip_address_longitude" in event["_source"])
-        self.assertTrue("ip_address_iso_code" in event["_source"])
-        self.assertTrue("ip_address_city" in event["_source"])
+        self.assertTrue("ip_address_latitude" in attributes)
+        self.assertTrue("ip_address_longitude" in attributes)
+        self.assertTrue("ip_address_iso_code" in attributes)
+        self.assertTrue("ip_address_city" in attributes)
         self.assertEqual(message, "Found 2 IP address(es).")
+
+
+class TestGeoIpCache(BaseTest):
+    """Tests for the on-disk cache of geolocations."""
+
+    def test_cache(self):
+        """Test caching geolocations per version and LRU eviction."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache_path = os.path.join(temp_dir, "geoip.db")
+            with GeoIpCache(cache_path, max_entries=2) as cache:
+                cache.set_many({"8.8.8.8": ("US", 1, 2, "USA", None)}, "db:1")
+                cache.set_many({"1.1.1.1": None}, "db:1")
+                self.assertEqual(
+                    cache.get_many(["8.8.8.8", "1.1.1.1", "8.8.4.4"], "db:1"),
+                    {"8.8.8.8": ("US", 1, 2, "USA", None), "1.1.1.1": None},
+                )
+                self.assertEqual(cache.get_many(["8.8.8.8"], "db:2"), {})
+
+                # The least recently used entry is evicted.
+                cache.get_many(["1.1.1.1"], "db:1")
+                cache.set_many({"8.8.4.4": None}, "db:1")
+                self.assertEqual(
+                    cache.get_many(["8.8.8.8", "1.1.1.1", "8.8.4.4"], "db:1"),
+                    {"1.1.1.1": None, "8.8.4.4": None},
+                )
+
+            # The cache is shared between runs.
+            with GeoIpCache(cache_path) as cache:
+                self.assertEqual(cache.get_many(["8.8.4.4"], "db:1"), {"8.8.4.4": None})
+
+    def test_cache_permissions(self):
+        """Test that the cache is private and not shared with other users."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache_path = os.path.join(temp_dir, "geoip.db")
+            with GeoIpCache(cache_path):
+                pass
+            self.assertEqual(os.stat(cache_path).st_mode & 0o777, 0o600)
+
+            os.chmod(cache_path, 0o666)
+            with self.assertRaises(OSError):
+                with GeoIpCache(cache_path):
+                    pass
+
+            link_path = os.path.join(temp_dir, "link.db")
+            os.symlink(cache_path, link_path)
+            with self.assertRaises(OSError):
+                with GeoIpCache(link_path):
+                    pass
+
+    @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
+    def test_cached_lookups(self):
+        """Test that cached IP addresses are not looked up again."""
+        analyzer = MaxMindDbGeoIPAnalyzer("test", 1)
+        client = mock.Mock()
+        client.MAX_CONCURRENT_LOOKUPS = 4
+        client.cache_version.return_value = "db:1"
+        client.ip2geo.side_effect = lambda ip: (ip, 1, 2, "d", "e")
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.app.config["GEOIP_CACHE_PATH"] = os.path.join(temp_dir, "geoip.db")
+            responses = analyzer._get_geolocations(client, ["8.8.8.8", "8.8.4.4"])
+            self.assertEqual(responses["8.8.4.4"], ("8.8.4.4", 1, 2, "d", "e"))
+            self.assertEqual(client.ip2geo.call_count, 2)
+
+            responses = analyzer._get_geolocations(client, ["8.8.8.8", "1.1.1.1"])
+            self.assertEqual(responses["8.8.8.8"], ("8.8.8.8", 1, 2, "d", "e"))
+            self.assertEqual(client.ip2geo.call_count, 3)
+            self.app.config["GEOIP_CACHE_PATH"] = ""
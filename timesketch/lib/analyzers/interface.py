@@ -15,6 +15,8 @@
 
 from __future__ import unicode_literals
 
+import collections
+import copy
 import datetime
 import json
 import logging
@@ -24,12 +26,24 @@ import time
 import traceback
 import yaml
 
+import numpy
 import opensearchpy
 from flask import current_app
+import prometheus_client
 
 import pandas
+from pandas.api.types import union_categoricals
+
+# Arrow backed string columns are optional in event_pandas.
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 
 from timesketch.lib import definitions
+from timesketch.lib import errors
+from timesketch.lib.analyzers import update_buffer
+from timesketch.lib.definitions import METRICS_NAMESPACE
 from timesketch.lib.datastores.opensearch import OpenSearchDataStore
 from timesketch.models import db_session
 from timesketch.models.sketch import Aggregation
@@ -46,25 +60,97 @@ from timesketch.models.sketch import Analysis
 
 logger = logging.getLogger("timesketch.analyzers")
 
+# Metrics definitions
+METRICS = {
+    "analyzer_run_duration": prometheus_client.Histogram(
+        "analyzer_run_duration_seconds",
+        "Duration of analyzer runs per analyzer and result status",
+        ["name", "status"],
+        buckets=[1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200, 14400],
+        namespace=METRICS_NAMESPACE,
+    ),
+    "analyzer_events_scanned": prometheus_client.Counter(
+        "analyzer_events_scanned",
+        "Number of events read by analyzers",
+        ["name"],
+        namespace=METRICS_NAMESPACE,
+    ),
+    "analyzer_events_updated": prometheus_client.Counter(
+        "analyzer_events_updated",
+        "Number of event updates made by analyzers",
+        ["name"],
+        namespace=METRICS_NAMESPACE,
+    ),
+    "analyzer_events_not_updated": prometheus_client.Counter(
+        "analyzer_events_not_updated",
+        "Number of events analyzers failed to update by query",
+        ["name"],
+        namespace=METRICS_NAMESPACE,
+    ),
+}
+
+# Painless script used by BaseAnalyzer.update_by_terms to add tags, emojis
+# and attributes to events, looked up by the value of a field in the event.
+UPDATE_BY_TERMS_SCRIPT = """
+def addToList(def source, String key, def items) {
+  def values = source[key];
+  if (values == null) {
+    values = [];
+  } else if (!(values instanceof List)) {
+    values = [values];
+  }
+  for (item in items) {
+    if (!values.contains(item)) {
+      values.add(item);
+    }
+  }
+  source[key] = values;
+}
+
+def fieldValues = ctx._source[params.field];
+if (!(fieldValues instanceof List)) {
+  fieldValues = [fieldValues];
+}
+boolean updated = false;
+for (fieldValue in fieldValues) {
+  def update = params.updates.get(fieldValue);
+  if (update == null) {
+    continue;
+  }
+  updated = true;
+  if (update.containsKey('tags')) {
+    addToList(ctx._source, 'tag', update.tags);
+  }
+  if (update.containsKey('emojis')) {
+    addToList(ctx._source, '__ts_emojis', update.emojis);
+  }
+  if (update.containsKey('attributes')) {
+    for (entry in update.attributes.entrySet()) {
+      ctx._source[entry.getKey()] = entry.getValue();
+    }
+  }
+}
+if (!updated) {
+  ctx.op = 'noop';
+}
+"""
+
 
 def _flush_datastore_decorator(func):
     """Decorator that flushes the bulk insert queue in the datastore."""
 
     def wrapper(self, *args, **kwargs):
-        func_return = func(self, *args, **kwargs)
-
-        # Add in tagged events and emojis.
-        for event_dict in self.tagged_events.values():
-            event = event_dict.get("event")
-            tags = event_dict.get("tags")
-
-            event.commit({"tag": tags})
-
-        for event_dict in self.emoji_events.values():
-            event = event_dict.get("event")
-            emojis = event_dict.get("emojis")
-
-            event.commit({"__ts_emojis": emojis})
+        try:
+            func_return = func(self, *args, **kwargs)
+        finally:
+            # Add in buffered tags, emojis, attributes and labels.
+            self.update_buffer.close()
+            METRICS["analyzer_events_updated"].labels(name=self.NAME).inc(
+                self.update_buffer.flushed
+            )
+            # Add in queued saved views.
+            if self.sketch:
+                self.sketch.commit_views()
 
         self.datastore.flush_queued_events()
         return func_return
@@ -131,6 +217,8 @@ class Event(object):
         event_type: Document type in OpenSearch.
         index_name: The name of the OpenSearch index.
         source: Source document from OpenSearch.
+        matched_queries: List of names of the named queries the event
+            matched, see BaseAnalyzer.multi_query_stream.
     """
 
     def __init__(self, event, datastore, sketch=None, analyzer=None):
@@ -157,6 +245,7 @@ class Event(object):
             self.index_name = event["_index"]
             self.timeline_id = event.get("_source", {}).get("__ts_timeline_id")
             self.source = event.get("_source", None)
+            self.matched_queries = event.get("matched_queries", [])
         except KeyError as e:
             raise KeyError("Malformed event: {0!s}".format(e)) from e
 
@@ -183,6 +272,9 @@ class Event(object):
         if not event_to_commit:
             return
 
+        if self._analyzer:
+            METRICS["analyzer_events_updated"].labels(name=self._analyzer.NAME).inc()
+
         self.datastore.import_event(
             self.index_name,
             self.event_type,
@@ -212,6 +304,16 @@ class Event(object):
             raise RuntimeError("No sketch provided.")
 
         user_id = 0
+        if self._analyzer:
+            self._analyzer.update_buffer.add_label(
+                self.index_name,
+                self.event_id,
+                self.event_type,
+                {"name": str(label), "user_id": user_id, "sketch_id": self.sketch.id},
+                toggle=toggle,
+            )
+            return
+
         updated_event = self.datastore.set_label(
             self.index_name,
             self.event_id,
@@ -233,22 +335,16 @@ class Event(object):
         if not tags:
             return
 
-        existing_tags = self.source.get("tag", [])
         if self._analyzer:
-            if self.event_id in self._analyzer.tagged_events:
-                existing_tags = self._analyzer.tagged_events[self.event_id].get("tags")
-            else:
-                self._analyzer.tagged_events[self.event_id] = {
-                    "event": self,
-                    "tags": existing_tags,
-                }
+            self._analyzer.update_buffer.add_tags(
+                self.index_name, self.event_id, self.event_type, tags
+            )
+            return
 
+        existing_tags = self.source.get("tag", [])
         new_tags = list(set().union(existing_tags, tags))
-        if self._analyzer:
-            self._analyzer.tagged_events[self.event_id]["tags"] = new_tags
-        else:
-            updated_event_attribute = {"tag": new_tags}
-            self._update(updated_event_attribute)
+        updated_event_attribute = {"tag": new_tags}
+        self._update(updated_event_attribute)
 
     def add_emojis(self, emojis):
         """Add emojis to the Event.
@@ -259,28 +355,19 @@ class Event(object):
         if not emojis:
             return
 
+        if self._analyzer:
+            self._analyzer.update_buffer.add_emojis(
+                self.index_name, self.event_id, self.event_type, emojis
+            )
+            return
+
         existing_emoji_list = self.source.get("__ts_emojis", [])
         if not isinstance(existing_emoji_list, (list, tuple)):
             existing_emoji_list = []
 
-        if self._analyzer:
-            if self.event_id in self._analyzer.emoji_events:
-                existing_emoji_list = self._analyzer.emoji_events[self.event_id].get(
-                    "emojis"
-                )
-            else:
-                self._analyzer.emoji_events[self.event_id] = {
-                    "event": self,
-                    "emojis": existing_emoji_list,
-                }
-
         new_emoji_list = list(set().union(existing_emoji_list, emojis))
-
-        if self._analyzer:
-            self._analyzer.emoji_events[self.event_id]["emojis"] = new_emoji_list
-        else:
-            updated_event_attribute = {"__ts_emojis": new_emoji_list}
-            self._update(updated_event_attribute)
+        updated_event_attribute = {"__ts_emojis": new_emoji_list}
+        self._update(updated_event_attribute)
 
     def add_star(self):
         """Star event."""
@@ -346,6 +433,9 @@ class Sketch(object):
         sql_sketch: Instance of a SQLAlchemy Sketch object.
     """
 
+    # Number of view names per database query in commit_views.
+    VIEW_QUERY_BATCH_SIZE = 500
+
     def __init__(self, sketch_id):
         """Initializes a Sketch object.
 
@@ -358,6 +448,8 @@ class Sketch(object):
         if not self.sql_sketch:
             raise RuntimeError("No such sketch")
 
+        self._queued_views = collections.OrderedDict()
+
     def add_aggregation(
         self,
         name,
@@ -471,25 +563,158 @@ class Sketch(object):
         if not (query_string or query_dsl):
             raise ValueError("Both query_string and query_dsl are missing.")
 
+        description = "analyzer: {0:s}".format(analyzer_name)
+        view = View.get_or_create(
+            name=view_name, description=description, sketch=self.sql_sketch, user=None
+        )
+        self._set_view_query(
+            view, description, query_string, query_dsl, query_filter, additional_fields
+        )
+        view.set_status(status="new")
+
+        db_session.add(view)
+        db_session.commit()
+        return view
+
+    @staticmethod
+    def _set_view_query(
+        view, description, query_string, query_dsl, query_filter, additional_fields
+    ):
+        """Sets the query of a saved view, see add_view for the arguments."""
         if not query_filter:
             query_filter = {"indices": "_all"}
 
         if additional_fields:
             query_filter["fields"] = [{"field": x.strip()} for x in additional_fields]
 
-        description = "analyzer: {0:s}".format(analyzer_name)
-        view = View.get_or_create(
-            name=view_name, description=description, sketch=self.sql_sketch, user=None
-        )
         view.description = description
         view.query_string = query_string
         view.query_filter = view.validate_filter(query_filter)
         view.query_dsl = query_dsl
         view.searchtemplate = None
-        view.set_status(status="new")
 
-        db_session.add(view)
+    def queue_view(
+        self,
+        view_name,
+        analyzer_name,
+        query_string=None,
+        query_dsl=None,
+        query_filter=None,
+        additional_fields=None,
+    ):
+        """Queue a saved view to be added to the Sketch by commit_views.
+
+        Analyzers that add many views should queue them, so that they are
+        added in a single transaction instead of one transaction per view.
+        Queued views are committed when the analyzer is done.
+
+        Args:
+            view_name: The name of the view.
+            analyzer_name: The name of the analyzer.
+            query_string: OpenSearch query string.
+            query_dsl: Dictionary with OpenSearch DSL query.
+            query_filter: Dictionary with OpenSearch filters.
+            additional_fields: A list with field names to include in the
+                view output.
+
+        Raises:
+            ValueError: If both query_string an query_dsl are missing.
+        """
+        if not (query_string or query_dsl):
+            raise ValueError("Both query_string and query_dsl are missing.")
+
+        self._queued_views[view_name] = (
+            "analyzer: {0:s}".format(analyzer_name),
+            query_string,
+            query_dsl,
+            query_filter,
+            additional_fields,
+        )
+
+    def commit_views(self):
+        """Add all queued views to the Sketch in a single transaction.
+
+        Returns:
+            List of SQLAlchemy View objects that were added or updated.
+        """
+        if not self._queued_views:
+            return []
+
+        names = list(self._queued_views.keys())
+        existing_views = {}
+        for offset in range(0, len(names), self.VIEW_QUERY_BATCH_SIZE):
+            batch = names[offset : offset + self.VIEW_QUERY_BATCH_SIZE]
+            query = View.query.filter(
+                View.sketch == self.sql_sketch,
+                View.user == None,  # pylint: disable=singleton-comparison
+                View.name.in_(batch),
+            )
+            for view in query:
+                existing_views.setdefault((view.name, view.description), view)
+
+        views = []
+        for view_name, queued_view in self._queued_views.items():
+            description = queued_view[0]
+            view = existing_views.get((view_name, description))
+            if not view:
+                view = View(
+                    name=view_name,
+                    description=description,
+                    sketch=self.sql_sketch,
+                    user=None,
+                )
+            self._set_view_query(view, *queued_view)
+            # Set the status without the commit of View.set_status.
+            for status in list(view.status):
+                view.status.remove(status)
+            view.status.append(View.Status(user=None, status="new"))
+            views.append(view)
+
+        db_session.add_all(views)
         db_session.commit()
+        self._queued_views.clear()
+        return views
+
+    def add_faceted_view(
+        self,
+        view_name,
+        analyzer_name,
+        field,
+        query_string=None,
+        query_dsl=None,
+        limit=1000,
+    ):
+        """Add a saved view with a facet on a field to the Sketch.
+
+        This replaces adding a view per value of a field, eg. one view per
+        session, with a single view of all events that have the field and
+        an aggregation of the values of the field attached to it.
+
+        Args:
+            view_name: The name of the view.
+            analyzer_name: The name of the analyzer.
+            field: Name of the field to aggregate values of.
+            query_string: OpenSearch query string, defaults to all events
+                that have the field.
+            query_dsl: Dictionary with OpenSearch DSL query.
+            limit: Maximum number of values in the aggregation.
+
+        Returns: An instance of a SQLAlchemy View object.
+        """
+        if not (query_string or query_dsl):
+            query_string = "_exists_:{0:s}".format(field)
+
+        view = self.add_view(
+            view_name, analyzer_name, query_string=query_string, query_dsl=query_dsl
+        )
+        self.add_aggregation(
+            name="{0:s} by {1:s}".format(view_name, field),
+            agg_name="field_bucket",
+            agg_params={"field": field, "limit": limit},
+            description="Created by the {0:s} analyzer".format(analyzer_name),
+            view_id=view.id,
+            chart_type="table",
+        )
         return view
 
     def add_sketch_attribute(self, name, values, ontology="text"):
@@ -796,6 +1021,211 @@ class Story(object):
         self._commit(block)
 
 
+class EventFrameBuilder(object):
+    """Builds a pandas DataFrame from search results, one page at a time.
+
+    Field values are collected into column lists for a page of events and
+    converted into pandas columns once the page is full, so that only a
+    single page of events is held as Python objects at any time.
+
+    Attributes:
+        num_rows: Number of events added to the builder.
+        num_bytes: Memory used by the pandas columns of the flushed pages.
+    """
+
+    # Number of events that are converted into pandas columns at a time.
+    PAGE_SIZE = 10000
+
+    # Hit metadata that is added as columns to the data frame.
+    METADATA_FIELDS = ("_id", "_type", "_index")
+
+    # Fields that always have very few distinct values.
+    DEFAULT_CATEGORICAL_FIELDS = frozenset(["_type", "_index"])
+
+    def __init__(
+        self,
+        categorical_fields=None,
+        datetime_fields=None,
+        use_arrow=False,
+        max_rows=None,
+        max_bytes=None,
+    ):
+        """Initialize the builder.
+
+        Args:
+            categorical_fields: List of fields with few distinct values,
+                stored as pandas categoricals.
+            datetime_fields: List of fields that are parsed into UTC
+                datetime columns.
+            use_arrow: If True string columns are backed by Arrow arrays,
+                if pyarrow is available.
+            max_rows: Maximum number of events, None or 0 for no limit.
+            max_bytes: Maximum memory used by the columns, None or 0 for
+                no limit.
+        """
+        self._categorical_fields = self.DEFAULT_CATEGORICAL_FIELDS.union(
+            categorical_fields or []
+        )
+        self._datetime_fields = frozenset(datetime_fields or [])
+        self._string_dtype = self._get_string_dtype() if use_arrow else None
+        self._max_rows = max_rows
+        self._max_bytes = max_bytes
+        self._columns = collections.OrderedDict()
+        self._page = collections.OrderedDict()
+        self._page_rows = 0
+        self._page_lengths = []
+        self.num_rows = 0
+        self.num_bytes = 0
+
+    @staticmethod
+    def _get_string_dtype():
+        """Returns the Arrow backed pandas string dtype or None."""
+        if pyarrow is None:
+            logger.warning("pyarrow is not installed, not using Arrow columns.")
+            return None
+        try:
+            return pandas.StringDtype("pyarrow")
+        except TypeError:
+            logger.warning(
+                "pandas {0:s} has no Arrow backed strings, not using Arrow "
+                "columns.".format(pandas.__version__)
+            )
+            return None
+
+    def _to_series(self, field, values):
+        """Converts the values of a column into a pandas series.
+
+        Args:
+            field: Name of the field.
+            values: List of values, numpy.nan for missing values.
+
+        Returns:
+            A pandas Series.
+        """
+        if field in self._datetime_fields:
+            return pandas.to_datetime(
+                pandas.Series(values, dtype=object), utc=True, errors="coerce"
+            )
+
+        if field in self._categorical_fields:
+            try:
+                return pandas.Series(pandas.Categorical(values))
+            except TypeError:
+                # Unhashable values, such as lists of tags.
+                return pandas.Series(values, dtype=object)
+
+        series = pandas.Series(values)
+        if self._string_dtype is not None and series.dtype == object:
+            try:
+                return series.astype(self._string_dtype)
+            except (TypeError, ValueError):
+                # Not all values are strings.
+                return series
+        return series
+
+    def _flush_page(self):
+        """Converts the current page into pandas columns.
+
+        Raises:
+            DataTooLargeError: if the columns use more than max_bytes.
+        """
+        page_number = len(self._page_lengths)
+        for field, values in self._page.items():
+            values.extend([numpy.nan] * (self._page_rows - len(values)))
+            series = self._to_series(field, values)
+            self.num_bytes += series.memory_usage(index=False, deep=True)
+            self._columns.setdefault(field, {})[page_number] = series
+
+        self._page_lengths.append(self._page_rows)
+        self._page = collections.OrderedDict()
+        self._page_rows = 0
+
+        if self._max_bytes and self.num_bytes > self._max_bytes:
+            raise errors.DataTooLargeError(
+                "Events use more than {0:d} bytes of memory, the maximum that "
+                "can be loaded into a data frame. Narrow down the query or "
+                "the fields that are returned.".format(self._max_bytes)
+            )
+
+    def add_event(self, event):
+        """Adds a search result to the builder.
+
+        Args:
+            event: Dictionary with an OpenSearch hit.
+
+        Raises:
+            DataTooLargeError: if more than max_rows events are added or the
+                columns use more than max_bytes.
+        """
+        if self._max_rows and self.num_rows >= self._max_rows:
+            raise errors.DataTooLargeError(
+                "Query returned more than {0:d} events, the maximum that can "
+                "be loaded into a data frame. Narrow down the query.".format(
+                    self._max_rows
+                )
+            )
+
+        row = self._page_rows
+        items = [(field, event.get(field)) for field in self.METADATA_FIELDS]
+        items.extend(
+            (field, value)
+            for field, value in event.get("_source", {}).items()
+            if field not in self.METADATA_FIELDS
+        )
+        for field, value in items:
+            column = self._page.get(field)
+            if column is None:
+                column = []
+                self._page[field] = column
+            if len(column) < row:
+                column.extend([numpy.nan] * (row - len(column)))
+            column.append(value)
+
+        self._page_rows += 1
+        self.num_rows += 1
+        if self._page_rows >= self.PAGE_SIZE:
+            self._flush_page()
+
+    def _build_column(self, field, pages):
+        """Concatenates the pages of a column.
+
+        Args:
+            field: Name of the field.
+            pages: Dict with page numbers and pandas series of the column.
+
+        Returns:
+            A pandas Series with a value for every event.
+        """
+        chunks = []
+        for page_number, length in enumerate(self._page_lengths):
+            series = pages.pop(page_number, None)
+            if series is None:
+                series = self._to_series(field, [numpy.nan] * length)
+            chunks.append(series)
+
+        if len(chunks) == 1:
+            return chunks[0]
+
+        if all(isinstance(chunk.dtype, pandas.CategoricalDtype) for chunk in chunks):
+            try:
+                return pandas.Series(union_categoricals(chunks))
+            except TypeError:
+                # Categories of different types in different pages.
+                pass
+        return pandas.concat(chunks, ignore_index=True)
+
+    def build(self):
+        """Returns a pandas DataFrame with all the added events."""
+        if self._page_rows:
+            self._flush_page()
+
+        columns = collections.OrderedDict()
+        while self._columns:
+            field = next(iter(self._columns))
+            columns[field] = self._build_column(field, self._columns.pop(field))
+        return pandas.DataFrame(columns)
+
+
 class BaseAnalyzer:
     """Base class for analyzers.
 
@@ -805,8 +1235,8 @@ class BaseAnalyzer:
         datastore: OpenSearch datastore client.
         sketch: Instance of Sketch object.
         timeline_id: The ID of the timeline the analyzer runs on.
-        tagged_events: Dict with all events to add tags and those tags.
-        emoji_events: Dict with all events to add emojis and those emojis.
+        update_buffer: Buffer of the tags, emojis, attributes and labels
+            to add to events (instance of EventUpdateBuffer).
     """
 
     NAME = "name"
@@ -821,10 +1251,31 @@ class BaseAnalyzer:
     # Used as hints to the frontend UI in order to render input forms.
     FORM_FIELDS = []
 
-    # Configure how long an analyzer should run before the timeline
-    # gets fully indexed.
-    SECONDS_PER_WAIT = 10
-    MAXIMUM_WAITS = 360
+    # Number of buckets fetched per request in get_term_counts.
+    AGGREGATION_PAGE_SIZE = 1000
+
+    # Number of field values per update by query request in update_by_terms.
+    UPDATE_BY_TERMS_BATCH_SIZE = 500
+
+    # Seconds between checks whether an update by query task has completed.
+    UPDATE_BY_QUERY_POLL_INTERVAL = 5
+
+    # Seconds to wait for an update by query task before it is cancelled.
+    UPDATE_BY_QUERY_TIMEOUT = 3600
+
+    # Number of times an update by query request is repeated when events
+    # changed while they were being updated.
+    UPDATE_BY_QUERY_MAX_RETRIES = 3
+
+    # Number of events per scroll page in multi_query_stream.
+    MULTI_QUERY_PAGE_SIZE = 10000
+
+    # Number of events per scroll page of event streams sorted by fields.
+    SORTED_STREAM_PAGE_SIZE = 10000
+
+    # Default limits of the data frames returned by event_pandas.
+    EVENT_PANDAS_MAX_ROWS = 10000000
+    EVENT_PANDAS_MAX_BYTES = 4 * 1024**3
 
     def __init__(self, index_name, sketch_id, timeline_id=None):
         """Initialize the analyzer object.
@@ -840,17 +1291,78 @@ class BaseAnalyzer:
         self.timeline_id = timeline_id
         self.timeline_name = ""
 
-        self.tagged_events = {}
-        self.emoji_events = {}
+        # Refresh points (epoch seconds) of the indices that have been
+        # prepared for searching, and indices that could not be found.
+        self._refreshed_indices = {}
+        self._missing_indices = set()
+
+        # Number of events that update by query requests failed to update.
+        self.events_not_updated = 0
 
         self.datastore = OpenSearchDataStore(
             host=current_app.config["OPENSEARCH_HOST"],
             port=current_app.config["OPENSEARCH_PORT"],
         )
+        self.datastore.task_type = "analyzer"
+
+        self.update_buffer = update_buffer.EventUpdateBuffer(
+            self.datastore,
+            max_bytes=current_app.config.get(
+                "ANALYZERS_UPDATE_BUFFER_MAX_BYTES",
+                update_buffer.EventUpdateBuffer.DEFAULT_MAX_BYTES,
+            ),
+            spill_directory=current_app.config.get("ANALYZERS_UPDATE_BUFFER_SPILL_DIR")
+            or None,
+        )
 
         if not hasattr(self, "sketch"):
             self.sketch = None
 
+    def prepare_indices(self, indices, force_refresh=False):
+        """Make sure indices are searchable before they are queried.
+
+        Each index is refreshed once per analyzer run. Later calls skip the
+        refresh, since forcing refreshes on an index that is still being
+        loaded creates many small segments and slows down indexing and
+        searching alike.
+
+        Args:
+            indices: List of index names.
+            force_refresh: If True any queued events are flushed and the
+                indices are refreshed again, so that changes made by the
+                analyzer are visible to the following searches.
+
+        Returns:
+            List of index names that exist and can be searched.
+        """
+        if force_refresh:
+            self.update_buffer.flush()
+            self.datastore.flush_queued_events()
+
+        prepared_indices = []
+        for index in indices:
+            if index in self._missing_indices:
+                continue
+
+            if index in self._refreshed_indices and not force_refresh:
+                prepared_indices.append(index)
+                continue
+
+            try:
+                self.datastore.client.indices.refresh(index=index)
+            except opensearchpy.NotFoundError:
+                logger.error(
+                    "Unable to find index: {0:s}, removing from "
+                    "result set.".format(index)
+                )
+                self._missing_indices.add(index)
+                continue
+
+            self._refreshed_indices[index] = time.time()
+            prepared_indices.append(index)
+
+        return prepared_indices
+
     def event_pandas(
         self,
         query_string=None,
@@ -858,6 +1370,8 @@ class BaseAnalyzer:
         query_dsl=None,
         indices=None,
         return_fields=None,
+        force_refresh=False,
+        frame_options=None,
     ):
         """Search OpenSearch.
 
@@ -868,12 +1382,21 @@ class BaseAnalyzer:
             indices: List of indices to query.
             return_fields: List of fields to be included in the search results,
                 if not included all fields will be included in the results.
+            force_refresh: If True the indices are refreshed before the
+                search, so that changes made by the analyzer are visible.
+            frame_options: Optional dict with keyword arguments of the
+                EventFrameBuilder that builds the data frame, eg.
+                categorical_fields, datetime_fields or use_arrow. The
+                max_rows and max_bytes limits default to
+                ANALYZERS_EVENT_PANDAS_MAX_ROWS and
+                ANALYZERS_EVENT_PANDAS_MAX_BYTES, set them to 0 for no limit.
 
         Returns:
             A python pandas object with all the events.
 
         Raises:
             ValueError: if neither query_string or query_dsl is provided.
+            DataTooLargeError: if the events exceed max_rows or max_bytes.
         """
         if not (query_string or query_dsl):
             raise ValueError("Both query_string and query_dsl are missing")
@@ -889,18 +1412,7 @@ class BaseAnalyzer:
         else:
             timeline_ids = None
 
-        # Refresh the index to make sure it is searchable.
-        for index in indices:
-            try:
-                self.datastore.client.indices.refresh(index=index)
-            except opensearchpy.NotFoundError:
-                logger.error(
-                    "Unable to refresh index: {0:s}, not found, "
-                    "removing from list.".format(index)
-                )
-                broken_index = indices.index(index)
-                _ = indices.pop(broken_index)
-
+        indices = self.prepare_indices(indices, force_refresh=force_refresh)
         if not indices:
             raise ValueError("Unable to get events, no indices to query.")
 
@@ -920,15 +1432,22 @@ class BaseAnalyzer:
             return_fields=return_fields,
         )
 
-        events = []
+        frame_options = dict(frame_options or {})
+        if frame_options.get("max_rows") is None:
+            frame_options["max_rows"] = current_app.config.get(
+                "ANALYZERS_EVENT_PANDAS_MAX_ROWS", self.EVENT_PANDAS_MAX_ROWS
+            )
+        if frame_options.get("max_bytes") is None:
+            frame_options["max_bytes"] = current_app.config.get(
+                "ANALYZERS_EVENT_PANDAS_MAX_BYTES", self.EVENT_PANDAS_MAX_BYTES
+            )
+
+        builder = EventFrameBuilder(**frame_options)
         for event in results:
-            source = event.get("_source")
-            source["_id"] = event.get("_id")
-            source["_type"] = event.get("_type")
-            source["_index"] = event.get("_index")
-            events.append(source)
+            builder.add_event(event)
+        METRICS["analyzer_events_scanned"].labels(name=self.NAME).inc(builder.num_rows)
 
-        return pandas.DataFrame(events)
+        return builder.build()
 
     def event_stream(
         self,
@@ -938,6 +1457,8 @@ class BaseAnalyzer:
         indices=None,
         return_fields=None,
         scroll=True,
+        force_refresh=False,
+        sort_fields=None,
     ):
         """Search OpenSearch.
 
@@ -949,6 +1470,11 @@ class BaseAnalyzer:
             return_fields: List of fields to return.
             scroll: Boolean determining whether we support scrolling searches
                 or not. Defaults to True.
+            force_refresh: If True the indices are refreshed before the
+                search, so that changes made by the analyzer are visible.
+            sort_fields: Optional list of sortable fields, eg. keyword fields
+                like "file_reference.keyword", to sort the events by in
+                ascending order. Events are sorted by datetime by default.
 
         Returns:
             Generator of Event objects.
@@ -959,6 +1485,17 @@ class BaseAnalyzer:
         if not (query_string or query_dsl):
             raise ValueError("Both query_string and query_dsl are missing")
 
+        if sort_fields:
+            query_dsl = {
+                "query": self._build_analyzer_query(query_string, query_dsl),
+                "sort": [
+                    {field: {"order": "asc", "unmapped_type": "keyword"}}
+                    for field in sort_fields
+                ],
+                "size": self.SORTED_STREAM_PAGE_SIZE,
+            }
+            query_string = None
+
         if not query_filter:
             query_filter = {"indices": self.index_name}
 
@@ -974,17 +1511,7 @@ class BaseAnalyzer:
         if not indices:
             indices = [self.index_name]
 
-        # Refresh the index to make sure it is searchable.
-        for index in indices:
-            try:
-                self.datastore.client.indices.refresh(index=index)
-            except opensearchpy.NotFoundError:
-                logger.error(
-                    "Unable to find index: {0:s}, removing from "
-                    "result set.".format(index)
-                )
-                broken_index = indices.index(index)
-                _ = indices.pop(broken_index)
+        indices = self.prepare_indices(indices, force_refresh=force_refresh)
         if not indices:
             raise ValueError(
                 "Unable to query for analyzers, discovered no index to query."
@@ -1012,7 +1539,11 @@ class BaseAnalyzer:
                     enable_scroll=scroll,
                     timeline_ids=timeline_ids,
                 )
+                events_scanned = METRICS["analyzer_events_scanned"].labels(
+                    name=self.NAME
+                )
                 for event in event_generator:
+                    events_scanned.inc()
                     yield Event(
                         event, self.datastore, sketch=self.sketch, analyzer=self
                     )
@@ -1020,7 +1551,7 @@ class BaseAnalyzer:
             except opensearchpy.TransportError as e:
                 sleep_seconds = backoff_in_seconds * 2**x + random.uniform(3, 7)
                 logger.info(
-                    "Attempt: {0:d}/{1:d} sleeping {2:f} for query {3:s}".format(
+                    "Attempt: {0:d}/{1:d} sleeping {2:f} for query {3!s}".format(
                         x + 1, retries, sleep_seconds, query_string
                     )
                 )
@@ -1028,13 +1559,405 @@ class BaseAnalyzer:
 
                 if x == retries - 1:
                     logger.error(
-                        "Timeout executing search for {0:s}: {1!s}".format(
+                        "Timeout executing search for {0!s}: {1!s}".format(
                             query_string, e
                         ),
                         exc_info=True,
                     )
                     raise
 
+    def grouped_stream(
+        self, key_fields, query_string=None, query_dsl=None, return_fields=None
+    ):
+        """Search OpenSearch for groups of events with the same key.
+
+        The events are sorted by the key fields in OpenSearch, so events with
+        the same values of the key fields follow each other and only the
+        events of a single group are held in memory at any time.
+
+        Args:
+            key_fields: List of sortable fields to group events by, eg.
+                "file_reference.keyword". The value is looked up in the source
+                of the event by the name of the field without a ".keyword"
+                suffix.
+            query_string: Query string.
+            query_dsl: Dictionary containing OpenSearch DSL query.
+            return_fields: List of fields to return.
+
+        Yields:
+            Tuples with the key, a tuple with the string values of the key
+            fields (None for missing values), and a list of Event objects.
+        """
+        source_fields = []
+        for field in key_fields:
+            if field.endswith(".keyword"):
+                field = field[: -len(".keyword")]
+            source_fields.append(field)
+
+        return_fields = list(return_fields or [])
+        return_fields.extend(source_fields)
+
+        events = self.event_stream(
+            query_string=query_string,
+            query_dsl=query_dsl,
+            return_fields=return_fields,
+            sort_fields=key_fields,
+        )
+
+        group_key = None
+        group = []
+        for event in events:
+            key = []
+            for field in source_fields:
+                value = event.source.get(field)
+                if isinstance(value, (list, tuple)):
+                    value = tuple(str(item) for item in value)
+                elif value is not None:
+                    value = str(value)
+                key.append(value)
+            key = tuple(key)
+
+            if group and key != group_key:
+                yield group_key, group
+                group = []
+            group_key = key
+            group.append(event)
+
+        if group:
+            yield group_key, group
+
+    def multi_query_stream(self, queries, return_fields=None, scroll=True):
+        """Search OpenSearch for several queries in a single pass.
+
+        The queries are combined into a single search where each query is a
+        named query, so that every event returned lists the names of the
+        queries it matched in Event.matched_queries. This replaces running
+        a separate search over the same timeline for each query.
+
+        Args:
+            queries: Dict with the name of each query as key and a dict with
+                either a query_string or a query_dsl as value.
+            return_fields: List of fields to return.
+            scroll: Boolean determining whether we support scrolling searches
+                or not. Defaults to True.
+
+        Returns:
+            Generator of Event objects.
+
+        Raises:
+            ValueError: if a query has neither a query_string or a query_dsl.
+        """
+        clauses = []
+        for name, query in queries.items():
+            query_string = query.get("query_string")
+            query_dsl = query.get("query_dsl")
+            if query_string:
+                clauses.append(
+                    {
+                        "query_string": {
+                            "query": query_string,
+                            "default_operator": "AND",
+                            "_name": name,
+                        }
+                    }
+                )
+            elif query_dsl:
+                if isinstance(query_dsl, str):
+                    query_dsl = json.loads(query_dsl)
+                clauses.append(
+                    {
+                        "bool": {
+                            "must": [query_dsl.get("query") or {"match_all": {}}],
+                            "_name": name,
+                        }
+                    }
+                )
+            else:
+                raise ValueError(
+                    "Both query_string and query_dsl are missing for: "
+                    "{0:s}".format(name)
+                )
+
+        if not clauses:
+            return
+
+        query_dsl = {
+            "query": {"bool": {"should": clauses, "minimum_should_match": 1}},
+            "size": self.MULTI_QUERY_PAGE_SIZE,
+            "sort": ["_doc"],
+        }
+        yield from self.event_stream(
+            query_dsl=query_dsl, return_fields=return_fields, scroll=scroll
+        )
+
+    def _build_analyzer_query(self, query_string=None, query_dsl=None):
+        """Build a query restricted to the timeline of the analyzer.
+
+        Args:
+            query_string: Query string.
+            query_dsl: Dictionary containing OpenSearch DSL query.
+
+        Returns:
+            Dictionary with the OpenSearch query clause.
+        """
+        if isinstance(query_dsl, str):
+            query_dsl = json.loads(query_dsl)
+        elif query_dsl:
+            # The datastore adds the timeline filter to the query in place.
+            query_dsl = copy.deepcopy(query_dsl)
+
+        if self.timeline_id:
+            timeline_ids = [self.timeline_id]
+        else:
+            timeline_ids = None
+
+        query = self.datastore.build_query(
+            sketch_id=self.sketch.id,
+            query_string=query_string or "",
+            query_filter={},
+            query_dsl=query_dsl,
+            timeline_ids=timeline_ids,
+        )
+        return query.get("query", {"match_all": {}})
+
+    def get_term_counts(self, field, query_string=None, query_dsl=None, indices=None):
+        """Count the values of a field using aggregations.
+
+        The values are counted by OpenSearch using a composite terms
+        aggregation, so no events need to be fetched to count them.
+
+        Args:
+            field: Name of the field to count values of. This needs to be an
+                aggregatable field, eg. "domain.keyword".
+            query_string: Optional query string to limit the events counted.
+            query_dsl: Optional OpenSearch DSL query to limit the events
+                counted.
+            indices: List of indices to query.
+
+        Returns:
+            A collections.Counter with the number of events per field value.
+        """
+        if not indices:
+            indices = [self.index_name]
+
+        indices = self.prepare_indices(indices)
+        counter = collections.Counter()
+        if not indices:
+            return counter
+
+        aggregation = {
+            "composite": {
+                "size": self.AGGREGATION_PAGE_SIZE,
+                "sources": [{"value": {"terms": {"field": field}}}],
+            }
+        }
+        body = {
+            "query": self._build_analyzer_query(query_string, query_dsl),
+            "aggregations": {"term_counts": aggregation},
+        }
+
+        while True:
+            result = self.datastore.client.search(
+                index=",".join(indices), body=body, size=0
+            )
+            term_counts = result.get("aggregations", {}).get("term_counts", {})
+            buckets = term_counts.get("buckets", [])
+            for bucket in buckets:
+                counter[bucket["key"]["value"]] += bucket["doc_count"]
+
+            after_key = term_counts.get("after_key")
+            if not buckets or not after_key:
+                break
+            aggregation["composite"]["after"] = after_key
+
+        return counter
+
+    def update_by_terms(
+        self, field, updates, query_string=None, query_dsl=None, indices=None
+    ):
+        """Add tags and attributes to events by the value of a field.
+
+        The events are updated by OpenSearch using update by query requests
+        on a terms filter, so no events need to be fetched to update them.
+        The events are updated directly, so this should not be mixed with
+        tags added to the same events using Event objects.
+
+        Args:
+            field: Name of the field to match values on, eg. "domain.keyword".
+                The value is looked up in the source of the event by the name
+                of the field without a ".keyword" suffix.
+            updates: Dict where the keys are values of the field and the
+                values are dicts with optional "tags" and "emojis" lists of
+                tags and emojis to add and an "attributes" dict of
+                attributes to set on the events.
+            query_string: Optional query string to limit the events updated.
+            query_dsl: Optional OpenSearch DSL query to limit the events
+                updated.
+            indices: List of indices to update.
+
+        Returns:
+            Number of events updated.
+        """
+        if not indices:
+            indices = [self.index_name]
+
+        indices = self.prepare_indices(indices)
+        if not indices or not updates:
+            return 0
+
+        if field.endswith(".keyword"):
+            source_field = field[: -len(".keyword")]
+        else:
+            source_field = field
+
+        query = self._build_analyzer_query(query_string, query_dsl)
+        values = list(updates.keys())
+        updated = 0
+        for offset in range(0, len(values), self.UPDATE_BY_TERMS_BATCH_SIZE):
+            batch = values[offset : offset + self.UPDATE_BY_TERMS_BATCH_SIZE]
+            body = {
+                "query": {
+                    "bool": {"must": [query], "filter": [{"terms": {field: batch}}]}
+                },
+                "script": {
+                    "source": UPDATE_BY_TERMS_SCRIPT,
+                    "lang": "painless",
+                    "params": {
+                        "field": source_field,
+                        "updates": {value: updates[value] for value in batch},
+                    },
+                },
+            }
+            updated += self.update_by_query(indices, body)
+
+        return updated
+
+    def update_by_query(self, indices, body):
+        """Updates events with an update by query request.
+
+        The request runs as an OpenSearch task that is polled until it
+        completes, so updates of large indices are not limited by the
+        timeout of the client. Events that changed while they were being
+        updated cause version conflicts, the request is repeated for as
+        long as there are conflicts, up to UPDATE_BY_QUERY_MAX_RETRIES
+        times. The script of the request therefore needs to give the same
+        result when it runs more than once on an event.
+
+        Events that could not be updated are added to events_not_updated,
+        which is reported in the result of the analyzer.
+
+        Args:
+            indices: List of indices to update.
+            body: Dict with the query and the script of the request.
+
+        Returns:
+            Number of events updated.
+
+        Raises:
+            ValueError: If the update by query task failed.
+        """
+        events_updated = METRICS["analyzer_events_updated"].labels(name=self.NAME)
+        for attempt in range(self.UPDATE_BY_QUERY_MAX_RETRIES + 1):
+            # pylint: disable=unexpected-keyword-arg
+            task = self.datastore.client.update_by_query(
+                index=",".join(indices),
+                body=body,
+                conflicts="proceed",
+                wait_for_completion=False,
+            )
+            response = self._wait_for_task(task["task"])
+            events_updated.inc(response.get("updated", 0))
+
+            failures = response.get("failures", [])
+            if failures:
+                logger.error(
+                    "[{0:s}] Unable to update {1:d} events, first failure: "
+                    "{2!s}".format(self.NAME, len(failures), failures[0])
+                )
+            conflicts = response.get("version_conflicts", 0)
+            if not conflicts:
+                break
+            logger.info(
+                "[{0:s}] {1:d} events changed while being updated, attempt "
+                "{2:d} of {3:d}.".format(
+                    self.NAME,
+                    conflicts,
+                    attempt + 1,
+                    self.UPDATE_BY_QUERY_MAX_RETRIES + 1,
+                )
+            )
+
+        not_updated = conflicts + len(failures)
+        if conflicts:
+            logger.error(
+                "[{0:s}] {1:d} events not updated due to version "
+                "conflicts.".format(self.NAME, conflicts)
+            )
+        if not_updated:
+            self.events_not_updated += not_updated
+            METRICS["analyzer_events_not_updated"].labels(name=self.NAME).inc(
+                not_updated
+            )
+
+        # Every attempt updates all events that match, so the last attempt
+        # has the number of events updated.
+        return response.get("updated", 0)
+
+    def _wait_for_task(self, task_id):
+        """Waits for an OpenSearch task to complete.
+
+        Tasks that do not complete within ANALYZERS_UPDATE_BY_QUERY_TIMEOUT
+        seconds are cancelled. The result OpenSearch stores for the task is
+        removed once it has been read.
+
+        Args:
+            task_id: ID of the task.
+
+        Returns:
+            Dict with the response of the task.
+
+        Raises:
+            ValueError: If the task failed or did not complete in time.
+        """
+        timeout = current_app.config.get(
+            "ANALYZERS_UPDATE_BY_QUERY_TIMEOUT", self.UPDATE_BY_QUERY_TIMEOUT
+        )
+        deadline = time.time() + timeout
+        client = self.datastore.client
+        while True:
+            # pylint: disable=unexpected-keyword-arg
+            result = client.tasks.get(task_id=task_id)
+            if result.get("completed"):
+                break
+
+            if time.time() >= deadline:
+                try:
+                    client.tasks.cancel(task_id=task_id)
+                except opensearchpy.TransportError as e:
+                    logger.warning(
+                        "Unable to cancel task {0:s}: {1!s}".format(task_id, e)
+                    )
+                raise ValueError(
+                    "Task {0:s} did not complete within {1:d} seconds".format(
+                        task_id, int(timeout)
+                    )
+                )
+            time.sleep(self.UPDATE_BY_QUERY_POLL_INTERVAL)
+
+        try:
+            # pylint: disable=unexpected-keyword-arg
+            client.delete(index=".tasks", id=task_id, ignore=404)
+        except opensearchpy.TransportError as e:
+            logger.warning(
+                "Unable to remove the result of task {0:s}: {1!s}".format(task_id, e)
+            )
+
+        if result.get("error"):
+            raise ValueError(
+                "Task {0:s} failed: {1!s}".format(task_id, result["error"])
+            )
+        return result.get("response", {})
+
     @_flush_datastore_decorator
     def run_wrapper(self, analysis_id):
         """A wrapper method to run the analyzer.
@@ -1046,45 +1969,74 @@ class BaseAnalyzer:
             Return value of the run method.
         """
         analysis = Analysis.query.get(analysis_id)
-        analysis.set_status("STARTED")
 
         timeline = analysis.timeline
         self.timeline_name = timeline.name
         searchindex = timeline.searchindex
 
-        counter = 0
-        while True:
-            status = searchindex.get_status.status
-            status = status.lower()
-            if status == "ready":
-                break
+        status = searchindex.get_status.status.lower()
+        if status not in ("ready", "fail"):
+            # The timeline is still being indexed. Instead of holding on to
+            # the worker while waiting, the analysis is parked and the
+            # indexing task will enqueue it again once it completes.
+            analysis.set_status("DEFERRED")
+            db_session.add(analysis)
+            db_session.commit()
 
-            if status == "fail":
-                logger.error(
-                    "Unable to run analyzer on a failed index ({0:s})".format(
-                        searchindex.index_name
+            # Check again in case indexing completed before the analysis was
+            # marked as deferred, in which case nobody would pick it up.
+            db_session.refresh(searchindex)
+            status = searchindex.get_status.status.lower()
+            if status not in ("ready", "fail"):
+                logger.info(
+                    "Index {0:s} is not ready, deferring analyzer {1:s}".format(
+                        searchindex.index_name, self.NAME
                     )
                 )
-                return "Failed"
+                return "Deferred"
 
-            time.sleep(self.SECONDS_PER_WAIT)
-            counter += 1
-            if counter >= self.MAXIMUM_WAITS:
-                logger.error(
-                    "Indexing has taken too long time, aborting run of " "analyzer"
+            # The indexing task may also have picked up the deferred
+            # analysis, only the one that claims it gets to run it.
+            if not analysis.compare_and_set_status("DEFERRED", "STARTED"):
+                logger.info(
+                    "Analyzer {0:s} on index {1:s} was picked up by the "
+                    "indexing task.".format(self.NAME, searchindex.index_name)
                 )
-                return "Failed"
-            # Refresh the searchindex object.
-            db_session.refresh(searchindex)
+                return "Deferred"
+
+        if status == "fail":
+            logger.error(
+                "Unable to run analyzer on a failed index ({0:s})".format(
+                    searchindex.index_name
+                )
+            )
+            analysis.set_status("ERROR")
+            analysis.result = "Failed"
+            db_session.add(analysis)
+            db_session.commit()
+            return "Failed"
+
+        analysis.set_status("STARTED")
+        db_session.add(analysis)
+        db_session.commit()
 
         # Run the analyzer. Broad Exception catch to catch any error and store
         # the error in the DB for display in the UI.
+        start_time = time.time()
         try:
             result = self.run()
-            analysis.set_status("DONE")
+            status = "DONE"
         except Exception:  # pylint: disable=broad-except
-            analysis.set_status("ERROR")
+            status = "ERROR"
             result = traceback.format_exc()
+        if self.events_not_updated and status == "DONE":
+            result = "{0!s} ({1:d} events could not be updated)".format(
+                result, self.events_not_updated
+            )
+        analysis.set_status(status)
+        METRICS["analyzer_run_duration"].labels(name=self.NAME, status=status).observe(
+            time.time() - start_time
+        )
 
         # Update database analysis object with result and status
         analysis.result = "{0:s}".format(result)
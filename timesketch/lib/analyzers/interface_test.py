@@ -17,9 +17,13 @@ from __future__ import unicode_literals
 
 import json
 
+import mock
+
+from timesketch.lib import errors
 from timesketch.lib.testlib import BaseTest
 from timesketch.lib.testlib import MockDataStore
 from timesketch.lib.analyzers import interface
+from timesketch.models.sketch import Analysis
 from timesketch.models.sketch import Sketch
 from timesketch.models.sketch import Story
 from timesketch.models.sketch import View
@@ -68,6 +72,38 @@ class TestAnalysisSketch(BaseTest):
         )
         self.assertIsInstance(view, View)
 
+    def test_queue_views(self):
+        """Test adding queued views to a sketch in one transaction."""
+        sketch = interface.Sketch(sketch_id=self.SKETCH_ID)
+        existing_view = sketch.add_view(
+            view_name="Session 1", analyzer_name="Test", query_string="old"
+        )
+        sketch.queue_view("Session 1", "Test", query_string="session:1")
+        sketch.queue_view("Session 2", "Test", query_string="session:2")
+        self.assertRaises(ValueError, sketch.queue_view, "Session 3", "Test")
+
+        with mock.patch.object(
+            interface.db_session, "commit", wraps=interface.db_session.commit
+        ) as mock_commit:
+            views = sketch.commit_views()
+            self.assertEqual(mock_commit.call_count, 1)
+
+        self.assertEqual([view.name for view in views], ["Session 1", "Session 2"])
+        self.assertEqual(views[0].id, existing_view.id)
+        self.assertEqual(views[0].query_string, "session:1")
+        self.assertIsNotNone(views[1].id)
+        self.assertEqual(views[1].get_status.status, "new")
+        self.assertEqual(sketch.commit_views(), [])
+
+    def test_add_faceted_view(self):
+        """Test adding a view with a facet to a sketch."""
+        sketch = interface.Sketch(sketch_id=self.SKETCH_ID)
+        view = sketch.add_faceted_view("Sessions", "Test", "session_id.test")
+        self.assertEqual(view.query_string, "_exists_:session_id.test")
+        aggregation = view.aggregations[0]
+        self.assertEqual(aggregation.agg_type, "field_bucket")
+        self.assertEqual(json.loads(aggregation.parameters)["field"], "session_id.test")
+
     def test_add_story(self):
         """Test adding a story to a sketch."""
         sketch = interface.Sketch(sketch_id=self.SKETCH_ID)
@@ -93,3 +129,315 @@ class TestAnalysisSketch(BaseTest):
         self.assertIsInstance(indices, list)
         self.assertEqual(len(indices), 1)
         self.assertEqual(indices[0], "test")
+
+
+class MockAnalyzer(interface.BaseAnalyzer):
+    """Analyzer used to test the base analyzer."""
+
+    NAME = "mock_analyzer"
+
+    def run(self):
+        """Entry point for the analyzer."""
+        return "Done"
+
+
+class TestBaseAnalyzer(BaseTest):
+    """Tests for the functionality of the BaseAnalyzer class."""
+
+    def _create_analysis(self):
+        """Create an analysis for the test timeline."""
+        analysis = Analysis(
+            name=MockAnalyzer.NAME,
+            description=MockAnalyzer.NAME,
+            analyzer_name=MockAnalyzer.NAME,
+            parameters="{}",
+            user=None,
+            sketch=self.sketch1,
+            timeline=self.timeline,
+        )
+        analysis.set_status("PENDING")
+        self._commit_to_database(analysis)
+        return analysis
+
+    @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
+    def test_run_wrapper(self):
+        """Test running an analyzer on a ready index."""
+        analysis = self._create_analysis()
+        analyzer = MockAnalyzer("test", 1, timeline_id=self.timeline.id)
+        self.assertEqual(analyzer.run_wrapper(analysis.id), "Done")
+        self.assertEqual(analysis.get_status.status, "DONE")
+
+    @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
+    def test_run_wrapper_deferred(self):
+        """Test that analyzers on an index being processed are deferred."""
+        self.searchindex.set_status("processing")
+        self._commit_to_database(self.searchindex)
+
+        analysis = self._create_analysis()
+        analyzer = MockAnalyzer("test", 1, timeline_id=self.timeline.id)
+        self.assertEqual(analyzer.run_wrapper(analysis.id), "Deferred")
+        self.assertEqual(analysis.get_status.status, "DEFERRED")
+
+    @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
+    def test_run_wrapper_deferred_claimed(self):
+        """Test that a deferred analysis only runs once when indexing ends."""
+        self.searchindex.set_status("processing")
+        self._commit_to_database(self.searchindex)
+        analysis = self._create_analysis()
+
+        def _finish_indexing(searchindex):
+            """Indexing ends and the indexing task claims the analysis."""
+            searchindex.set_status("ready")
+            self.assertTrue(analysis.compare_and_set_status("DEFERRED", "PENDING"))
+
+        analyzer = MockAnalyzer("test", 1, timeline_id=self.timeline.id)
+        with mock.patch.object(
+            interface.db_session, "refresh", side_effect=_finish_indexing
+        ):
+            self.assertEqual(analyzer.run_wrapper(analysis.id), "Deferred")
+        self.assertEqual(analysis.get_status.status, "PENDING")
+        self.assertFalse(analysis.compare_and_set_status("DEFERRED", "STARTED"))
+
+    @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
+    def test_prepare_indices(self):
+        """Test that indices are only refreshed once per analyzer run."""
+        analyzer = MockAnalyzer("test", 1)
+        with mock.patch.object(
+            analyzer.datastore.client.indices, "refresh"
+        ) as mock_refresh:
+            self.assertEqual(analyzer.prepare_indices(["test"]), ["test"])
+            self.assertEqual(analyzer.prepare_indices(["test"]), ["test"])
+            self.assertEqual(mock_refresh.call_count, 1)
+
+            analyzer.prepare_indices(["test"], force_refresh=True)
+            self.assertEqual(mock_refresh.call_count, 2)
+
+    def test_get_term_counts(self):
+        """Test counting field values with a composite aggregation."""
+        analyzer = MockAnalyzer("test", 1, timeline_id=1)
+        analyzer.datastore.client = mock.MagicMock()
+        analyzer.datastore.client.search.side_effect = [
+            {
+                "aggregations": {
+                    "term_counts": {
+                        "buckets": [
+                            {"key": {"value": "a.com"}, "doc_count": 3},
+                            {"key": {"value": "b.com"}, "doc_count": 1},
+                        ],
+                        "after_key": {"value": "b.com"},
+                    }
+                }
+            },
+            {"aggregations": {"term_counts": {"buckets": []}}},
+        ]
+
+        counts = analyzer.get_term_counts("domain.keyword")
+        self.assertEqual(dict(counts), {"a.com": 3, "b.com": 1})
+
+        calls = analyzer.datastore.client.search.call_args_list
+        self.assertEqual(len(calls), 2)
+        composite = calls[1][1]["body"]["aggregations"]["term_counts"]["composite"]
+        self.assertEqual(composite["after"], {"value": "b.com"})
+        self.assertEqual(
+            composite["sources"], [{"value": {"terms": {"field": "domain.keyword"}}}]
+        )
+
+    def test_update_by_terms(self):
+        """Test updating events by field values with update by query."""
+        analyzer = MockAnalyzer("test", 1, timeline_id=1)
+        analyzer.UPDATE_BY_TERMS_BATCH_SIZE = 2
+        analyzer.datastore.client = mock.MagicMock()
+        analyzer.datastore.client.update_by_query.return_value = {"task": "node:1"}
+        analyzer.datastore.client.tasks.get.return_value = {
+            "completed": True,
+            "response": {"updated": 5},
+        }
+
+        updates = {
+            "a.com": {"tags": ["rare-domain"]},
+            "b.com": {"attributes": {"domain_count": 1}},
+            "c.com": {"tags": ["known-cdn"]},
+        }
+        updated = analyzer.update_by_terms("domain.keyword", updates)
+        self.assertEqual(updated, 10)
+
+        calls = analyzer.datastore.client.update_by_query.call_args_list
+        self.assertEqual(len(calls), 2)
+        body = calls[0][1]["body"]
+        self.assertEqual(
+            body["query"]["bool"]["filter"],
+            [{"terms": {"domain.keyword": ["a.com", "b.com"]}}],
+        )
+        self.assertEqual(body["script"]["params"]["field"], "domain")
+        self.assertEqual(
+            body["script"]["params"]["updates"],
+            {"a.com": updates["a.com"], "b.com": updates["b.com"]},
+        )
+        self.assertEqual(calls[0][1]["conflicts"], "proceed")
+        self.assertFalse(calls[0][1]["wait_for_completion"])
+        analyzer.datastore.client.tasks.get.assert_called_with(task_id="node:1")
+
+    @mock.patch("time.sleep")
+    def test_update_by_query_conflicts(self, mock_sleep):
+        """Test that updates are polled and repeated on version conflicts."""
+        analyzer = MockAnalyzer("test", 1, timeline_id=1)
+        analyzer.UPDATE_BY_QUERY_MAX_RETRIES = 1
+        client = mock.MagicMock()
+        analyzer.datastore.client = client
+        client.update_by_query.return_value = {"task": "node:1"}
+        client.tasks.get.side_effect = [
+            {"completed": False},
+            {"completed": True, "response": {"updated": 3, "version_conflicts": 2}},
+            {"completed": True, "response": {"updated": 5}},
+        ]
+        self.assertEqual(analyzer.update_by_query(["test"], {}), 5)
+        self.assertEqual(client.update_by_query.call_count, 2)
+        self.assertEqual(analyzer.events_not_updated, 0)
+        mock_sleep.assert_called_once()
+
+        # Conflicts that remain after the retries are counted.
+        client.tasks.get.side_effect = [
+            {"completed": True, "response": {"updated": 3, "version_conflicts": 2}},
+            {"completed": True, "response": {"updated": 4, "version_conflicts": 1}},
+        ]
+        self.assertEqual(analyzer.update_by_query(["test"], {}), 4)
+        self.assertEqual(analyzer.events_not_updated, 1)
+
+        client.tasks.get.side_effect = [
+            {"completed": True, "error": {"type": "script_exception"}}
+        ]
+        with self.assertRaises(ValueError):
+            analyzer.update_by_query(["test"], {})
+
+        # The stored results of the tasks are removed.
+        client.delete.assert_called_with(index=".tasks", id="node:1", ignore=404)
+
+    @mock.patch("timesketch.lib.analyzers.interface.time.sleep")
+    def test_update_by_query_timeout(self, mock_sleep):
+        """Test that update by query tasks are cancelled after the timeout."""
+        analyzer = MockAnalyzer("test", 1, timeline_id=1)
+        client = mock.MagicMock()
+        analyzer.datastore.client = client
+        client.update_by_query.return_value = {"task": "node:1"}
+        client.tasks.get.return_value = {"completed": False}
+
+        self.app.config["ANALYZERS_UPDATE_BY_QUERY_TIMEOUT"] = 0
+        try:
+            with self.assertRaises(ValueError):
+                analyzer.update_by_query(["test"], {})
+        finally:
+            del self.app.config["ANALYZERS_UPDATE_BY_QUERY_TIMEOUT"]
+        client.tasks.cancel.assert_called_once_with(task_id="node:1")
+        mock_sleep.assert_not_called()
+
+    def test_grouped_stream(self):
+        """Test streaming groups of events sorted by keyword fields."""
+        analyzer = MockAnalyzer("test", 1, timeline_id=1)
+        analyzer.datastore.client = mock.MagicMock()
+        hits = []
+        for index, (file_reference, timestamp_desc) in enumerate(
+            [("1-1", "atime"), ("1-1", "atime"), ("1-1", "mtime"), (2, "atime")]
+        ):
+            source = {
+                "file_reference": file_reference,
+                "timestamp_desc": timestamp_desc,
+            }
+            hits.append(
+                {
+                    "_id": str(index),
+                    "_type": "_doc",
+                    "_index": "test",
+                    "_source": source,
+                }
+            )
+
+        with mock.patch.object(
+            analyzer.datastore, "search_stream", return_value=iter(hits)
+        ) as mock_search:
+            groups = list(
+                analyzer.grouped_stream(
+                    ["file_reference.keyword", "timestamp_desc.keyword"],
+                    query_string="attribute_type:16",
+                    return_fields=["timestamp"],
+                )
+            )
+
+        self.assertEqual(
+            [(key, [event.event_id for event in events]) for key, events in groups],
+            [
+                (("1-1", "atime"), ["0", "1"]),
+                (("1-1", "mtime"), ["2"]),
+                (("2", "atime"), ["3"]),
+            ],
+        )
+        kwargs = mock_search.call_args[1]
+        self.assertIsNone(kwargs["query_string"])
+        self.assertEqual(
+            kwargs["query_dsl"]["sort"][0],
+            {"file_reference.keyword": {"order": "asc", "unmapped_type": "keyword"}},
+        )
+        self.assertIn("file_reference", kwargs["return_fields"])
+
+
+class TestEventFrameBuilder(BaseTest):
+    """Tests for the functionality of the EventFrameBuilder class."""
+
+    @staticmethod
+    def _get_events(count):
+        """Returns a list of search hits."""
+        events = []
+        for index in range(count):
+            source = {
+                "datetime": "2022-01-0{0:d}T12:00:00+00:00".format(index % 3 + 1),
+                "source_name": "source_{0:d}".format(index % 2),
+                "tag": ["tag"],
+            }
+            if index % 4 == 0:
+                source["record_number"] = index
+            events.append(
+                {
+                    "_id": str(index),
+                    "_type": "_doc",
+                    "_index": "test",
+                    "_source": source,
+                }
+            )
+        return events
+
+    def test_build(self):
+        """Test building a data frame over several pages."""
+        builder = interface.EventFrameBuilder(
+            categorical_fields=["source_name", "tag"], datetime_fields=["datetime"]
+        )
+        builder.PAGE_SIZE = 3
+        for event in self._get_events(10):
+            builder.add_event(event)
+        frame = builder.build()
+
+        self.assertEqual(frame.shape[0], 10)
+        self.assertEqual(list(frame["_id"]), [str(x) for x in range(10)])
+        self.assertEqual(frame["source_name"].dtype.name, "category")
+        self.assertEqual(frame["_index"].dtype.name, "category")
+        self.assertEqual(frame["tag"].dtype.name, "object")
+        self.assertEqual(str(frame["datetime"].dtype), "datetime64[ns, UTC]")
+        self.assertEqual(frame["datetime"][4].day, 2)
+        self.assertEqual(frame["record_number"][8], 8)
+        self.assertTrue(frame["record_number"].isnull()[9])
+
+    def test_build_empty(self):
+        """Test building a data frame without events."""
+        builder = interface.EventFrameBuilder()
+        self.assertEqual(builder.build().shape[0], 0)
+
+    def test_limits(self):
+        """Test that the row and memory limits are enforced."""
+        builder = interface.EventFrameBuilder(max_rows=5)
+        with self.assertRaises(errors.DataTooLargeError):
+            for event in self._get_events(10):
+                builder.add_event(event)
+
+        builder = interface.EventFrameBuilder(max_bytes=100)
+        builder.PAGE_SIZE = 5
+        with self.assertRaises(errors.DataTooLargeError):
+            for event in self._get_events(10):
+                builder.add_event(event)
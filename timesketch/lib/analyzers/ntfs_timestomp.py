@@ -100,41 +100,40 @@ class NtfsTimestompSketchPlugin(interface.BaseAnalyzer):
             "timestamp",
         ]
 
-        events = self.event_stream(query_string=query, return_fields=return_fields)
-
-        # Dict timestamp_type + "&" + file_ref -> FileInfo
-        file_infos = dict()
-
-        for event in events:
-            attribute_type = event.source.get("attribute_type")
-            file_ref = event.source.get("file_reference")
-            timestamp_type = event.source.get("timestamp_desc")
-            timestamp = event.source.get("timestamp")
+        # Events are grouped by file reference and timestamp type, so only
+        # the events of a single file are held in memory.
+        groups = self.grouped_stream(
+            ["file_reference.keyword", "timestamp_desc.keyword"],
+            query_string=query,
+            return_fields=return_fields,
+        )
 
-            if not attribute_type or not timestamp_type:
-                continue
+        timestomps = 0
+        for _, events in groups:
+            file_info = FileInfo()
 
-            if attribute_type not in [self.FILE_NAME, self.STD_INFO]:
-                continue
+            for event in events:
+                attribute_type = event.source.get("attribute_type")
+                file_ref = event.source.get("file_reference")
+                timestamp_type = event.source.get("timestamp_desc")
+                timestamp = event.source.get("timestamp")
 
-            key = "{0:s}&{1:s}".format(timestamp_type, str(file_ref))
+                if not attribute_type or not timestamp_type:
+                    continue
 
-            if key not in file_infos:
-                file_infos[key] = FileInfo()
+                if attribute_type not in [self.FILE_NAME, self.STD_INFO]:
+                    continue
 
-            file_info = file_infos[key]
-            file_info.file_reference = file_ref
-            file_info.timestamp_desc = timestamp_type
+                file_info.file_reference = file_ref
+                file_info.timestamp_desc = timestamp_type
 
-            if attribute_type == self.STD_INFO:
-                file_info.std_info_timestamp = timestamp
-                file_info.std_info_event = event
+                if attribute_type == self.STD_INFO:
+                    file_info.std_info_timestamp = timestamp
+                    file_info.std_info_event = event
 
-            if attribute_type == self.FILE_NAME:
-                file_info.file_names.append((event, timestamp))
+                if attribute_type == self.FILE_NAME:
+                    file_info.file_names.append((event, timestamp))
 
-        timestomps = 0
-        for file_info in file_infos.values():
             if self.is_suspicious(file_info):
                 timestomps = timestomps + 1
 
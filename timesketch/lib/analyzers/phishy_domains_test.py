@@ -1,6 +1,9 @@
 """Tests for DomainsPlugin."""
 from __future__ import unicode_literals
 
+import random
+import string
+
 import mock
 
 from flask import current_app
@@ -63,3 +66,71 @@ class TestDomainsPlugin(BaseTest):
         # pylint: disable=protected-access
         similar = analyzer._get_similar_domains("www.google.com", domain_dict)
         self.assertEqual(len(similar), 0)
+
+    # Mock the OpenSearch datastore.
+    @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
+    def test_score_domains(self):
+        """Test scoring domains against the watched domain index."""
+        analyzer = phishy_domains.PhishyDomainsSketchPlugin("test_index", 1)
+        analyzer.SCORING_CHUNK_SIZE = 2
+        watched_domains = {}
+        for domain in ("stortmbl.is", "google.com"):
+            # pylint: disable=protected-access
+            watched_domains[domain] = {
+                "hash": analyzer._get_minhash_from_domain(domain),
+                "depth": 2,
+            }
+        domain_index = phishy_domains.WatchedDomainIndex(watched_domains, 0.75)
+        self.assertTrue(domain_index.is_sub_domain("mail.google.com"))
+        self.assertFalse(domain_index.is_sub_domain("google.com"))
+
+        domains = ["stortmbi.is", "mail.google.com", "mbl.is", "gooogle.com"]
+        for processes in (0, 2):
+            current_app.config["DOMAIN_ANALYZER_SCORING_PROCESSES"] = processes
+            # pylint: disable=protected-access
+            results = analyzer._score_domains(domains, watched_domains, domain_index)
+            self.assertEqual(set(results), set(domains))
+            self.assertEqual([x for x, _ in results["stortmbi.is"]], ["stortmbl.is"])
+            self.assertEqual([x for x, _ in results["gooogle.com"]], ["google.com"])
+            self.assertEqual(results["mail.google.com"], [])
+            self.assertEqual(results["mbl.is"], [])
+
+    def test_candidate_recall(self):
+        """Test that the LSH returns all watched domains that are similar."""
+        rand = random.Random(1)
+        letters = string.ascii_lowercase
+
+        def _typo(name):
+            """Returns a name with a few random changes."""
+            chars = list(name)
+            for _ in range(rand.randint(1, 3)):
+                position = rand.randrange(len(chars))
+                if rand.random() < 0.5:
+                    chars[position] = rand.choice(letters)
+                else:
+                    chars.insert(position, rand.choice(letters))
+            return "".join(chars)
+
+        watched_domains = {}
+        for _ in range(100):
+            name = "".join(rand.choice(letters) for _ in range(rand.randint(5, 14)))
+            domain = "{0:s}.com".format(name)
+            watched_domains[domain] = {
+                # pylint: disable=protected-access
+                "hash": phishy_domains._get_minhash_from_domain(domain),
+                "depth": 2,
+            }
+        domain_index = phishy_domains.WatchedDomainIndex(watched_domains, 0.75)
+
+        watched_names = [domain[: -len(".com")] for domain in watched_domains]
+        for _ in range(1000):
+            domain = "{0:s}.com".format(_typo(rand.choice(watched_names)))
+            # pylint: disable=protected-access
+            minhash = phishy_domains._get_minhash_from_domain(domain)
+            similar = {
+                watched_domain
+                for watched_domain, item in watched_domains.items()
+                if item["hash"].jaccard(minhash) >= 0.75
+            }
+            candidates = set(domain_index.get_candidates(2, minhash))
+            self.assertTrue(similar.issubset(candidates), domain)
@@ -2,10 +2,37 @@
 
 from __future__ import unicode_literals
 
+from flask import current_app
+from opensearchpy.exceptions import NotFoundError
+
 from timesketch.lib.analyzers import interface
 from timesketch.lib.analyzers import manager
 
 
+# Painless script that sets the session ID of an event from the start
+# timestamps of a batch of sessions, the event belongs to the last session
+# that starts before or at the timestamp of the event.
+SESSION_RANGES_SCRIPT = """
+long timestamp = ((Number) ctx._source.timestamp).longValue();
+int low = 0;
+int high = params.starts.size() - 1;
+while (low < high) {
+  int middle = (low + high + 1) / 2;
+  if (((Number) params.starts.get(middle)).longValue() <= timestamp) {
+    low = middle;
+  } else {
+    high = middle - 1;
+  }
+}
+def sessionIds = ctx._source.session_id;
+if (!(sessionIds instanceof Map)) {
+  sessionIds = new HashMap();
+}
+sessionIds[params.session_type] = params.first_session + low;
+ctx._source.session_id = sessionIds;
+"""
+
+
 class SessionizerSketchPlugin(interface.BaseAnalyzer):
     """Sessionizing analyzer.
 
@@ -34,12 +61,21 @@ class SessionizerSketchPlugin(interface.BaseAnalyzer):
     query = "*"
     session_type = "all_events"
 
+    # Number of timestamps per scroll page when computing session ranges.
+    TIMESTAMP_PAGE_SIZE = 10000
+
+    # Number of sessions per update by query request.
+    SESSION_RANGE_BATCH_SIZE = 1000
+
     def run(self):
         """Entry point for the analyzer. Allocates each event a session_id
         attribute.
         Returns:
             String containing the number of sessions created.
         """
+        if current_app.config.get("SESSIONIZER_RANGE_UPDATES", False):
+            return self.run_with_ranges()
+
         return_fields = ["timestamp"]
 
         # event_stream returns an ordered generator of events (by time)
@@ -83,5 +119,115 @@ class SessionizerSketchPlugin(interface.BaseAnalyzer):
 
         event.commit()
 
+    def timestamp_stream(self):
+        """Streams the timestamps of the events to be sessionized.
+
+        Only the timestamp doc values of the events are fetched, in order
+        of time, not the source of the events.
+
+        Yields:
+            Timestamps of the events as integers, in microseconds.
+        """
+        indices = self.prepare_indices([self.index_name])
+        if not indices:
+            return
+
+        body = {
+            "query": self._build_analyzer_query(query_string=self.query),
+            "_source": False,
+            "docvalue_fields": ["timestamp"],
+            "sort": [{"timestamp": "asc"}],
+            "size": self.TIMESTAMP_PAGE_SIZE,
+        }
+        # pylint: disable=unexpected-keyword-arg
+        result = self.datastore.client.search(
+            index=",".join(indices), body=body, scroll="5m"
+        )
+        scroll_id = result.get("_scroll_id")
+        events_scanned = interface.METRICS["analyzer_events_scanned"].labels(
+            name=self.NAME
+        )
+        try:
+            while result["hits"]["hits"]:
+                for hit in result["hits"]["hits"]:
+                    events_scanned.inc()
+                    timestamps = hit.get("fields", {}).get("timestamp")
+                    if timestamps:
+                        yield int(timestamps[0])
+                result = self.datastore.client.scroll(scroll_id=scroll_id, scroll="5m")
+                scroll_id = result.get("_scroll_id", scroll_id)
+        finally:
+            if scroll_id:
+                try:
+                    self.datastore.client.clear_scroll(scroll_id=scroll_id)
+                except NotFoundError:
+                    pass
+
+    def get_session_ranges(self):
+        """Computes the sessions from the timestamps of the events.
+
+        Returns:
+            List of tuples with the first and last timestamp of each session,
+            in order of time.
+        """
+        ranges = []
+        start_timestamp = None
+        last_timestamp = None
+        for timestamp in self.timestamp_stream():
+            if last_timestamp is None:
+                start_timestamp = timestamp
+            elif timestamp - last_timestamp > self.max_time_diff_micros:
+                ranges.append((start_timestamp, last_timestamp))
+                start_timestamp = timestamp
+            last_timestamp = timestamp
+
+        if last_timestamp is not None:
+            ranges.append((start_timestamp, last_timestamp))
+        return ranges
+
+    def run_with_ranges(self):
+        """Allocates session IDs to events by ranges of time.
+
+        The session boundaries are computed from the timestamps of the
+        events, then the events of each range of time are updated with
+        scripted update by query requests, many sessions per request. The
+        number of requests depends on the number of sessions and not on
+        the number of events.
+
+        Returns:
+            String containing the number of sessions created.
+        """
+        ranges = self.get_session_ranges()
+        indices = self.prepare_indices([self.index_name])
+        query = self._build_analyzer_query(query_string=self.query)
+
+        for offset in range(0, len(ranges), self.SESSION_RANGE_BATCH_SIZE):
+            batch = ranges[offset : offset + self.SESSION_RANGE_BATCH_SIZE]
+            # All events between the first and last session of the batch that
+            # match the query are in one of the sessions of the batch.
+            time_range = {"gte": batch[0][0], "lte": batch[-1][1]}
+            body = {
+                "query": {
+                    "bool": {
+                        "must": [query],
+                        "filter": [{"range": {"timestamp": time_range}}],
+                    }
+                },
+                "script": {
+                    "source": SESSION_RANGES_SCRIPT,
+                    "lang": "painless",
+                    "params": {
+                        "session_type": self.session_type,
+                        "starts": [start for start, _ in batch],
+                        "first_session": offset + 1,
+                    },
+                },
+            }
+            self.update_by_query(indices, body)
+
+        return "Sessionizing completed, number of session created:" " {0:d}".format(
+            len(ranges)
+        )
+
 
 manager.AnalysisManager.register_analyzer(SessionizerSketchPlugin)
@@ -5,6 +5,8 @@ from __future__ import unicode_literals
 import unittest
 import mock
 
+from flask import current_app
+
 from timesketch.lib.analyzers.sessionizer import SessionizerSketchPlugin
 from timesketch.lib.analyzers.base_sessionizer_test import _create_mock_event
 from timesketch.lib.analyzers.base_sessionizer_test import check_surrounding_events
@@ -101,6 +103,52 @@ class TestSessionizerPlugin(BaseTest):
         event1 = datastore.event_store["0"]
         self.assertEqual(event1["_source"]["session_id"], {"all_events": 1})
 
+    def test_range_updates(self):
+        """Test allocating sessions by ranges of time."""
+        current_app.config["SESSIONIZER_RANGE_UPDATES"] = True
+        analyzer = SessionizerSketchPlugin("test_index", 1)
+        analyzer.SESSION_RANGE_BATCH_SIZE = 2
+        analyzer.datastore.client = mock.Mock()
+        client = analyzer.datastore.client
+
+        timestamps = [100, 200, 400000000, 400000100, 900000000]
+        client.search.return_value = {
+            "_scroll_id": "1",
+            "hits": {"hits": [{"fields": {"timestamp": [x]}} for x in timestamps]},
+        }
+        client.scroll.return_value = {"_scroll_id": "1", "hits": {"hits": []}}
+        client.update_by_query.return_value = {"task": "node:1"}
+        client.tasks.get.return_value = {"completed": True, "response": {"updated": 2}}
+
+        message = analyzer.run()
+        self.assertEqual(
+            message, "Sessionizing completed, number of session created: 3"
+        )
+
+        search_body = client.search.call_args[1]["body"]
+        self.assertFalse(search_body["_source"])
+        self.assertEqual(search_body["docvalue_fields"], ["timestamp"])
+        client.clear_scroll.assert_called_once_with(scroll_id="1")
+
+        calls = client.update_by_query.call_args_list
+        self.assertEqual(len(calls), 2)
+        body = calls[0][1]["body"]
+        self.assertEqual(
+            body["query"]["bool"]["filter"],
+            [{"range": {"timestamp": {"gte": 100, "lte": 400000100}}}],
+        )
+        self.assertEqual(
+            body["script"]["params"],
+            {
+                "session_type": "all_events",
+                "starts": [100, 400000000],
+                "first_session": 1,
+            },
+        )
+        params = calls[1][1]["body"]["script"]["params"]
+        self.assertEqual(params["starts"], [900000000])
+        self.assertEqual(params["first_session"], 3)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -15,6 +15,8 @@
 
 from __future__ import unicode_literals
 
+from flask import current_app
+
 from timesketch.lib import similarity
 from timesketch.lib.analyzers import interface
 from timesketch.lib.analyzers import manager
@@ -126,17 +128,19 @@ class SimilarityScorer(interface.BaseAnalyzer):
             delimiters=self._config.delimiters,
             num_perm=self._config.num_perm,
             threshold=self._config.threshold,
+            processes=current_app.config.get("SIMILARITY_SCORER_PROCESSES", 0),
         )
         total_num_events = len(minhashes)
-        for key, minhash in minhashes.items():
+        scores = similarity.calculate_scores(lsh, minhashes, total_num_events)
+        for key, score in scores.items():
             event_id, event_type, index_name = key
-            event_dict = dict(_id=event_id, _type=event_type, _index=index_name)
-            event = interface.Event(event_dict, self.datastore)
-            score = similarity.calculate_score(lsh, minhash, total_num_events)
-            attributes_to_add = {"similarity_score": score}
-            event.add_attributes(attributes_to_add)
-            # Commit the event to the datastore.
-            event.commit()
+            # Queue the update in the bulk insert queue of the datastore.
+            self.datastore.import_event(
+                index_name,
+                event_type,
+                event_id=event_id,
+                event={"similarity_score": score},
+            )
 
         msg = "Similarity scorer processed {0:d} events for data_type {1:s}"
         return msg.format(total_num_events, self._config.data_type)
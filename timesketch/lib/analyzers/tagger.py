@@ -2,6 +2,8 @@
 from collections.abc import Iterable
 import logging
 
+from flask import current_app
+
 from timesketch.lib import emojis
 from timesketch.lib.analyzers import interface
 from timesketch.lib.analyzers import manager
@@ -33,6 +35,7 @@ class TaggerSketchPlugin(interface.BaseAnalyzer):
         self.index_name = index_name
         self._tag_name = kwargs.get("tag")
         self._tag_config = kwargs.get("tag_config")
+        self._tag_configs = kwargs.get("tag_configs")
         super().__init__(index_name, sketch_id, timeline_id=timeline_id)
 
     def run(self):
@@ -41,6 +44,8 @@ class TaggerSketchPlugin(interface.BaseAnalyzer):
         Returns:
             String with summary of the analyzer result.
         """
+        if self._tag_configs:
+            return self.tag_all(self._tag_configs)
         return self.tagger(self._tag_name, self._tag_config)
 
     @staticmethod
@@ -48,30 +53,32 @@ class TaggerSketchPlugin(interface.BaseAnalyzer):
         """Get kwargs for the analyzer.
 
         Returns:
-            List of searches to tag results for.
+            List of searches to tag results for. If ANALYZERS_SINGLE_PASS
+            is enabled all searches are run by a single analyzer.
         """
         tags_config = interface.get_yaml_config("tags.yaml")
         if not tags_config:
             return "Unable to parse the tags config file."
 
+        if current_app.config.get("ANALYZERS_SINGLE_PASS", True):
+            return [{"tag_configs": tags_config}]
+
         tags_kwargs = [
             {"tag": tag, "tag_config": config} for tag, config in tags_config.items()
         ]
         return tags_kwargs
 
-    def tagger(self, name, config):
-        """Tag and add emojis to events.
+    @staticmethod
+    def _get_tagger(config):
+        """Returns a dict with the settings of a tagger.
 
         Args:
-            name: String with the name describing what will be tagged.
             config: A dict that contains the configuration See data/tags.yaml
                 for fields and documentation of what needs to be defined.
 
         Returns:
-            String with summary of the analyzer result.
+            Dict with the parsed configuration of the tagger.
         """
-        query = config.get("query_string")
-        query_dsl = config.get("query_dsl")
         save_search = config.get("save_search", False)
         # For legacy reasons to support both save_search and
         # create_view parameters.
@@ -81,14 +88,13 @@ class TaggerSketchPlugin(interface.BaseAnalyzer):
         search_name = config.get("search_name", None)
         # For legacy reasons to support both search_name and view_name.
         if search_name is None:
-            search_name = config.get("view_name", name)
+            search_name = config.get("view_name")
 
         tags = set(config.get("tags", []))
         dynamic_tags = {tag[1:] for tag in tags if tag.startswith("$")}
         tags = {tag for tag in tags if not tag.startswith("$")}
 
         emoji_names = config.get("emojis", [])
-        emojis_to_add = [emojis.get_emoji(x) for x in emoji_names]
 
         expression_string = config.get("regular_expression", "")
         attributes = list(dynamic_tags)
@@ -103,46 +109,135 @@ class TaggerSketchPlugin(interface.BaseAnalyzer):
             if attribute:
                 attributes.append(attribute)
 
-        event_counter = 0
+        return {
+            "config": config,
+            "query_string": config.get("query_string"),
+            "query_dsl": config.get("query_dsl"),
+            "save_search": save_search,
+            "search_name": search_name,
+            "tags": tags,
+            "dynamic_tags": dynamic_tags,
+            "emojis": [emojis.get_emoji(x) for x in emoji_names],
+            "expression": expression,
+            "attributes": attributes,
+            "event_counter": 0,
+        }
+
+    def _tag_event(self, event, tagger):
+        """Tag and add emojis to an event, without committing it.
+
+        Args:
+            event: Event object that matched the query of the tagger.
+            tagger: Dict with the settings of the tagger, see _get_tagger.
+        """
+        config = tagger["config"]
+        if tagger["expression"]:
+            value = event.source.get(config.get("re_attribute"))
+            if value:
+                result = tagger["expression"].findall(value)
+                if not result:
+                    # Skip counting this tag since the regular expression
+                    # didn't find anything.
+                    return
+
+        tagger["event_counter"] += 1
+        event.add_tags(tagger["tags"])
+
+        # Compute dynamic tag values with modifiers.
+        dynamic_tag_values = []
+        for attribute in tagger["dynamic_tags"]:
+            tag_value = event.source.get(attribute)
+            for mod in config.get("modifiers", []):
+                tag_value = self.MODIFIERS[mod](tag_value)
+            if isinstance(tag_value, Iterable):
+                dynamic_tag_values.extend(tag_value)
+            else:
+                dynamic_tag_values.append(tag_value)
+        event.add_tags(dynamic_tag_values)
+
+        event.add_emojis(tagger["emojis"])
+
+    def _finish_tagger(self, name, tagger):
+        """Saves the search of a tagger and returns its summary.
+
+        Args:
+            name: String with the name describing what was tagged.
+            tagger: Dict with the settings of the tagger, see _get_tagger.
+
+        Returns:
+            String with summary of the tagger result.
+        """
+        event_counter = tagger["event_counter"]
+        if tagger["save_search"] and event_counter:
+            self.sketch.add_view(
+                tagger["search_name"] or name,
+                self.NAME,
+                query_string=tagger["query_string"],
+                query_dsl=tagger["query_dsl"],
+            )
+        return "{0:d} events tagged for [{1:s}]".format(event_counter, name)
+
+    def tagger(self, name, config):
+        """Tag and add emojis to events.
+
+        Args:
+            name: String with the name describing what will be tagged.
+            config: A dict that contains the configuration See data/tags.yaml
+                for fields and documentation of what needs to be defined.
+
+        Returns:
+            String with summary of the analyzer result.
+        """
+        tagger = self._get_tagger(config)
         events = self.event_stream(
-            query_string=query, query_dsl=query_dsl, return_fields=attributes
+            query_string=tagger["query_string"],
+            query_dsl=tagger["query_dsl"],
+            return_fields=tagger["attributes"],
         )
 
         for event in events:
-            if expression:
-                value = event.source.get(config.get("re_attribute"))
-                if value:
-                    result = expression.findall(value)
-                    if not result:
-                        # Skip counting this tag since the regular expression
-                        # didn't find anything.
-                        continue
-
-            event_counter += 1
-            event.add_tags(tags)
-
-            # Compute dynamic tag values with modifiers.
-            dynamic_tag_values = []
-            for attribute in dynamic_tags:
-                tag_value = event.source.get(attribute)
-                for mod in config.get("modifiers", []):
-                    tag_value = self.MODIFIERS[mod](tag_value)
-                if isinstance(tag_value, Iterable):
-                    dynamic_tag_values.extend(tag_value)
-                else:
-                    dynamic_tag_values.append(tag_value)
-            event.add_tags(dynamic_tag_values)
-
-            event.add_emojis(emojis_to_add)
+            self._tag_event(event, tagger)
+            # Commit the event to the datastore.
+            event.commit()
+
+        return self._finish_tagger(name, tagger)
+
+    def tag_all(self, configs):
+        """Tag and add emojis to events for several taggers in one search.
 
+        The queries of all taggers are combined into a single search, each
+        event is tagged by every tagger whose query it matched. Results and
+        saved searches are the same as running each tagger on its own.
+
+        Args:
+            configs: Dict with the name of each tagger as key and its
+                configuration as value, see data/tags.yaml.
+
+        Returns:
+            String with summary of the analyzer result.
+        """
+        taggers = {}
+        return_fields = set()
+        for name, config in configs.items():
+            tagger = self._get_tagger(config)
+            if not (tagger["query_string"] or tagger["query_dsl"]):
+                logger.warning("No query defined for tagger: {0:s}".format(name))
+                continue
+            taggers[name] = tagger
+            return_fields.update(tagger["attributes"])
+
+        events = self.multi_query_stream(taggers, return_fields=list(return_fields))
+        for event in events:
+            matched_queries = set(event.matched_queries)
+            for name, tagger in taggers.items():
+                if name in matched_queries:
+                    self._tag_event(event, tagger)
             # Commit the event to the datastore.
             event.commit()
 
-        if save_search and event_counter:
-            self.sketch.add_view(
-                search_name, self.NAME, query_string=query, query_dsl=query_dsl
-            )
-        return "{0:d} events tagged for [{1:s}]".format(event_counter, name)
+        return "\n".join(
+            self._finish_tagger(name, tagger) for name, tagger in taggers.items()
+        )
 
 
 manager.AnalysisManager.register_analyzer(TaggerSketchPlugin)
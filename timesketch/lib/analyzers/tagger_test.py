@@ -82,7 +82,7 @@ class TestTaggerPlugin(BaseTest):
 
         datastore.import_event("blah", "blah", source_attributes, "0")
         message = analyzer.run()
-        self.assertEqual(analyzer.tagged_events["0"]["tags"], ["dummyTag"])
+        self.assertEqual(analyzer.update_buffer.get("blah", "0").tags, {"dummyTag"})
         self.assertEqual(message, "1 events tagged for [dummy_tagger]")
 
     @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
@@ -122,8 +122,8 @@ class TestTaggerPlugin(BaseTest):
         message = analyzer.run()
 
         self.assertEqual(message, "1 events tagged for [regex_tagger]")
-        self.assertNotIn("0", analyzer.tagged_events)
-        self.assertEqual(analyzer.tagged_events["1"]["tags"], ["regexTag"])
+        self.assertIsNone(analyzer.update_buffer.get("blah", "0"))
+        self.assertEqual(analyzer.update_buffer.get("blah", "1").tags, {"regexTag"})
 
     @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
     def test_dynamic_tag_extraction(self):
@@ -162,7 +162,67 @@ class TestTaggerPlugin(BaseTest):
         datastore.import_event("blah", "blah", source_attributes, "0")
         message = analyzer.run()
         self.assertEqual(
-            sorted(analyzer.tagged_events["0"]["tags"]),
+            sorted(analyzer.update_buffer.get("blah", "0").tags),
             sorted(["yara", "rule2", "rule1"]),
         )
         self.assertEqual(message, "1 events tagged for [yara_match_tagger]")
+
+    @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
+    def test_tag_all(self):
+        """Tests that several taggers are run in a single search."""
+        config = yaml.safe_load(
+            """
+        first_tagger:
+          query_string: 'message:first'
+          tags: ['firstTag']
+        second_tagger:
+          query_string: 'message:second'
+          tags: ['secondTag', '$data_type']
+          modifiers: ['split']
+          save_search: true
+          """
+        )
+        analyzer = tagger.TaggerSketchPlugin("test_index", 1, tag_configs=config)
+        analyzer.datastore.client = mock.Mock()
+
+        hits = [
+            {
+                "_id": "0",
+                "_type": "_doc",
+                "_index": "blah",
+                "_source": {"message": "first second", "data_type": "test"},
+                "matched_queries": ["first_tagger", "second_tagger"],
+            },
+            {
+                "_id": "1",
+                "_type": "_doc",
+                "_index": "blah",
+                "_source": {"message": "second", "data_type": "test"},
+                "matched_queries": ["second_tagger"],
+            },
+        ]
+        with mock.patch.object(
+            analyzer.datastore, "search_stream", return_value=iter(hits)
+        ) as mock_search:
+            message = analyzer.run()
+
+        self.assertEqual(mock_search.call_count, 1)
+        query_dsl = mock_search.call_args[1]["query_dsl"]
+        clauses = query_dsl["query"]["bool"]["should"]
+        self.assertEqual(
+            [clause["query_string"]["_name"] for clause in clauses],
+            ["first_tagger", "second_tagger"],
+        )
+        self.assertIn("data_type", mock_search.call_args[1]["return_fields"])
+
+        self.assertEqual(
+            analyzer.update_buffer.get("blah", "0").tags,
+            {"firstTag", "secondTag", "test"},
+        )
+        self.assertEqual(
+            analyzer.update_buffer.get("blah", "1").tags, {"secondTag", "test"}
+        )
+        self.assertEqual(
+            message,
+            "1 events tagged for [first_tagger]\n2 events tagged for [second_tagger]",
+        )
@@ -0,0 +1,486 @@
+# Copyright 2022 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Buffer of changes analyzers make to events."""
+
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+
+
+logger = logging.getLogger("timesketch.analyzers.update_buffer")
+
+# Painless script that applies the buffered changes of a single event. Tags
+# and emojis are added to the values already in the event, so buffered
+# changes can be flushed at any time without knowing the event source.
+EVENT_UPDATE_SCRIPT = """
+def addToList(def source, String key, def items) {
+  def values = source[key];
+  if (values == null) {
+    values = [];
+  } else if (!(values instanceof List)) {
+    values = [values];
+  }
+  for (item in items) {
+    if (!values.contains(item)) {
+      values.add(item);
+    }
+  }
+  source[key] = values;
+}
+
+if (params.containsKey('attributes')) {
+  for (entry in params.attributes.entrySet()) {
+    ctx._source[entry.getKey()] = entry.getValue();
+  }
+}
+if (params.containsKey('tags')) {
+  addToList(ctx._source, 'tag', params.tags);
+}
+if (params.containsKey('emojis')) {
+  addToList(ctx._source, '__ts_emojis', params.emojis);
+}
+if (params.containsKey('labels')) {
+  if (ctx._source.timesketch_label == null) {
+    ctx._source.timesketch_label = new ArrayList();
+  }
+  for (change in params.labels) {
+    def label = change.timesketch_label;
+    if (change.toggle) {
+      boolean removed = ctx._source.timesketch_label.removeIf(
+          l -> l.name == label.name && l.sketch_id == label.sketch_id);
+      if (!removed) {
+        ctx._source.timesketch_label.add(label);
+      }
+    } else if (!ctx._source.timesketch_label.contains(label)) {
+      ctx._source.timesketch_label.add(label);
+    }
+  }
+}
+"""
+
+
+def _estimate_size(value):
+    """Returns a rough estimate of the memory used by a value in bytes."""
+    if isinstance(value, str):
+        return 50 + len(value)
+    if isinstance(value, dict):
+        return 100 + sum(
+            _estimate_size(key) + _estimate_size(item) for key, item in value.items()
+        )
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return 60 + sum(_estimate_size(item) for item in value)
+    return 30
+
+
+class EventUpdate(object):
+    """Changes to a single event.
+
+    Attributes:
+        event_type: Document type in OpenSearch.
+        tags: Set of tags to add, or None.
+        emojis: Set of emojis to add, or None.
+        attributes: Dict with attributes to set, or None.
+        labels: List of label changes, or None.
+    """
+
+    __slots__ = ("event_type", "tags", "emojis", "attributes", "labels")
+
+    def __init__(self, event_type):
+        """Initialize the update.
+
+        Args:
+            event_type: Document type in OpenSearch.
+        """
+        self.event_type = event_type
+        self.tags = None
+        self.emojis = None
+        self.attributes = None
+        self.labels = None
+
+    def add_tags(self, tags):
+        """Adds tags and returns the estimated size of the change."""
+        if self.tags is None:
+            self.tags = set()
+        new_tags = set(tags).difference(self.tags)
+        self.tags.update(new_tags)
+        return _estimate_size(new_tags)
+
+    def add_emojis(self, emojis):
+        """Adds emojis and returns the estimated size of the change."""
+        if self.emojis is None:
+            self.emojis = set()
+        new_emojis = set(emojis).difference(self.emojis)
+        self.emojis.update(new_emojis)
+        return _estimate_size(new_emojis)
+
+    def add_attributes(self, attributes):
+        """Sets attributes and returns the estimated size of the change."""
+        if self.attributes is None:
+            self.attributes = {}
+        self.attributes.update(attributes)
+        return _estimate_size(attributes)
+
+    def add_label(self, label, toggle=False):
+        """Adds a label change and returns the estimated size of the change.
+
+        Adding the same label twice is a no-op, while toggling a label twice
+        cancels out the two changes.
+
+        Args:
+            label: Dict with the name, user_id and sketch_id of the label.
+            toggle: If True the label is removed if the event has it already.
+
+        Returns:
+            Estimated size of the change in bytes.
+        """
+        if self.labels is None:
+            self.labels = []
+        change = {"timesketch_label": label, "toggle": toggle}
+        if change in self.labels:
+            if not toggle:
+                return 0
+            self.labels.remove(change)
+            return -_estimate_size(change)
+        self.labels.append(change)
+        return _estimate_size(change)
+
+    def merge(self, other):
+        """Adds the changes of another update to this update.
+
+        Args:
+            other: EventUpdate object with changes made after this update.
+        """
+        if other.attributes:
+            self.add_attributes(other.attributes)
+        if other.tags:
+            self.add_tags(other.tags)
+        if other.emojis:
+            self.add_emojis(other.emojis)
+        for change in other.labels or []:
+            self.add_label(change["timesketch_label"], toggle=change["toggle"])
+
+    def to_dict(self):
+        """Returns a JSON serializable dict with the changes."""
+        changes = {}
+        if self.attributes:
+            changes["attributes"] = self.attributes
+        if self.tags:
+            changes["tags"] = list(self.tags)
+        if self.emojis:
+            changes["emojis"] = list(self.emojis)
+        if self.labels:
+            changes["labels"] = self.labels
+        return changes
+
+    @classmethod
+    def from_dict(cls, event_type, changes):
+        """Creates an update from the output of to_dict.
+
+        Args:
+            event_type: Document type in OpenSearch.
+            changes: Dict with the changes.
+
+        Returns:
+            An EventUpdate object.
+        """
+        update = cls(event_type)
+        if changes.get("attributes"):
+            update.attributes = changes["attributes"]
+        if changes.get("tags"):
+            update.tags = set(changes["tags"])
+        if changes.get("emojis"):
+            update.emojis = set(changes["emojis"])
+        if changes.get("labels"):
+            update.labels = changes["labels"]
+        return update
+
+
+class EventUpdateSpillStore(object):
+    """A temporary on-disk store of event updates.
+
+    Updates are kept in a SQLite database, keyed by the index name and the
+    ID of the event. Updates of an event that is already in the store are
+    merged into the stored update.
+    """
+
+    # Stay below the SQLite limit of variables in a single statement.
+    BATCH_SIZE = 400
+
+    def __init__(self, directory=None):
+        """Initialize the store.
+
+        Args:
+            directory: Directory for the database file, defaults to the
+                system temporary directory.
+        """
+        file_descriptor, self._path = tempfile.mkstemp(
+            prefix="timesketch_updates_", suffix=".db", dir=directory or None
+        )
+        os.close(file_descriptor)
+        self._connection = sqlite3.connect(self._path)
+        self._connection.execute(
+            "CREATE TABLE event_update (index_name TEXT NOT NULL, "
+            "event_id TEXT NOT NULL, event_type TEXT, changes TEXT NOT NULL, "
+            "PRIMARY KEY (index_name, event_id))"
+        )
+        self._connection.commit()
+
+    def __len__(self):
+        """Returns the number of events in the store."""
+        (count,) = self._connection.execute(
+            "SELECT COUNT(*) FROM event_update"
+        ).fetchone()
+        return count
+
+    def add(self, updates):
+        """Adds updates to the store.
+
+        Args:
+            updates: Dict with tuples of index name and event ID as keys and
+                EventUpdate objects as values.
+        """
+        keys = list(updates)
+        for batch_start in range(0, len(keys), self.BATCH_SIZE):
+            batch = keys[batch_start : batch_start + self.BATCH_SIZE]
+            clauses = " OR ".join(["(index_name = ? AND event_id = ?)"] * len(batch))
+            rows = self._connection.execute(
+                "SELECT index_name, event_id, event_type, changes FROM "
+                "event_update WHERE {0:s}".format(clauses),
+                [value for key in batch for value in key],
+            )
+            stored = {
+                (index_name, event_id): EventUpdate.from_dict(
+                    event_type, json.loads(changes)
+                )
+                for index_name, event_id, event_type, changes in rows
+            }
+
+            values = []
+            for key in batch:
+                update = updates[key]
+                if key in stored:
+                    stored[key].merge(update)
+                    update = stored[key]
+                values.append(key + (update.event_type, json.dumps(update.to_dict())))
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO event_update VALUES (?, ?, ?, ?)", values
+            )
+        self._connection.commit()
+
+    def __iter__(self):
+        """Yields tuples of index name, event ID and EventUpdate objects."""
+        rows = self._connection.execute(
+            "SELECT index_name, event_id, event_type, changes FROM event_update"
+        )
+        for index_name, event_id, event_type, changes in rows:
+            yield index_name, event_id, EventUpdate.from_dict(
+                event_type, json.loads(changes)
+            )
+
+    def clear(self):
+        """Removes all updates from the store."""
+        self._connection.execute("DELETE FROM event_update")
+        self._connection.commit()
+
+    def close(self):
+        """Closes and removes the database file."""
+        self._connection.close()
+        os.remove(self._path)
+
+
+class EventUpdateBuffer(object):
+    """Buffer of changes analyzers make to events.
+
+    Changes are merged per event, keyed by the index name and the event ID,
+    so the memory used by the buffer depends on the number of changes and
+    not on the size of the events. Once the buffer grows above a memory
+    threshold the buffered changes are either sent to the datastore, or,
+    if a spill directory is set, moved to an on-disk store that is sent to
+    the datastore when the buffer is flushed.
+
+    Attributes:
+        size: Estimated memory used by the buffered changes in bytes.
+        flushed: Number of events with changes sent to the datastore.
+    """
+
+    DEFAULT_MAX_BYTES = 64 * 1024**2
+
+    # Estimated memory used by an EventUpdate object and its key.
+    UPDATE_SIZE = 300
+
+    def __init__(self, datastore, max_bytes=DEFAULT_MAX_BYTES, spill_directory=None):
+        """Initialize the buffer.
+
+        Args:
+            datastore: OpenSearch datastore client.
+            max_bytes: Memory threshold of the buffer in bytes.
+            spill_directory: Optional directory to move changes to once the
+                buffer is above the memory threshold. If not set changes are
+                sent to the datastore instead.
+        """
+        self._datastore = datastore
+        self._max_bytes = max_bytes
+        self._spill_directory = spill_directory
+        self._spill_store = None
+        self._updates = {}
+        self.size = 0
+        self.flushed = 0
+
+    def __len__(self):
+        """Returns the number of events with changes in memory."""
+        return len(self._updates)
+
+    def _get_update(self, index_name, event_id, event_type):
+        """Returns the update of an event, adding it if needed."""
+        key = (index_name, event_id)
+        update = self._updates.get(key)
+        if update is None:
+            update = EventUpdate(event_type)
+            self._updates[key] = update
+            self.size += self.UPDATE_SIZE + _estimate_size(event_id)
+        return update
+
+    def _check_size(self):
+        """Moves the buffered changes out of memory if the buffer is full."""
+        if self.size <= self._max_bytes:
+            return
+
+        if self._spill_directory is None:
+            self.flush()
+            return
+
+        if self._spill_store is None:
+            self._spill_store = EventUpdateSpillStore(self._spill_directory)
+        logger.debug(
+            "Moving changes of {0:d} events to disk.".format(len(self._updates))
+        )
+        self._spill_store.add(self._updates)
+        self._updates = {}
+        self.size = 0
+
+    def get(self, index_name, event_id):
+        """Returns the buffered changes of an event.
+
+        Args:
+            index_name: Name of the OpenSearch index of the event.
+            event_id: ID of the event.
+
+        Returns:
+            An EventUpdate object, or None if the event has no changes in
+            memory.
+        """
+        return self._updates.get((index_name, event_id))
+
+    def add_tags(self, index_name, event_id, event_type, tags):
+        """Adds tags to an event.
+
+        Args:
+            index_name: Name of the OpenSearch index of the event.
+            event_id: ID of the event.
+            event_type: Document type in OpenSearch.
+            tags: List of tags to add.
+        """
+        update = self._get_update(index_name, event_id, event_type)
+        self.size += update.add_tags(tags)
+        self._check_size()
+
+    def add_emojis(self, index_name, event_id, event_type, emojis):
+        """Adds emojis to an event.
+
+        Args:
+            index_name: Name of the OpenSearch index of the event.
+            event_id: ID of the event.
+            event_type: Document type in OpenSearch.
+            emojis: List of emojis to add.
+        """
+        update = self._get_update(index_name, event_id, event_type)
+        self.size += update.add_emojis(emojis)
+        self._check_size()
+
+    def add_attributes(self, index_name, event_id, event_type, attributes):
+        """Sets attributes of an event.
+
+        Args:
+            index_name: Name of the OpenSearch index of the event.
+            event_id: ID of the event.
+            event_type: Document type in OpenSearch.
+            attributes: Dict with the attributes to set.
+        """
+        update = self._get_update(index_name, event_id, event_type)
+        self.size += update.add_attributes(attributes)
+        self._check_size()
+
+    def add_label(self, index_name, event_id, event_type, label, toggle=False):
+        """Adds a label to an event.
+
+        Args:
+            index_name: Name of the OpenSearch index of the event.
+            event_id: ID of the event.
+            event_type: Document type in OpenSearch.
+            label: Dict with the name, user_id and sketch_id of the label.
+            toggle: If True the label is removed if the event has it already.
+        """
+        update = self._get_update(index_name, event_id, event_type)
+        self.size += update.add_label(label, toggle=toggle)
+        self._check_size()
+
+    def _import_update(self, index_name, event_id, update):
+        """Queues the changes of an event in the datastore."""
+        params = update.to_dict()
+        if not params:
+            return
+        self._datastore.import_event(
+            index_name,
+            update.event_type,
+            event_id=event_id,
+            event={"source": EVENT_UPDATE_SCRIPT, "lang": "painless", "params": params},
+        )
+
+    def flush(self):
+        """Sends all buffered changes to the datastore.
+
+        Returns:
+            Number of events with changes that were sent to the datastore.
+        """
+        count = 0
+        if self._spill_store is not None:
+            for index_name, event_id, update in self._spill_store:
+                key = (index_name, event_id)
+                if key in self._updates:
+                    update.merge(self._updates.pop(key))
+                self._import_update(index_name, event_id, update)
+                count += 1
+            self._spill_store.clear()
+
+        for (index_name, event_id), update in self._updates.items():
+            self._import_update(index_name, event_id, update)
+            count += 1
+        self._updates = {}
+        self.size = 0
+
+        if count:
+            self._datastore.flush_queued_events()
+        self.flushed += count
+        return count
+
+    def close(self):
+        """Flushes the buffer and removes the on-disk store, if any."""
+        try:
+            self.flush()
+        finally:
+            if self._spill_store is not None:
+                self._spill_store.close()
+                self._spill_store = None
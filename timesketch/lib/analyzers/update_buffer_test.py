@@ -0,0 +1,121 @@
+# Copyright 2022 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the buffer of event changes."""
+
+import tempfile
+
+import mock
+
+from timesketch.lib.analyzers import update_buffer
+from timesketch.lib.testlib import BaseTest
+
+
+class TestEventUpdate(BaseTest):
+    """Tests for the EventUpdate class."""
+
+    def test_merge(self):
+        """Test merging changes of the same event."""
+        label = {"name": "__ts_star", "user_id": 0, "sketch_id": 1}
+        update = update_buffer.EventUpdate("_doc")
+        update.add_tags(["a", "b"])
+        update.add_attributes({"x": 1})
+        update.add_label(label, toggle=True)
+
+        other = update_buffer.EventUpdate("_doc")
+        other.add_tags(["b", "c"])
+        other.add_emojis(["emoji"])
+        other.add_attributes({"x": 2, "y": 3})
+        other.add_label(label, toggle=True)
+        update.merge(other)
+
+        self.assertEqual(update.tags, {"a", "b", "c"})
+        self.assertEqual(update.emojis, {"emoji"})
+        self.assertEqual(update.attributes, {"x": 2, "y": 3})
+        # Toggling a label twice cancels out.
+        self.assertEqual(update.labels, [])
+        self.assertNotIn("labels", update.to_dict())
+
+        copy = update_buffer.EventUpdate.from_dict("_doc", update.to_dict())
+        self.assertEqual(copy.tags, update.tags)
+        self.assertEqual(copy.emojis, update.emojis)
+        self.assertEqual(copy.attributes, update.attributes)
+
+
+class TestEventUpdateBuffer(BaseTest):
+    """Tests for the EventUpdateBuffer class."""
+
+    @staticmethod
+    def _get_imported(datastore):
+        """Returns the changes sent to the datastore, by event ID."""
+        imported = {}
+        for call in datastore.import_event.call_args_list:
+            event = call[1]["event"]
+            imported[call[1]["event_id"]] = event["params"]
+        return imported
+
+    def test_flush(self):
+        """Test that changes are merged per event and flushed once."""
+        datastore = mock.Mock()
+        buffer = update_buffer.EventUpdateBuffer(datastore)
+        buffer.add_tags("index", "1", "_doc", ["a"])
+        buffer.add_tags("index", "1", "_doc", ["b"])
+        buffer.add_emojis("index", "2", "_doc", ["emoji"])
+        buffer.add_attributes("other", "1", "_doc", {"x": 1})
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(buffer.get("index", "1").tags, {"a", "b"})
+        datastore.import_event.assert_not_called()
+
+        self.assertEqual(buffer.flush(), 3)
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(buffer.size, 0)
+        self.assertEqual(datastore.import_event.call_count, 3)
+        datastore.flush_queued_events.assert_called_once()
+
+        event = datastore.import_event.call_args_list[0][1]["event"]
+        self.assertEqual(event["lang"], "painless")
+        self.assertEqual(event["source"], update_buffer.EVENT_UPDATE_SCRIPT)
+        self.assertEqual(sorted(event["params"]["tags"]), ["a", "b"])
+
+    def test_incremental_flush(self):
+        """Test that changes are flushed once above the memory threshold."""
+        datastore = mock.Mock()
+        buffer = update_buffer.EventUpdateBuffer(datastore, max_bytes=2000)
+        for event_id in range(20):
+            buffer.add_tags("index", str(event_id), "_doc", ["tag"])
+        self.assertGreater(datastore.import_event.call_count, 0)
+        self.assertLess(len(buffer), 20)
+
+        buffer.flush()
+        self.assertEqual(datastore.import_event.call_count, 20)
+
+    def test_spill(self):
+        """Test that changes above the memory threshold are moved to disk."""
+        datastore = mock.Mock()
+        with tempfile.TemporaryDirectory() as directory:
+            buffer = update_buffer.EventUpdateBuffer(
+                datastore, max_bytes=2000, spill_directory=directory
+            )
+            for event_id in range(20):
+                buffer.add_tags("index", str(event_id), "_doc", ["a"])
+            for event_id in range(20):
+                buffer.add_tags("index", str(event_id), "_doc", ["b"])
+            datastore.import_event.assert_not_called()
+
+            buffer.close()
+
+        imported = self._get_imported(datastore)
+        self.assertEqual(len(imported), 20)
+        self.assertEqual(datastore.import_event.call_count, 20)
+        for params in imported.values():
+            self.assertEqual(sorted(params["tags"]), ["a", "b"])
@@ -13,10 +13,17 @@
 # limitations under the License.
 """This file contains utilities for analyzers."""
 
+import copy
+import json
 import logging
 import re
 from six.moves import urllib_parse as urlparse
 
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python versions before 3.11.
+    import sre_parse
+
 import numpy
 
 from timesketch.lib.analyzers import interface
@@ -24,6 +31,13 @@ from timesketch.lib.analyzers import interface
 
 logger = logging.getLogger("timesketch.analyzer_utils")
 
+# Shortest word used in a regular expression prefilter, shorter words match
+# too many events to be of use.
+PREFILTER_MINIMUM_LENGTH = 3
+
+# Maximum number of words in a regular expression prefilter.
+PREFILTER_MAXIMUM_CLAUSES = 1000
+
 # Title and header text of a story that is common among browser
 # based analyzers.
 BROWSER_STORY_TITLE = "Browser Artifacts"
@@ -341,3 +355,236 @@ def compile_regular_expression(
         expression = None
 
     return expression
+
+
+def _get_required_literals(sub_pattern, literals):
+    """Collect the literal runs that a parsed regular expression requires.
+
+    Args:
+        sub_pattern: A parsed regular expression (sre_parse.SubPattern).
+        literals: List that literal strings are appended to.
+    """
+    current = []
+    for op, arguments in sub_pattern:
+        name = str(op)
+        if name == "LITERAL":
+            current.append(chr(arguments))
+            continue
+
+        if current:
+            literals.append("".join(current))
+            current = []
+
+        if name == "SUBPATTERN":
+            _get_required_literals(arguments[-1], literals)
+        elif name == "ATOMIC_GROUP":
+            _get_required_literals(arguments, literals)
+        elif name in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT"):
+            minimum, _, repeated = arguments
+            if minimum > 0:
+                _get_required_literals(repeated, literals)
+
+    if current:
+        literals.append("".join(current))
+
+
+def get_regex_literals(expression_string, flags=0):
+    """Returns literal strings that every match of an expression contains.
+
+    Only literals that are required by every match are returned, so literals
+    in alternations or optional parts of the expression are left out. This
+    can be used to narrow down which events a regular expression needs to
+    be run against, eg. with a datastore query. If no literals are returned
+    the expression can match events without any particular substring.
+
+    Args:
+        expression_string (str): The regular expression.
+        flags (int): Flags the expression is compiled with, eg. re.VERBOSE.
+
+    Returns:
+        A list of literal strings, empty if the expression can not be parsed.
+    """
+    try:
+        parsed = sre_parse.parse(expression_string, flags)
+    except (re.error, OverflowError, RecursionError):
+        return []
+
+    literals = []
+    _get_required_literals(parsed, literals)
+    return literals
+
+
+def get_regex_prefilter_words(expressions, minimum_length=PREFILTER_MINIMUM_LENGTH):
+    """Returns words that events need to contain to match any expression.
+
+    For each expression the longest alphanumeric word of the literals that
+    every match contains is picked. The words are lower case, to match the
+    terms of analyzed text fields.
+
+    Args:
+        expressions (list): Regular expressions, either strings or compiled
+            expressions.
+        minimum_length (int): Length of the shortest word to use.
+
+    Returns:
+        A sorted list of words, or None if any of the expressions can match
+        a value that contains none of the words.
+    """
+    words = set()
+    for expression in expressions:
+        if isinstance(expression, re.Pattern):
+            literals = get_regex_literals(expression.pattern, expression.flags)
+        else:
+            literals = get_regex_literals(expression)
+
+        expression_words = []
+        for literal in literals:
+            expression_words.extend(re.findall(r"[a-z0-9]+", literal.lower()))
+        if not expression_words:
+            return None
+        longest_word = max(expression_words, key=len)
+        if len(longest_word) < minimum_length:
+            return None
+        words.add(longest_word)
+
+    if not words:
+        return None
+    return sorted(words)
+
+
+def build_regex_prefilter(
+    field,
+    expressions,
+    minimum_length=PREFILTER_MINIMUM_LENGTH,
+    maximum_clauses=PREFILTER_MAXIMUM_CLAUSES,
+):
+    """Builds a query clause that matches all values expressions can match.
+
+    The query clause uses wildcard queries for words that every match of an
+    expression contains, so that events that can not match are left out by
+    the datastore. The query does not replace running the expressions, it
+    only narrows down the events they need to run against.
+
+    Args:
+        field (str): Name of the analyzed text field the expressions run
+            against.
+        expressions (list): Regular expressions, either strings or compiled
+            expressions.
+        minimum_length (int): Length of the shortest word to use.
+        maximum_clauses (int): Maximum number of words in the query.
+
+    Returns:
+        Dict with an OpenSearch query clause, or None if the expressions can
+        match events that the query would leave out.
+    """
+    words = get_regex_prefilter_words(expressions, minimum_length=minimum_length)
+    if not words or len(words) > maximum_clauses:
+        return None
+
+    return {
+        "bool": {
+            "should": [
+                {"wildcard": {field: {"value": "*{0:s}*".format(word)}}}
+                for word in words
+            ],
+            "minimum_should_match": 1,
+        }
+    }
+
+
+def add_regex_prefilter(field, expressions, query_string=None, query_dsl=None):
+    """Adds a prefilter for regular expressions to a query.
+
+    See build_regex_prefilter, the query is returned unchanged if no
+    prefilter can be built for the expressions.
+
+    Args:
+        field (str): Name of the analyzed text field the expressions run
+            against.
+        expressions (list): Regular expressions, either strings or compiled
+            expressions.
+        query_string (str): Query string to add the prefilter to.
+        query_dsl: Dict or JSON string with an OpenSearch DSL query to add
+            the prefilter to, used if there is no query string.
+
+    Returns:
+        A tuple with the query string and the query DSL.
+    """
+    prefilter = build_regex_prefilter(field, expressions)
+    if not prefilter:
+        return query_string, query_dsl
+
+    if query_string:
+        values = [
+            clause["wildcard"][field]["value"] for clause in prefilter["bool"]["should"]
+        ]
+        query_string = "({0:s}) AND {1:s}:({2:s})".format(
+            query_string, field, " OR ".join(values)
+        )
+        return query_string, query_dsl
+
+    if not query_dsl:
+        return query_string, query_dsl
+
+    if isinstance(query_dsl, str):
+        query_dsl = json.loads(query_dsl)
+    else:
+        query_dsl = copy.deepcopy(query_dsl)
+
+    query = query_dsl.get("query") or {"match_all": {}}
+    query_dsl["query"] = {"bool": {"must": [query], "filter": [prefilter]}}
+    return query_string, query_dsl
+
+
+class SuffixTrie(object):
+    """A trie of reversed strings to check for suffixes.
+
+    This is used to check whether a string ends with any string from a list
+    of strings, eg. whether a domain is a sub domain of any of a list of
+    domains, in time that depends on the length of the string and not on
+    the number of strings in the list.
+    """
+
+    # Marks the end of an inserted string in a node.
+    _END = ""
+
+    def __init__(self, values=None):
+        """Initialize the trie.
+
+        Args:
+            values: optional iterable of strings to add to the trie.
+        """
+        self._root = {}
+        for value in values or []:
+            self.add(value)
+
+    def add(self, value):
+        """Add a string to the trie.
+
+        Args:
+            value: the string to add.
+        """
+        node = self._root
+        for char in reversed(value):
+            node = node.setdefault(char, {})
+        node[self._END] = True
+
+    def has_suffix(self, value):
+        """Check whether a string ends with any string in the trie.
+
+        Args:
+            value: the string to check.
+
+        Returns:
+            True if any of the strings in the trie is a suffix of the value.
+        """
+        node = self._root
+        if self._END in node:
+            return True
+        for char in reversed(value):
+            node = node.get(char)
+            if node is None:
+                return False
+            if self._END in node:
+                return True
+        return False
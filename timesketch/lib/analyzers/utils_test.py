@@ -15,6 +15,8 @@
 
 from __future__ import unicode_literals
 
+import re
+
 import six
 
 import pandas as pd
@@ -68,6 +70,17 @@ class TestAnalyzerUtils(BaseTest):
         self.assertIsInstance(provider, six.text_type)
         self.assertEqual(provider, "")
 
+    def test_suffix_trie(self):
+        """Test the SuffixTrie class."""
+        trie = utils.SuffixTrie([".google.com", "github.io"])
+        self.assertTrue(trie.has_suffix("mail.google.com"))
+        self.assertTrue(trie.has_suffix("mygithub.io"))
+        self.assertFalse(trie.has_suffix("google.com"))
+        self.assertFalse(trie.has_suffix("mbl.is"))
+
+        trie.add("mbl.is")
+        self.assertTrue(trie.has_suffix("mbl.is"))
+
     def test_get_events_from_data_frame(self):
         """Test getting all events from data frame."""
         lines = [
@@ -107,3 +120,48 @@ class TestAnalyzerUtils(BaseTest):
             expression_parameters=re_parameters,
         )
         self.assertTrue(expression.match(string_test))
+
+    def test_get_regex_literals(self):
+        """Test get_regex_literals function."""
+        self.assertEqual(utils.get_regex_literals(r"baddomain\.com"), ["baddomain.com"])
+        self.assertEqual(utils.get_regex_literals(r"ab?cde"), ["a", "cde"])
+        self.assertEqual(utils.get_regex_literals(r"(foo|bar)[0-9]+\.exe"), [".exe"])
+        self.assertEqual(utils.get_regex_literals(r"(?:evil)+"), ["evil"])
+        self.assertEqual(utils.get_regex_literals(r"x*[ab]"), [])
+        self.assertEqual(utils.get_regex_literals(r"(unbalanced"), [])
+        self.assertEqual(
+            utils.get_regex_literals("evil # comment", re.VERBOSE), ["evil"]
+        )
+
+    def test_add_regex_prefilter(self):
+        """Test adding a prefilter for regular expressions to a query."""
+        expressions = [r"bing\.com/search", re.compile(r"Mail\.Google\.com", re.I)]
+        self.assertEqual(
+            utils.get_regex_prefilter_words(expressions), ["google", "search"]
+        )
+
+        query_string, query_dsl = utils.add_regex_prefilter(
+            "url", expressions, query_string="source_short:WEBHIST"
+        )
+        self.assertEqual(
+            query_string, "(source_short:WEBHIST) AND url:(*google* OR *search*)"
+        )
+        self.assertIsNone(query_dsl)
+
+        query_string, query_dsl = utils.add_regex_prefilter(
+            "url", expressions, query_dsl='{"query": {"match_all": {}}}'
+        )
+        self.assertIsNone(query_string)
+        self.assertEqual(query_dsl["query"]["bool"]["must"], [{"match_all": {}}])
+        self.assertEqual(
+            query_dsl["query"]["bool"]["filter"][0]["bool"]["should"][0],
+            {"wildcard": {"url": {"value": "*google*"}}},
+        )
+
+        # Without a required word the query is left as is.
+        self.assertEqual(
+            utils.add_regex_prefilter(
+                "url", expressions + [r"[a-z]+\.ru"], query_string="*"
+            ),
+            ("*", None),
+        )
@@ -71,7 +71,13 @@ class EvtxGapPlugin(interface.BaseAnalyzer):
 
         # Generator of events based on your query.
         event_frame = self.event_pandas(
-            query_string=query, indices=[self.index_name], return_fields=return_fields
+            query_string=query,
+            indices=[self.index_name],
+            return_fields=return_fields,
+            frame_options={
+                "categorical_fields": ["source_name"],
+                "datetime_fields": ["datetime"],
+            },
         )
 
         if not event_frame.shape[0]:
@@ -8,6 +8,7 @@ import requests
 
 from timesketch.lib.analyzers import interface
 from timesketch.lib.analyzers import manager
+from timesketch.lib.analyzers import utils
 from timesketch.lib import emojis
 
 
@@ -20,6 +21,12 @@ class YetiIndicators(interface.BaseAnalyzer):
 
     DEPENDENCIES = frozenset(["domain"])
 
+    # Shortest substring of an indicator that is used to narrow down the
+    # events to search with a query, and the maximum number of those
+    # substrings in a single query.
+    MINIMUM_PREFILTER_LENGTH = 3
+    MAXIMUM_PREFILTER_CLAUSES = 1000
+
     def __init__(self, index_name, sketch_id, timeline_id=None):
         """Initialize the Analyzer.
 
@@ -30,6 +37,7 @@ class YetiIndicators(interface.BaseAnalyzer):
         """
         super().__init__(index_name, sketch_id, timeline_id=timeline_id)
         self.intel = {}
+        self._neighbors_cache = {}
         self.yeti_api_root = current_app.config.get("YETI_API_ROOT")
         self.yeti_api_key = current_app.config.get("YETI_API_KEY")
 
@@ -55,6 +63,20 @@ class YetiIndicators(interface.BaseAnalyzer):
 
         return neighbors
 
+    def get_cached_neighbors(self, entity_id):
+        """Retrieves the neighbors of an entity, looking each entity up once.
+
+        Args:
+          entity_id (str): STIX ID of the entity to get associated inticators
+                from.
+
+        Returns:
+          A list of JSON objects describing a Yeti object.
+        """
+        if entity_id not in self._neighbors_cache:
+            self._neighbors_cache[entity_id] = self.get_neighbors(entity_id)
+        return self._neighbors_cache[entity_id]
+
     def get_indicators(self, indicator_type):
         """Populates the intel attribute with entities from Yeti."""
         results = requests.post(
@@ -69,6 +91,104 @@ class YetiIndicators(interface.BaseAnalyzer):
             item["compiled_regexp"] = re.compile(item["pattern"])
             self.intel[item["id"]] = item
 
+    def build_matcher(self):
+        """Compiles all indicators into combined regular expressions.
+
+        The first expression is an alternation of all indicators, that finds
+        the offsets where any indicator matches. The second expression has
+        an optional lookahead per indicator, each with a named group, so
+        matching it at an offset captures every indicator that matches
+        there. Indicators that can not be combined, eg. because they contain
+        back references, named groups or global flags, are matched one by
+        one.
+
+        Returns:
+            Tuple with the alternation and the lookahead expression (both
+            None if no indicators could be combined), a dict mapping group
+            names to indicator IDs and a list of indicators to match one
+            by one.
+        """
+        group_indicators = {}
+        alternatives = []
+        lookaheads = []
+        separate_indicators = []
+        for index, (indicator_id, indicator) in enumerate(self.intel.items()):
+            pattern = indicator["pattern"]
+            group_name = "indicator{0:d}".format(index)
+            alternative = "(?:{0:s})".format(pattern)
+            lookahead = "(?:(?=(?P<{0:s}>{1:s}))|)".format(group_name, pattern)
+            if re.search(r"\\[0-9]|\(\?P[<=]|\(\?[aiLmsux]+\)", pattern):
+                separate_indicators.append(indicator)
+                continue
+            try:
+                re.compile(alternative)
+                re.compile(lookahead)
+            except re.error:
+                separate_indicators.append(indicator)
+                continue
+            group_indicators[group_name] = indicator_id
+            alternatives.append(alternative)
+            lookaheads.append(lookahead)
+
+        if not alternatives:
+            return None, None, group_indicators, separate_indicators
+        return (
+            re.compile("|".join(alternatives)),
+            re.compile("".join(lookaheads)),
+            group_indicators,
+            separate_indicators,
+        )
+
+    @staticmethod
+    def get_matching_indicators(message, matcher, offset_matcher, group_indicators):
+        """Returns the IDs of the combined indicators that match a message.
+
+        The alternation is searched from each offset after the previous
+        match, so overlapping matches are found, and the lookahead expression
+        collects all indicators that match at each of those offsets.
+
+        Args:
+            message: String to match the indicators against.
+            matcher: Compiled alternation of the indicators.
+            offset_matcher: Compiled lookahead expression of the indicators.
+            group_indicators: Dict mapping group names to indicator IDs.
+
+        Returns:
+            Set with the IDs of the matching indicators.
+        """
+        indicator_ids = set()
+        match = matcher.search(message)
+        while match:
+            offset = match.start()
+            groups = offset_matcher.match(message, offset).groupdict()
+            for group_name, value in groups.items():
+                if value is not None:
+                    indicator_ids.add(group_indicators[group_name])
+            if len(indicator_ids) == len(group_indicators) or offset >= len(message):
+                break
+            match = matcher.search(message, offset + 1)
+        return indicator_ids
+
+    def build_prefilter_query(self):
+        """Builds a query that matches all events that indicators can match.
+
+        The query looks for the longest alphanumeric part of a literal
+        substring that every match of an indicator contains.
+
+        Returns:
+            Dict with an OpenSearch DSL query or None if the indicators can
+            match events that the query would leave out.
+        """
+        prefilter = utils.build_regex_prefilter(
+            "message",
+            [indicator["pattern"] for indicator in self.intel.values()],
+            minimum_length=self.MINIMUM_PREFILTER_LENGTH,
+            maximum_clauses=self.MAXIMUM_PREFILTER_CLAUSES,
+        )
+        if not prefilter:
+            return None
+        return {"query": prefilter}
+
     def mark_event(self, indicator, event, neighbors):
         """Anotate an event with data from indicators and neighbors.
 
@@ -102,27 +222,49 @@ class YetiIndicators(interface.BaseAnalyzer):
         self.get_indicators("x-regex")
 
         entities_found = set()
+        (
+            matcher,
+            offset_matcher,
+            group_indicators,
+            separate_indicators,
+        ) = self.build_matcher()
+
+        query_dsl = self.build_prefilter_query()
+        if query_dsl:
+            events = self.event_stream(query_dsl=query_dsl, return_fields=["message"])
+        else:
+            events = self.event_stream(query_string="*", return_fields=["message"])
 
-        events = self.event_stream(query_string="*", return_fields=["message"])
         total_matches = 0
         matching_indicators = set()
         for event in events:
+            message = event.source.get("message", "")
+            indicator_ids = set()
+            if matcher:
+                indicator_ids = self.get_matching_indicators(
+                    message, matcher, offset_matcher, group_indicators
+                )
+
+            for indicator in separate_indicators:
+                if indicator["compiled_regexp"].search(message):
+                    indicator_ids.add(indicator["id"])
+
             for _id, indicator in self.intel.items():
-                regexp = indicator["compiled_regexp"]
-                if regexp.search(event.source["message"]):
-                    total_matches += 1
-                    matching_indicators.add(indicator["id"])
-                    neighbors = self.get_neighbors(indicator["id"])
-                    self.mark_event(indicator, event, neighbors)
-                    for n in neighbors:
-                        entities_found.add("{0:s}:{1:s}".format(n["name"], n["type"]))
+                if _id not in indicator_ids:
+                    continue
+                total_matches += 1
+                matching_indicators.add(indicator["id"])
+                neighbors = self.get_cached_neighbors(indicator["id"])
+                self.mark_event(indicator, event, neighbors)
+                for n in neighbors:
+                    entities_found.add("{0:s}:{1:s}".format(n["name"], n["type"]))
 
         if not total_matches:
             return "No indicators were found in the timeline."
 
         for entity in entities_found:
             name, _type = entity.split(":")
-            self.sketch.add_view(
+            self.sketch.queue_view(
                 "Indicator matches for {0:s} ({1:s})".format(name, _type),
                 self.NAME,
                 query_string='tag:"{0:s}"'.format(name),
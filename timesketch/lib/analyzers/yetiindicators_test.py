@@ -106,3 +106,68 @@ class TestThreatintelPlugin(BaseTest):
         )
         # The name of the entity is "Random incident"
         mock_event.add_tags.assert_called_once_with(["random-incident"])
+
+    @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
+    def test_build_matcher(self):
+        """Test that indicators are combined into a single expression."""
+        analyzer = yetiindicators.YetiIndicators("test_index", 1)
+        analyzer.intel = {
+            "a": {"id": "a", "pattern": "baddomain\\.com"},
+            "b": {"id": "b", "pattern": "(evil|bad)\\.exe"},
+            "c": {"id": "c", "pattern": "(x)\\1"},
+        }
+        analyzer.intel["d"] = {"id": "d", "pattern": "bad"}
+        analyzer.intel["e"] = {"id": "e", "pattern": "domain\\.c"}
+        (
+            matcher,
+            offset_matcher,
+            group_indicators,
+            separate,
+        ) = analyzer.build_matcher()
+        self.assertEqual([indicator["id"] for indicator in separate], ["c"])
+
+        # Indicators that match at the same offset or inside the match of
+        # another indicator are all found.
+        match_ids = analyzer.get_matching_indicators(
+            "bad.exe from baddomain.com", matcher, offset_matcher, group_indicators
+        )
+        self.assertEqual(match_ids, {"a", "b", "d", "e"})
+        match_ids = analyzer.get_matching_indicators(
+            "good.exe", matcher, offset_matcher, group_indicators
+        )
+        self.assertEqual(match_ids, set())
+
+    @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
+    def test_build_prefilter_query(self):
+        """Test that a prefilter query is built from indicator literals."""
+        analyzer = yetiindicators.YetiIndicators("test_index", 1)
+        analyzer.intel = {
+            "a": {"id": "a", "pattern": "baddomain\\.com"},
+            "b": {"id": "b", "pattern": "(evil|bad)\\.Exe[0-9]+"},
+        }
+        query_dsl = analyzer.build_prefilter_query()
+        self.assertEqual(
+            query_dsl["query"]["bool"]["should"],
+            [
+                {"wildcard": {"message": {"value": "*baddomain*"}}},
+                {"wildcard": {"message": {"value": "*exe*"}}},
+            ],
+        )
+
+        # Without a literal substring no events can be left out.
+        analyzer.intel["c"] = {"id": "c", "pattern": "[a-z]+\\.ru"}
+        self.assertIsNone(analyzer.build_prefilter_query())
+
+    @mock.patch("timesketch.lib.analyzers.interface.OpenSearchDataStore", MockDataStore)
+    @mock.patch(
+        "timesketch.lib.analyzers.yetiindicators." "YetiIndicators.get_neighbors"
+    )
+    def test_cached_neighbors(self, mock_get_neighbors):
+        """Test that neighbors are only looked up once per entity."""
+        analyzer = yetiindicators.YetiIndicators("test_index", 1)
+        mock_get_neighbors.return_value = MOCK_YETI_NEIGHBORS
+        for _ in range(3):
+            self.assertEqual(
+                analyzer.get_cached_neighbors("x-regex--1"), MOCK_YETI_NEIGHBORS
+            )
+        mock_get_neighbors.assert_called_once_with("x-regex--1")
@@ -156,6 +156,14 @@ class DataFinder:
                 expression_flags=self._rule.get("re_flags"),
                 expression_parameters=self._rule.get("re_parameters"),
             )
+            if expression:
+                # Only fetch events the regular expression can match.
+                query_string, query_dsl = utils.add_regex_prefilter(
+                    attribute,
+                    [expression],
+                    query_string=query_string,
+                    query_dsl=query_dsl,
+                )
         else:
             expression = None
 
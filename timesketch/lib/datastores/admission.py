@@ -0,0 +1,280 @@
+# Copyright 2022 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Admission control of searches, based on their cost and concurrency."""
+
+import collections
+import re
+import threading
+import time
+
+import prometheus_client
+
+from timesketch.lib.definitions import METRICS_NAMESPACE
+from timesketch.lib.errors import SearchRejectedError
+
+
+# Metrics definitions
+METRICS = {
+    "search_admission": prometheus_client.Counter(
+        "search_admission",
+        "Number of searches per admission result (admitted, cost, concurrency)",
+        ["result"],
+        namespace=METRICS_NAMESPACE,
+    ),
+    "search_cost": prometheus_client.Histogram(
+        "search_cost",
+        "Estimated cost of searches",
+        buckets=[1, 10, 100, 1000, 10000, 100000],
+        namespace=METRICS_NAMESPACE,
+    ),
+}
+
+# Factor of the cost of queries with leading wildcards or regular
+# expressions, that need to look at every term of a field.
+EXPENSIVE_QUERY_FACTOR = 10
+# Number of buckets that add the cost of a full scan to an aggregation.
+AGGREGATION_BUCKETS_PER_SCAN = 1000
+# Default number of buckets of aggregations without a size.
+DEFAULT_AGGREGATION_BUCKETS = 10
+# Seconds the document count of indices is cached.
+DOCUMENT_COUNT_TTL = 300
+
+# Leading wildcards and regular expressions in a query string.
+EXPENSIVE_QUERY_STRING_RE = re.compile(r"(?:^|[\s:(])(?:[*?][^\s*?]|/)")
+AGGREGATION_KEYS = frozenset(["aggs", "aggregations"])
+
+_document_counts = {}
+_document_counts_lock = threading.Lock()
+
+
+def _is_expensive_query(query_dsl):
+    """Returns whether a query has leading wildcards or regular expressions.
+
+    Args:
+        query_dsl: Dict or list with (part of) an OpenSearch query.
+    """
+    if isinstance(query_dsl, list):
+        return any(_is_expensive_query(item) for item in query_dsl)
+    if not isinstance(query_dsl, dict):
+        return False
+
+    for key, value in query_dsl.items():
+        if key in AGGREGATION_KEYS:
+            continue
+        if key == "regexp":
+            return True
+        if key == "wildcard" and isinstance(value, dict):
+            for pattern in value.values():
+                if isinstance(pattern, dict):
+                    pattern = pattern.get("value", pattern.get("wildcard", ""))
+                if str(pattern)[:1] in ("*", "?"):
+                    return True
+        if key == "query_string" and isinstance(value, dict):
+            if EXPENSIVE_QUERY_STRING_RE.search(value.get("query", "")):
+                return True
+        if _is_expensive_query(value):
+            return True
+    return False
+
+
+def _count_aggregation_buckets(aggregations):
+    """Returns the number of buckets that aggregations can create.
+
+    Buckets of nested aggregations are multiplied by the buckets of the
+    aggregation they are nested in.
+
+    Args:
+        aggregations: Dict with OpenSearch aggregations, keyed by name.
+    """
+    buckets = 0
+    for spec in (aggregations or {}).values():
+        if not isinstance(spec, dict):
+            continue
+        size = 1
+        for key, value in spec.items():
+            if key in AGGREGATION_KEYS or not isinstance(value, dict):
+                continue
+            size = value.get("size", value.get("buckets", DEFAULT_AGGREGATION_BUCKETS))
+            if not isinstance(size, int):
+                size = DEFAULT_AGGREGATION_BUCKETS
+        nested = spec.get("aggs") or spec.get("aggregations")
+        buckets += size * (1 + _count_aggregation_buckets(nested))
+    return buckets
+
+
+def estimate_search_cost(query_dsl, document_count):
+    """Estimates the cost of a search.
+
+    The cost is the number of documents in the searched indices in
+    millions, multiplied when the query has leading wildcards or regular
+    expressions and when aggregations create many buckets.
+
+    Args:
+        query_dsl: Dict with the OpenSearch query, including aggregations.
+        document_count: Number of documents in the searched indices.
+
+    Returns:
+        Float with the estimated cost of the search.
+    """
+    query_dsl = query_dsl or {}
+    cost = max(document_count, 1) / 10**6
+
+    query = query_dsl.get("query", {})
+    if _is_expensive_query(query):
+        cost *= EXPENSIVE_QUERY_FACTOR
+
+    aggregations = query_dsl.get("aggregations") or query_dsl.get("aggs")
+    buckets = _count_aggregation_buckets(aggregations)
+    if buckets:
+        cost *= 1 + buckets / AGGREGATION_BUCKETS_PER_SCAN
+    return cost
+
+
+def get_document_count(datastore, indices):
+    """Returns the number of documents in indices, cached for a while.
+
+    Args:
+        datastore: OpenSearch datastore.
+        indices: List of index names.
+    """
+    key = tuple(sorted(set(indices)))
+    now = time.time()
+    with _document_counts_lock:
+        cached = _document_counts.get(key)
+    if cached and now - cached[1] < DOCUMENT_COUNT_TTL:
+        return cached[0]
+
+    document_count, _ = datastore.count(list(key))
+    with _document_counts_lock:
+        _document_counts[key] = (document_count, now)
+    return document_count
+
+
+class ConcurrencyLimiter(object):
+    """Limits the number of searches that run at the same time per user.
+
+    The limit applies within one process, eg. a single web server worker.
+    """
+
+    def __init__(self):
+        """Initialize the limiter."""
+        self._lock = threading.Lock()
+        self._running = collections.Counter()
+
+    def acquire(self, username, limit):
+        """Registers a search of a user, if the user is below the limit.
+
+        Args:
+            username: Name of the user.
+            limit: Number of searches a user can run at the same time.
+
+        Returns:
+            Boolean indicating whether the search can run.
+        """
+        with self._lock:
+            if self._running[username] >= limit:
+                return False
+            self._running[username] += 1
+            return True
+
+    def release(self, username):
+        """Registers that a search of a user has finished.
+
+        Args:
+            username: Name of the user.
+        """
+        with self._lock:
+            self._running[username] -= 1
+            if self._running[username] <= 0:
+                del self._running[username]
+
+    def running(self, username):
+        """Returns the number of searches a user is running."""
+        with self._lock:
+            return self._running[username]
+
+
+_limiter = ConcurrencyLimiter()
+
+
+class SearchAdmission(object):
+    """Context manager that admits a search, or raises SearchRejectedError.
+
+    Attributes:
+        cost: Estimated cost of the search, or None if it was not estimated.
+    """
+
+    def __init__(
+        self, datastore, indices, query_dsl, username, max_cost=0, max_concurrent=0
+    ):
+        """Initialize the admission.
+
+        Args:
+            datastore: OpenSearch datastore.
+            indices: List of indices to search.
+            query_dsl: Dict with the OpenSearch query, including aggregations.
+            username: Name of the user running the search, searches without
+                a user are always admitted.
+            max_cost: Maximum estimated cost of a search, 0 for no limit.
+            max_concurrent: Maximum number of searches a user can run at the
+                same time, 0 for no limit.
+        """
+        self.cost = None
+        self._datastore = datastore
+        self._indices = indices
+        self._query_dsl = query_dsl
+        self._username = username
+        self._max_cost = max_cost
+        self._max_concurrent = max_concurrent
+        self._acquired = False
+
+    def __enter__(self):
+        """Checks the cost and concurrency of the search."""
+        if not self._username:
+            return self
+
+        if self._max_cost:
+            document_count = get_document_count(self._datastore, self._indices)
+            self.cost = estimate_search_cost(self._query_dsl, document_count)
+            METRICS["search_cost"].observe(self.cost)
+            if self.cost > self._max_cost:
+                METRICS["search_admission"].labels(result="cost").inc()
+                raise SearchRejectedError(
+                    "The search is too expensive (estimated cost {0:.0f}, the "
+                    "maximum is {1:.0f}). Narrow down the query, search fewer "
+                    "timelines or avoid leading wildcards and regular "
+                    "expressions.".format(self.cost, self._max_cost),
+                    reason="cost",
+                )
+
+        if self._max_concurrent:
+            if not _limiter.acquire(self._username, self._max_concurrent):
+                METRICS["search_admission"].labels(result="concurrency").inc()
+                raise SearchRejectedError(
+                    "Too many searches running at the same time, the maximum "
+                    "is {0:d}. Try again when a search has finished.".format(
+                        self._max_concurrent
+                    ),
+                    reason="concurrency",
+                )
+            self._acquired = True
+
+        METRICS["search_admission"].labels(result="admitted").inc()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        """Releases the concurrency slot of the search."""
+        if self._acquired:
+            _limiter.release(self._username)
+            self._acquired = False
@@ -0,0 +1,111 @@
+# Copyright 2022 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the admission control of searches."""
+
+import mock
+
+from timesketch.lib.datastores import admission
+from timesketch.lib.errors import SearchRejectedError
+from timesketch.lib.testlib import BaseTest
+
+
+def _get_datastore(document_count):
+    """Returns a mock datastore with a number of documents."""
+    datastore = mock.Mock()
+    datastore.count.return_value = (document_count, 0)
+    return datastore
+
+
+class TestAdmission(BaseTest):
+    """Tests for the admission control of searches."""
+
+    def setUp(self):
+        super().setUp()
+        admission._document_counts.clear()  # pylint: disable=protected-access
+
+    def test_estimate_search_cost(self):
+        """Test the cost of wildcards, regular expressions and aggregations."""
+        simple = {"query": {"query_string": {"query": "message:foo*"}}}
+        self.assertEqual(admission.estimate_search_cost(simple, 2 * 10**6), 2)
+
+        leading_wildcard = {"query": {"query_string": {"query": "message:*foo"}}}
+        self.assertEqual(
+            admission.estimate_search_cost(leading_wildcard, 2 * 10**6), 20
+        )
+
+        regexp = {"query": {"bool": {"must": [{"regexp": {"message": "fo+"}}]}}}
+        self.assertEqual(admission.estimate_search_cost(regexp, 10**6), 10)
+
+        aggregation = {
+            "query": {"match_all": {}},
+            "aggs": {
+                "users": {
+                    "terms": {"field": "username", "size": 1000},
+                    "aggs": {"hosts": {"terms": {"field": "hostname", "size": 9}}},
+                }
+            },
+        }
+        # 1000 users with 9 hosts each are 10000 buckets, or 10 extra scans.
+        self.assertEqual(admission.estimate_search_cost(aggregation, 10**6), 11)
+
+    def test_concurrency_limiter(self):
+        """Test that the limiter counts the searches of each user."""
+        limiter = admission.ConcurrencyLimiter()
+        self.assertTrue(limiter.acquire("alice", 2))
+        self.assertTrue(limiter.acquire("alice", 2))
+        self.assertFalse(limiter.acquire("alice", 2))
+        self.assertTrue(limiter.acquire("bob", 2))
+        self.assertEqual(limiter.running("alice"), 2)
+
+        limiter.release("alice")
+        self.assertTrue(limiter.acquire("alice", 2))
+        limiter.release("bob")
+        self.assertEqual(limiter.running("bob"), 0)
+
+    def test_search_admission(self):
+        """Test that expensive and concurrent searches are rejected."""
+        query_dsl = {"query": {"regexp": {"message": ".*"}}}
+        datastore = _get_datastore(5 * 10**6)
+
+        with self.assertRaises(SearchRejectedError) as context:
+            with admission.SearchAdmission(
+                datastore, ["test"], query_dsl, "alice", max_cost=10
+            ):
+                pass
+        self.assertEqual(context.exception.reason, "cost")
+
+        # Searches without a user, eg. of analyzers, are always admitted.
+        with admission.SearchAdmission(
+            datastore, ["test"], query_dsl, None, max_cost=10, max_concurrent=1
+        ) as search:
+            self.assertIsNone(search.cost)
+
+        with admission.SearchAdmission(
+            datastore, ["test"], {}, "alice", max_cost=10, max_concurrent=1
+        ) as search:
+            self.assertEqual(search.cost, 5)
+            with self.assertRaises(SearchRejectedError) as context:
+                with admission.SearchAdmission(
+                    datastore, ["test"], {}, "alice", max_concurrent=1
+                ):
+                    pass
+            self.assertEqual(context.exception.reason, "concurrency")
+
+        # The slot is released when the search is done and the document
+        # count of the indices is cached.
+        with admission.SearchAdmission(
+            datastore, ["test"], {}, "alice", max_cost=10, max_concurrent=1
+        ):
+            pass
+        datastore.count.assert_called_once_with(["test"])
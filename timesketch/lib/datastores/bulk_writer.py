@@ -0,0 +1,370 @@
+# Copyright 2022 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Background writer of OpenSearch bulk requests."""
+
+from collections import Counter
+import logging
+import queue
+import random
+import socket
+import threading
+import time
+
+from opensearchpy.exceptions import ConnectionTimeout
+import prometheus_client
+
+from timesketch.lib.definitions import METRICS_NAMESPACE
+
+
+es_logger = logging.getLogger("timesketch.opensearch")
+
+# Metrics definitions
+METRICS = {
+    "bulk_request_bytes": prometheus_client.Histogram(
+        "bulk_request_bytes",
+        "Size of bulk requests in bytes",
+        ["task_type"],
+        buckets=[2**exponent for exponent in range(14, 28, 2)],
+        namespace=METRICS_NAMESPACE,
+    ),
+    "bulk_request_duration": prometheus_client.Histogram(
+        "bulk_request_duration_seconds",
+        "Duration of bulk requests",
+        ["task_type"],
+        buckets=[0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 180],
+        namespace=METRICS_NAMESPACE,
+    ),
+    "bulk_actions": prometheus_client.Counter(
+        "bulk_actions",
+        "Number of bulk actions per result (indexed, rejected or failed)",
+        ["task_type", "result"],
+        namespace=METRICS_NAMESPACE,
+    ),
+}
+
+
+class BulkWriter(object):
+    """Sends bulk actions to OpenSearch from a background thread.
+
+    Actions are collected into a batch that is handed to a background
+    thread once it holds enough actions or bytes, or once it has been
+    waiting for longer than the flush interval. Only a few batches can be
+    waiting to be sent at any time, adding actions blocks while the queue
+    is full. Actions rejected by an overloaded cluster (HTTP status 429) are
+    retried with exponential backoff, all other failed actions, including
+    the actions of batches that could not be sent at all, are passed to the
+    error callback.
+
+    Attributes:
+        counters: Counter with the number of bulk requests, actions that
+            were indexed, retried and failed, bytes sent and the time spent
+            in bulk requests.
+        task_type: Type of the task that adds actions, used to label
+            metrics, eg. csv or analyzer.
+    """
+
+    DEFAULT_MAX_ACTIONS = 1000
+    DEFAULT_MAX_BYTES = 10 * 1024**2
+    DEFAULT_FLUSH_INTERVAL = 5.0  # Seconds a batch waits before it is sent.
+    DEFAULT_QUEUE_SIZE = 4  # Batches waiting to be sent.
+    DEFAULT_MAX_RETRIES = 5
+    DEFAULT_INITIAL_BACKOFF = 1.0  # Seconds to wait before the first retry.
+    DEFAULT_MAX_BACKOFF = 60.0
+
+    # HTTP status of actions rejected due to a full queue in the cluster.
+    RETRY_STATUS = 429
+
+    def __init__(
+        self,
+        client,
+        request_timeout=None,
+        error_callback=None,
+        max_actions=DEFAULT_MAX_ACTIONS,
+        max_bytes=DEFAULT_MAX_BYTES,
+        flush_interval=DEFAULT_FLUSH_INTERVAL,
+        queue_size=DEFAULT_QUEUE_SIZE,
+        max_retries=DEFAULT_MAX_RETRIES,
+        initial_backoff=DEFAULT_INITIAL_BACKOFF,
+        max_backoff=DEFAULT_MAX_BACKOFF,
+    ):
+        """Initialize the writer.
+
+        Args:
+            client: OpenSearch client.
+            request_timeout: Timeout of a bulk request in OpenSearch.
+            error_callback: Function called with the result of each action
+                that failed.
+            max_actions: Number of actions in a batch before it is sent.
+            max_bytes: Size of a batch in bytes before it is sent.
+            flush_interval: Seconds a batch waits before it is sent.
+            queue_size: Number of batches that can wait to be sent.
+            max_retries: Number of times an action is retried.
+            initial_backoff: Seconds to wait before the first retry.
+            max_backoff: Maximum number of seconds to wait between retries.
+        """
+        self._client = client
+        self._serializer = client.transport.serializer
+        self._request_timeout = request_timeout
+        self._error_callback = error_callback
+        self._max_actions = max_actions
+        self._max_bytes = max_bytes
+        self._flush_interval = flush_interval
+        self._max_retries = max_retries
+        self._initial_backoff = initial_backoff
+        self._max_backoff = max_backoff
+
+        self._lock = threading.Lock()
+        # Held while a batch that is not in the queue is sent.
+        self._send_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_started = 0.0
+
+        self.counters = Counter()
+        self.task_type = "web"
+
+    def _take_batch(self):
+        """Returns the current batch and starts a new one, hold the lock."""
+        batch = self._batch
+        self._batch = []
+        self._batch_bytes = 0
+        return batch
+
+    def _ensure_thread(self):
+        """Starts the background thread if it is not running."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="opensearch-bulk-writer", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        """Sends batches until there is nothing left to send."""
+        while True:
+            try:
+                batch = self._queue.get(timeout=self._flush_interval)
+            except queue.Empty:
+                with self._lock:
+                    if not self._batch:
+                        if self._queue.empty():
+                            # Idle, a new thread is started for new batches.
+                            self._thread = None
+                            return
+                        continue
+                    if time.time() - self._batch_started < self._flush_interval:
+                        continue
+                    batch = self._take_batch()
+                    self._send_lock.acquire()  # pylint: disable=consider-using-with
+                try:
+                    self._send(batch)
+                finally:
+                    self._send_lock.release()
+                continue
+
+            try:
+                self._send(batch)
+            finally:
+                self._queue.task_done()
+
+    def _get_backoff(self, attempt):
+        """Returns the number of seconds to wait before a retry."""
+        backoff = min(self._max_backoff, self._initial_backoff * 2 ** (attempt - 1))
+        return backoff * random.uniform(0.5, 1.0)
+
+    def _count_actions(self, result, count):
+        """Counts actions that were indexed or failed."""
+        self.counters[result] += count
+        METRICS["bulk_actions"].labels(task_type=self.task_type, result=result).inc(
+            count
+        )
+
+    def _drop_batch(self, batch, error_type, reason, status=0):
+        """Counts a batch that could not be sent and reports each action.
+
+        Args:
+            batch: List of tuples with the serialized header and body of
+                each action.
+            error_type: String with the type of the error.
+            reason: String with the reason the batch was not sent.
+            status: HTTP status of the failed request, if any.
+        """
+        self._count_actions("failed", len(batch))
+        if not self._error_callback:
+            return
+
+        for header, _ in batch:
+            # The header is keyed by the action type, eg. index or update.
+            metadata = next(iter(self._serializer.loads(header).values()), {})
+            self._error_callback(
+                {
+                    "_index": metadata.get("_index", "N/A"),
+                    "_id": metadata.get("_id", "(unable to get doc id)"),
+                    "status": status if isinstance(status, int) else 0,
+                    "error": {"type": error_type, "reason": reason},
+                }
+            )
+
+    def _send(self, batch):
+        """Sends a batch of actions, retrying rejected actions.
+
+        Args:
+            batch: List of tuples with the serialized header and body of
+                each action.
+        """
+        attempt = 0
+        while batch:
+            body = "".join(header + "\n" + source + "\n" for header, source in batch)
+            start_time = time.time()
+            try:
+                # pylint: disable=unexpected-keyword-arg
+                results = self._client.bulk(body=body, timeout=self._request_timeout)
+            except (ConnectionTimeout, socket.timeout):
+                if attempt >= self._max_retries:
+                    es_logger.error(
+                        "Unable to add {0:d} events, reached retry max.".format(
+                            len(batch)
+                        ),
+                        exc_info=True,
+                    )
+                    self._drop_batch(batch, "timeout", "Reached retry max.")
+                    return
+                attempt += 1
+                es_logger.warning(
+                    "Unable to add events (retry {0:d}/{1:d})".format(
+                        attempt, self._max_retries
+                    )
+                )
+                self.counters["retried"] += len(batch)
+                time.sleep(self._get_backoff(attempt))
+                continue
+            # Errors must not stop the thread, the actions are reported as
+            # failed instead.
+            except Exception as e:  # pylint: disable=broad-except
+                es_logger.error("Unable to add events.", exc_info=True)
+                self._drop_batch(
+                    batch,
+                    type(e).__name__,
+                    str(e),
+                    status=getattr(e, "status_code", 0),
+                )
+                return
+
+            elapsed = time.time() - start_time
+            self.counters["requests"] += 1
+            self.counters["bytes"] += len(body)
+            self.counters["seconds"] += elapsed
+            self.counters["max_seconds"] = max(self.counters["max_seconds"], elapsed)
+            METRICS["bulk_request_bytes"].labels(task_type=self.task_type).observe(
+                len(body)
+            )
+            METRICS["bulk_request_duration"].labels(task_type=self.task_type).observe(
+                elapsed
+            )
+
+            rejected = []
+            failed = 0
+            if results.get("errors", False):
+                for action, item in zip(batch, results.get("items", [])):
+                    # The item is keyed by the action type, eg. index or update.
+                    result = next(iter(item.values()), {})
+                    if "error" not in result:
+                        continue
+                    if (
+                        result.get("status") == self.RETRY_STATUS
+                        and attempt < self._max_retries
+                    ):
+                        rejected.append(action)
+                        continue
+                    failed += 1
+                    if self._error_callback:
+                        self._error_callback(result)
+
+            self._count_actions("indexed", len(batch) - len(rejected) - failed)
+            self._count_actions("failed", failed)
+            batch = rejected
+            if batch:
+                attempt += 1
+                self.counters["retried"] += len(batch)
+                METRICS["bulk_actions"].labels(
+                    task_type=self.task_type, result="rejected"
+                ).inc(len(batch))
+                es_logger.warning(
+                    "{0:d} events rejected, retrying (retry {1:d}/{2:d})".format(
+                        len(batch), attempt, self._max_retries
+                    )
+                )
+                time.sleep(self._get_backoff(attempt))
+
+    def add(self, header, source):
+        """Adds an action, sending the batch if it is full.
+
+        Args:
+            header: Dict with the action and metadata of the document.
+            source: Dict with the document, or the partial document or
+                script of an update.
+        """
+        action = (self._serializer.dumps(header), self._serializer.dumps(source))
+        with self._lock:
+            if not self._batch:
+                self._batch_started = time.time()
+            self._batch.append(action)
+            self._batch_bytes += len(action[0]) + len(action[1]) + 2
+            is_full = (
+                len(self._batch) >= self._max_actions
+                or self._batch_bytes >= self._max_bytes
+            )
+
+        if is_full:
+            self.submit()
+        else:
+            # Makes sure the batch is sent after the flush interval.
+            self._ensure_thread()
+
+    def submit(self):
+        """Hands the current batch to the background thread.
+
+        Blocks while the queue of batches waiting to be sent is full.
+        """
+        with self._lock:
+            batch = self._take_batch()
+        if not batch:
+            return
+        self._ensure_thread()
+        self._queue.put(batch)
+        self._ensure_thread()
+
+    def flush(self):
+        """Sends all actions and waits until they have been sent."""
+        self.submit()
+        self._queue.join()
+        # Wait for a batch sent after the flush interval, if any.
+        with self._send_lock:
+            pass
+
+    @property
+    def pending(self):
+        """Number of actions in the current batch."""
+        return len(self._batch)
+
+    def get_stats(self):
+        """Returns a dict with the counters and throughput of the writer."""
+        stats = dict(self.counters)
+        seconds = self.counters["seconds"]
+        stats["actions_per_second"] = (
+            self.counters["indexed"] / seconds if seconds else 0
+        )
+        return stats
@@ -0,0 +1,158 @@
+# Copyright 2022 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the OpenSearch bulk writer."""
+
+import json
+import time
+
+import mock
+from opensearchpy.exceptions import ConnectionError as OpenSearchConnectionError
+from opensearchpy.exceptions import ConnectionTimeout
+from opensearchpy.serializer import JSONSerializer
+import prometheus_client
+
+from timesketch.lib.datastores.bulk_writer import BulkWriter
+from timesketch.lib.testlib import BaseTest
+
+
+def _get_ids(body):
+    """Returns the document IDs of the actions in a bulk request body."""
+    lines = body.splitlines()
+    return [json.loads(line)["index"]["_id"] for line in lines[::2]]
+
+
+def _get_result(body, rejected=(), failed=()):
+    """Returns a bulk response for a request body."""
+    items = []
+    for doc_id in _get_ids(body):
+        if doc_id in rejected:
+            result = {"_id": doc_id, "status": 429, "error": {"type": "rejected"}}
+        elif doc_id in failed:
+            result = {"_id": doc_id, "status": 400, "error": {"type": "mapper"}}
+        else:
+            result = {"_id": doc_id, "status": 201}
+        items.append({"index": result})
+    return {"errors": bool(rejected or failed), "items": items}
+
+
+class TestBulkWriter(BaseTest):
+    """Tests for the BulkWriter class."""
+
+    def _get_writer(self, **kwargs):
+        """Returns a writer with a mock client."""
+        client = mock.Mock()
+        client.transport.serializer = JSONSerializer()
+        errors = []
+        writer = BulkWriter(
+            client, error_callback=errors.append, initial_backoff=0.01, **kwargs
+        )
+        return writer, client, errors
+
+    @staticmethod
+    def _add(writer, doc_ids):
+        """Adds index actions to the writer."""
+        for doc_id in doc_ids:
+            writer.add({"index": {"_index": "test", "_id": doc_id}}, {"id": doc_id})
+
+    def test_retry_rejected(self):
+        """Test that only rejected actions are retried."""
+        writer, client, errors = self._get_writer()
+
+        def bulk(body, timeout):
+            del timeout
+            bodies.append(body)
+            if len(bodies) == 1:
+                return _get_result(body, rejected=["2"], failed=["3"])
+            return _get_result(body)
+
+        bodies = []
+        client.bulk.side_effect = bulk
+        writer.task_type = "retry_test"
+        self._add(writer, ["1", "2", "3"])
+        writer.flush()
+
+        self.assertEqual([_get_ids(body) for body in bodies], [["1", "2", "3"], ["2"]])
+        self.assertEqual([error["_id"] for error in errors], ["3"])
+        stats = writer.get_stats()
+        self.assertEqual(stats["indexed"], 2)
+        self.assertEqual(stats["failed"], 1)
+        self.assertEqual(stats["retried"], 1)
+        self.assertEqual(stats["requests"], 2)
+
+        for result, count in (("indexed", 2), ("rejected", 1), ("failed", 1)):
+            self.assertEqual(
+                prometheus_client.REGISTRY.get_sample_value(
+                    "timesketch_bulk_actions_total",
+                    {"task_type": "retry_test", "result": result},
+                ),
+                count,
+            )
+
+    def test_retry_limit(self):
+        """Test that rejected actions fail after the maximum retries."""
+        writer, client, errors = self._get_writer(max_retries=2)
+        client.bulk.side_effect = lambda body, timeout: _get_result(
+            body, rejected=["1"]
+        )
+        self._add(writer, ["1"])
+        writer.flush()
+
+        self.assertEqual(client.bulk.call_count, 3)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(writer.get_stats()["failed"], 1)
+
+    def test_dropped_batch(self):
+        """Test that batches that could not be sent are reported."""
+        writer, client, errors = self._get_writer(max_retries=1)
+        client.bulk.side_effect = ConnectionTimeout("TIMEOUT", "timed out", None)
+        self._add(writer, ["1", "2"])
+        with mock.patch("timesketch.lib.datastores.bulk_writer.time.sleep"):
+            writer.flush()
+
+        self.assertEqual(client.bulk.call_count, 2)
+        self.assertEqual([error["_id"] for error in errors], ["1", "2"])
+        self.assertEqual(errors[0]["_index"], "test")
+        self.assertEqual(writer.get_stats()["failed"], 2)
+
+        client.bulk.side_effect = OpenSearchConnectionError("N/A", "refused", None)
+        self._add(writer, ["3"])
+        writer.flush()
+
+        self.assertEqual(errors[-1]["_id"], "3")
+        self.assertEqual(errors[-1]["error"]["type"], "ConnectionError")
+        self.assertEqual(writer.get_stats()["failed"], 3)
+
+    def test_size_trigger(self):
+        """Test that full batches are sent without flushing."""
+        writer, client, _ = self._get_writer(max_actions=2)
+        client.bulk.side_effect = lambda body, timeout: _get_result(body)
+        self._add(writer, ["1", "2", "3"])
+        # The full batch is queued, the last action waits for more.
+        self.assertEqual(writer.pending, 1)
+        writer.flush()
+        self.assertEqual(client.bulk.call_count, 2)
+        self.assertEqual(writer.get_stats()["indexed"], 3)
+
+    def test_time_trigger(self):
+        """Test that a batch is sent after the flush interval."""
+        writer, client, _ = self._get_writer(flush_interval=0.05)
+        client.bulk.side_effect = lambda body, timeout: _get_result(body)
+        self._add(writer, ["1"])
+        for _ in range(100):
+            if client.bulk.called:
+                break
+            time.sleep(0.05)
+        writer.flush()
+        self.assertEqual(client.bulk.call_count, 1)
+        self.assertEqual(writer.pending, 0)
@@ -15,11 +15,14 @@
 from __future__ import unicode_literals
 
 from collections import Counter
+import contextlib
 import copy
 import codecs
 import json
 import logging
-import socket
+import math
+import random
+import time
 from uuid import uuid4
 import six
 
@@ -34,8 +37,13 @@ from opensearchpy.exceptions import ConnectionError
 
 from flask import abort
 from flask import current_app
+from flask import has_request_context
+from flask_login import current_user
 import prometheus_client
 
+from timesketch.lib import tracing
+from timesketch.lib.datastores import admission
+from timesketch.lib.datastores.bulk_writer import BulkWriter
 from timesketch.lib.definitions import HTTP_STATUS_CODE_NOT_FOUND
 from timesketch.lib.definitions import METRICS_NAMESPACE
 
@@ -43,6 +51,7 @@ from timesketch.lib.definitions import METRICS_NAMESPACE
 # Setup logging
 es_logger = logging.getLogger("timesketch.opensearch")
 es_logger.setLevel(logging.WARNING)
+slow_query_logger = logging.getLogger("timesketch.slow_query")
 
 # Metrics definitions
 METRICS = {
@@ -69,8 +78,36 @@ METRICS = {
         "Number of times a single event is requested",
         namespace=METRICS_NAMESPACE,
     ),
+    "search_scroll_duration": prometheus_client.Histogram(
+        "search_scroll_duration_seconds",
+        "Duration of requests for a page of scrolled search results",
+        ["task_type"],
+        buckets=[0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30],
+        namespace=METRICS_NAMESPACE,
+    ),
+    "search_slow_queries": prometheus_client.Counter(
+        "search_slow_queries",
+        "Number of searches slower than the slow query threshold",
+        ["type"],
+        namespace=METRICS_NAMESPACE,
+    ),
+    "search_timeouts": prometheus_client.Counter(
+        "search_timeouts",
+        "Number of searches the client gave up waiting for",
+        namespace=METRICS_NAMESPACE,
+    ),
+    "search_cancelled": prometheus_client.Counter(
+        "search_cancelled",
+        "Number of OpenSearch search tasks that were cancelled",
+        namespace=METRICS_NAMESPACE,
+    ),
 }
 
+# Limits of the summary of a search profile.
+PROFILE_MAX_DEPTH = 4
+PROFILE_MAX_CHILDREN = 5
+PROFILE_MAX_DESCRIPTION_LENGTH = 200
+
 # OpenSearch scripts
 UPDATE_LABEL_SCRIPT = """
 if (ctx._source.timesketch_label == null) {
@@ -96,6 +133,102 @@ if (!removedLabel) {
 """
 
 
+def _summarize_profile_node(node, depth, max_depth, max_children):
+    """Returns a summary of a query or aggregation of a search profile.
+
+    Args:
+        node: Dict with the profile of a query or aggregation.
+        depth: Depth of the node in the profile tree.
+        max_depth: Depth of the tree below which nodes are left out.
+        max_children: Maximum number of children of a node, the slowest
+            children are kept.
+
+    Returns:
+        Dict with the type, description, time and children of the node.
+    """
+    description = node.get("description", "")
+    if len(description) > PROFILE_MAX_DESCRIPTION_LENGTH:
+        description = description[:PROFILE_MAX_DESCRIPTION_LENGTH] + "..."
+
+    summary = {
+        "type": node.get("type", ""),
+        "description": description,
+        "time_ms": node.get("time_in_nanos", 0) / 10**6,
+        "children": [],
+    }
+    children = sorted(
+        node.get("children", []),
+        key=lambda child: child.get("time_in_nanos", 0),
+        reverse=True,
+    )
+    if depth < max_depth:
+        summary["children"] = [
+            _summarize_profile_node(child, depth + 1, max_depth, max_children)
+            for child in children[:max_children]
+        ]
+    summary["omitted_children"] = len(children) - len(summary["children"])
+    return summary
+
+
+def summarize_profile(
+    profile, max_depth=PROFILE_MAX_DEPTH, max_children=PROFILE_MAX_CHILDREN
+):
+    """Summarizes the profile of a search, slowest shards and queries first.
+
+    Args:
+        profile: Dict with the profile of a search, as returned by OpenSearch
+            for searches with "profile" enabled.
+        max_depth: Depth of the query tree below which queries are left out.
+        max_children: Maximum number of children of a query.
+
+    Returns:
+        List of dicts with the timings in milliseconds and the slowest
+        queries and aggregations of each shard.
+    """
+    shards = []
+    for shard in (profile or {}).get("shards", []):
+        queries = []
+        rewrite_nanos = 0
+        collector_nanos = 0
+        for search in shard.get("searches", []):
+            queries.extend(
+                _summarize_profile_node(query, 1, max_depth, max_children)
+                for query in search.get("query", [])
+            )
+            rewrite_nanos += search.get("rewrite_time", 0)
+            collector_nanos += sum(
+                collector.get("time_in_nanos", 0)
+                for collector in search.get("collector", [])
+            )
+        aggregations = [
+            _summarize_profile_node(aggregation, 1, max_depth, max_children)
+            for aggregation in shard.get("aggregations", [])
+        ]
+
+        summary = {
+            "id": shard.get("id", ""),
+            "query_time_ms": sum(query["time_ms"] for query in queries),
+            "rewrite_time_ms": rewrite_nanos / 10**6,
+            "collector_time_ms": collector_nanos / 10**6,
+            "aggregation_time_ms": sum(
+                aggregation["time_ms"] for aggregation in aggregations
+            ),
+            "queries": sorted(queries, key=lambda q: q["time_ms"], reverse=True),
+            "aggregations": sorted(
+                aggregations, key=lambda a: a["time_ms"], reverse=True
+            ),
+        }
+        summary["time_ms"] = (
+            summary["query_time_ms"]
+            + summary["rewrite_time_ms"]
+            + summary["collector_time_ms"]
+            + summary["aggregation_time_ms"]
+        )
+        shards.append(summary)
+
+    return sorted(shards, key=lambda shard: shard["time_ms"], reverse=True)
+
+
 class OpenSearchDataStore(object):
     """Implements the datastore."""
 
@@ -106,8 +239,21 @@ class OpenSearchDataStore(object):
     DEFAULT_FROM = 0
     DEFAULT_STREAM_LIMIT = 5000  # Max events to return when streaming results
 
-    DEFAULT_FLUSH_RETRY_LIMIT = 3  # Max retries for flushing the queue.
     DEFAULT_EVENT_IMPORT_TIMEOUT = "3m"  # Timeout value for importing events.
+    # Times an update is retried when the event was changed in the meantime,
+    # eg. by an update by query of another analyzer.
+    DEFAULT_UPDATE_RETRY_ON_CONFLICT = 5
+
+    # Index settings used when importing timelines.
+    DEFAULT_INDEX_REPLICAS = 1  # Replicas to keep once the import is done.
+    DEFAULT_INDEX_SHARD_SIZE = 10 * 1024**3  # Target size of a shard in bytes.
+    DEFAULT_INDEX_MAX_SHARDS = 5
+    DEFAULT_INDEX_SORT_FIELD = "datetime"
+    DEFAULT_FORCE_MERGE_TIMEOUT = 3600  # Seconds to wait for a force merge.
+
+    # Seconds the client waits for a search beyond its server side timeout,
+    # before it gives up and cancels the search.
+    SEARCH_TIMEOUT_GRACE = 10
 
     def __init__(self, host="127.0.0.1", port=9200):
         """Create a OpenSearch client."""
@@ -119,6 +265,17 @@ class OpenSearchDataStore(object):
         self.ssl = current_app.config.get("OPENSEARCH_SSL", False)
         self.verify = current_app.config.get("OPENSEARCH_VERIFY_CERTS", True)
         self.timeout = current_app.config.get("OPENSEARCH_TIMEOUT", 10)
+        self._slow_query_threshold = current_app.config.get(
+            "SLOW_QUERY_LOG_THRESHOLD", 0
+        )
+        self._slow_query_sample_rate = current_app.config.get(
+            "SLOW_QUERY_LOG_SAMPLE_RATE", 1.0
+        )
+        self._search_timeout = current_app.config.get("SEARCH_TIMEOUT", 0)
+        self._search_max_cost = current_app.config.get("SEARCH_MAX_COST", 0)
+        self._search_max_concurrent = current_app.config.get(
+            "SEARCH_MAX_CONCURRENT_PER_USER", 0
+        )
 
         parameters = {}
         if self.ssl:
@@ -131,12 +288,29 @@ class OpenSearchDataStore(object):
             parameters["timeout"] = self.timeout
 
         self.client = OpenSearch([{"host": host, "port": port}], **parameters)
+        tracing.trace_opensearch_client(self.client)
 
         self.import_counter = Counter()
-        self.import_events = []
         self._request_timeout = current_app.config.get(
             "TIMEOUT_FOR_EVENT_IMPORT", self.DEFAULT_EVENT_IMPORT_TIMEOUT
         )
+        self._bulk_writer = BulkWriter(
+            self.client,
+            request_timeout=self._request_timeout,
+            error_callback=self._record_import_error,
+            max_bytes=current_app.config.get(
+                "OPENSEARCH_BULK_MAX_BYTES", BulkWriter.DEFAULT_MAX_BYTES
+            ),
+            flush_interval=current_app.config.get(
+                "OPENSEARCH_BULK_FLUSH_INTERVAL", BulkWriter.DEFAULT_FLUSH_INTERVAL
+            ),
+            queue_size=current_app.config.get(
+                "OPENSEARCH_BULK_QUEUE_SIZE", BulkWriter.DEFAULT_QUEUE_SIZE
+            ),
+            max_retries=current_app.config.get(
+                "OPENSEARCH_BULK_MAX_RETRIES", BulkWriter.DEFAULT_MAX_RETRIES
+            ),
+        )
 
     @staticmethod
     def _build_labels_query(sketch_id, labels):
@@ -149,7 +323,7 @@ class OpenSearchDataStore(object):
         Returns:
             OpenSearch query as a dictionary.
         """
-        label_query = {"bool": {"must": []}}
+        label_query = {"bool": {"filter": []}}
 
         for label in labels:
             # Increase metrics counter per label
@@ -158,7 +332,7 @@ class OpenSearchDataStore(object):
                 "nested": {
                     "query": {
                         "bool": {
-                            "must": [
+                            "filter": [
                                 {"term": {"timesketch_label.name.keyword": label}},
                                 {"term": {"timesketch_label.sketch_id": sketch_id}},
                             ]
@@ -167,9 +341,36 @@ class OpenSearchDataStore(object):
                     "path": "timesketch_label",
                 }
             }
-            label_query["bool"]["must"].append(nested_query)
+            label_query["bool"]["filter"].append(nested_query)
         return label_query
 
+    @staticmethod
+    def _build_timeline_filter(timeline_ids):
+        """Build OpenSearch filter for a list of timelines.
+
+        Events of timelines that were indexed before the timeline ID was
+        stored in each event don't have the __ts_timeline_id field, so those
+        events are matched as well.
+
+        TODO: Simplify this when we don't have to support both timelines
+        that have __ts_timeline_id set and those that don't.
+
+        Args:
+            timeline_ids: List of timeline IDs (int).
+
+        Returns:
+            OpenSearch filter as a dictionary.
+        """
+        return {
+            "bool": {
+                "should": [
+                    {"bool": {"must_not": [{"exists": {"field": "__ts_timeline_id"}}]}},
+                    {"terms": {"__ts_timeline_id": timeline_ids}},
+                ],
+                "minimum_should_match": 1,
+            }
+        }
+
     @staticmethod
     def _build_events_query(events):
         """Build OpenSearch query for one or more document ids.
@@ -218,33 +419,12 @@ class OpenSearchDataStore(object):
         if not old_query:
             return query_dsl
 
+        # The timeline filter does not affect scoring, so any scoring from
+        # the supplied query is kept as is.
         query_dsl["query"] = {
             "bool": {
-                "must": [],
-                "should": [
-                    {
-                        "bool": {
-                            "must": old_query,
-                            "must_not": [
-                                {
-                                    "exists": {"field": "__ts_timeline_id"},
-                                }
-                            ],
-                        }
-                    },
-                    {
-                        "bool": {
-                            "must": [
-                                {"terms": {"__ts_timeline_id": timeline_ids}},
-                                old_query,
-                            ],
-                            "must_not": [],
-                            "filter": [{"exists": {"field": "__ts_timeline_id"}}],
-                        }
-                    },
-                ],
-                "must_not": [],
-                "filter": [],
+                "must": [old_query],
+                "filter": [OpenSearchDataStore._build_timeline_filter(timeline_ids)],
             }
         }
         return query_dsl
@@ -329,19 +509,21 @@ class OpenSearchDataStore(object):
             events = query_filter["events"]
             return self._build_events_query(events)
 
+        # All clauses are added in filter context. Results are sorted by
+        # time, so scoring would be wasted work, and filters can be cached.
         query_dsl = {"query": {"bool": {"must": [], "must_not": [], "filter": []}}}
+        filters = query_dsl["query"]["bool"]["filter"]
+        must_not_filters = query_dsl["query"]["bool"]["must_not"]
 
         if query_string:
-            query_dsl["query"]["bool"]["must"].append(
+            filters.append(
                 {"query_string": {"query": query_string, "default_operator": "AND"}}
             )
 
         # New UI filters
         if query_filter.get("chips", None):
             labels = []
-            must_filters = query_dsl["query"]["bool"]["must"]
-            must_not_filters = query_dsl["query"]["bool"]["must_not"]
-            datetime_ranges = {"bool": {"should": [], "minimum_should_match": 1}}
+            datetime_ranges = []
 
             for chip in query_filter["chips"]:
                 # Exclude chips that the user disabled
@@ -363,7 +545,7 @@ class OpenSearchDataStore(object):
                     }
 
                     if chip["operator"] == "must":
-                        must_filters.append(term_filter)
+                        filters.append(term_filter)
 
                     elif chip["operator"] == "must_not":
                         must_not_filters.append(term_filter)
@@ -378,11 +560,15 @@ class OpenSearchDataStore(object):
                         start, end = self._convert_to_time_range(chip["value"])
                     else:
                         continue
-                    datetime_ranges["bool"]["should"].append(range_filter(start, end))
+                    datetime_ranges.append(range_filter(start, end))
 
-            label_filter = self._build_labels_query(sketch_id, labels)
-            must_filters.append(label_filter)
-            must_filters.append(datetime_ranges)
+            if labels:
+                filters.append(self._build_labels_query(sketch_id, labels))
+
+            if datetime_ranges:
+                filters.append(
+                    {"bool": {"should": datetime_ranges, "minimum_should_match": 1}}
+                )
 
         # Pagination
         if query_filter.get("from", None):
@@ -392,60 +578,18 @@ class OpenSearchDataStore(object):
         if query_filter.get("size", None):
             query_dsl["size"] = query_filter["size"]
 
-        # Make sure we are sorting.
+        # Make sure we are sorting, and since we sort by time there is no
+        # need to compute scores.
         if not query_dsl.get("sort", None):
             query_dsl["sort"] = {"datetime": query_filter.get("order", "asc")}
+            query_dsl["track_scores"] = False
 
         # Add any pre defined aggregations
         if aggregations:
-            # post_filter happens after aggregation so we need to move the
-            # filter to the query instead.
-            if query_dsl.get("post_filter", None):
-                query_dsl["query"]["bool"]["filter"] = query_dsl["post_filter"]
-                query_dsl.pop("post_filter", None)
             query_dsl["aggregations"] = aggregations
 
-        # TODO: Simplify this when we don't have to support both timelines
-        # that have __ts_timeline_id set and those that don't.
-        # (query_string AND timeline_id NOT EXISTS) OR (
-        #       query_string AND timeline_id in LIST)
         if timeline_ids and isinstance(timeline_ids, (list, tuple)):
-            must_filters_pre = copy.copy(query_dsl["query"]["bool"]["must"])
-            must_not_filters_pre = copy.copy(query_dsl["query"]["bool"]["must_not"])
-
-            must_filters_post = copy.copy(query_dsl["query"]["bool"]["must"])
-            must_not_filters_post = copy.copy(query_dsl["query"]["bool"]["must_not"])
-
-            must_not_filters_pre.append(
-                {
-                    "exists": {"field": "__ts_timeline_id"},
-                }
-            )
-
-            must_filters_post.append({"terms": {"__ts_timeline_id": timeline_ids}})
-
-            query_dsl["query"] = {
-                "bool": {
-                    "must": [],
-                    "should": [
-                        {
-                            "bool": {
-                                "must": must_filters_pre,
-                                "must_not": must_not_filters_pre,
-                            }
-                        },
-                        {
-                            "bool": {
-                                "must": must_filters_post,
-                                "must_not": must_not_filters_post,
-                                "filter": [{"exists": {"field": "__ts_timeline_id"}}],
-                            }
-                        },
-                    ],
-                    "must_not": [],
-                    "filter": [],
-                }
-            }
+            filters.append(self._build_timeline_filter(timeline_ids))
 
         return query_dsl
 
@@ -462,6 +606,8 @@ class OpenSearchDataStore(object):
         return_fields=None,
         enable_scroll=False,
         timeline_ids=None,
+        profile=False,
+        search_id=None,
     ):
         """Search OpenSearch. This will take a query string from the UI
         together with a filter definition. Based on this it will execute the
@@ -479,9 +625,17 @@ class OpenSearchDataStore(object):
             enable_scroll: If OpenSearch scroll API should be used
             timeline_ids: Optional list of IDs of Timeline objects that should
                 be queried as part of the search.
+            profile: If True OpenSearch profiles the search and the result
+                contains the profile, ignored when counting.
+            search_id: Optional ID of the search, used to cancel it.
 
         Returns:
             Set of event documents in JSON format
+
+        Raises:
+            SearchRejectedError: If the search is too expensive or the user
+                runs too many searches at the same time.
+            ValueError: If the query is invalid or the search timed out.
         """
         scroll_timeout = None
         if enable_scroll:
@@ -513,13 +667,19 @@ class OpenSearchDataStore(object):
 
         # Default search type for OpenSearch is query_then_fetch.
         search_type = "query_then_fetch"
+        opaque_id = self._get_opaque_id(search_id)
+        request_params = self._get_request_params(opaque_id)
+        start_time = time.time()
 
         # Only return how many documents matches the query.
         if count:
             if "sort" in query_dsl:
                 del query_dsl["sort"]
             try:
-                count_result = self.client.count(body=query_dsl, index=list(indices))
+                with self._guard_search(indices, query_dsl, opaque_id):
+                    count_result = self.client.count(
+                        body=query_dsl, index=list(indices), **request_params
+                    )
             except NotFoundError:
                 es_logger.error(
                     "Unable to count due to an index not found: {0:s}".format(
@@ -528,38 +688,60 @@ class OpenSearchDataStore(object):
                 )
                 return 0
             METRICS["search_requests"].labels(type="count").inc()
+            self._log_slow_query(
+                "count",
+                sketch_id,
+                indices,
+                query_dsl,
+                time.time() - start_time,
+                hits=count_result.get("count", 0),
+            )
             return count_result.get("count", 0)
 
+        if profile:
+            query_dsl["profile"] = True
+        search_timeout = self._get_search_timeout()
+        if search_timeout and "timeout" not in query_dsl:
+            query_dsl["timeout"] = "{0:d}s".format(search_timeout)
+
         if not return_fields:
             # Suppress the lint error because opensearchpy adds parameters
             # to the function with a decorator and this makes pylint sad.
             # pylint: disable=unexpected-keyword-arg
-            return self.client.search(
-                body=query_dsl,
-                index=list(indices),
-                search_type=search_type,
-                scroll=scroll_timeout,
-            )
-
-        # The argument " _source_include" changed to "_source_includes" in
-        # ES version 7. This check add support for both version 6 and 7 clients.
-        # pylint: disable=unexpected-keyword-arg
-        try:
-            if self.version.startswith("6"):
+            with self._guard_search(indices, query_dsl, opaque_id):
                 _search_result = self.client.search(
                     body=query_dsl,
                     index=list(indices),
                     search_type=search_type,
-                    _source_include=return_fields,
                     scroll=scroll_timeout,
+                    **request_params
                 )
-            else:
+            self._log_slow_query(
+                "single",
+                sketch_id,
+                indices,
+                query_dsl,
+                time.time() - start_time,
+                result=_search_result,
+            )
+            return _search_result
+
+        # The argument " _source_include" changed to "_source_includes" in
+        # ES version 7. This check add support for both version 6 and 7 clients.
+        if self.version.startswith("6"):
+            request_params["_source_include"] = return_fields
+        else:
+            request_params["_source_includes"] = return_fields
+
+        # pylint: disable=unexpected-keyword-arg
+        try:
+            with self._guard_search(indices, query_dsl, opaque_id):
                 _search_result = self.client.search(
                     body=query_dsl,
                     index=list(indices),
                     search_type=search_type,
-                    _source_includes=return_fields,
                     scroll=scroll_timeout,
+                    **request_params
                 )
         except RequestError as e:
             root_cause = e.info.get("error", {}).get("root_cause")
@@ -581,8 +763,237 @@ class OpenSearchDataStore(object):
             raise ValueError(cause) from e
 
         METRICS["search_requests"].labels(type="single").inc()
+        self._log_slow_query(
+            "single",
+            sketch_id,
+            indices,
+            query_dsl,
+            time.time() - start_time,
+            result=_search_result,
+        )
         return _search_result
 
+    def aggregate(self, indices, aggregation_dsl, search_id=None):
+        """Runs an aggregation, with the same limits as searches.
+
+        Args:
+            indices: List of indices to aggregate.
+            aggregation_dsl: Dict or JSON string with the OpenSearch query
+                and aggregations.
+            search_id: Optional ID of the search, used to cancel it.
+
+        Returns:
+            Dict with the search result, including the aggregations.
+
+        Raises:
+            SearchRejectedError: If the aggregation is too expensive or the
+                user runs too many searches at the same time.
+            ValueError: If the aggregation is not valid JSON or timed out.
+        """
+        if isinstance(aggregation_dsl, str):
+            aggregation_dsl = json.loads(aggregation_dsl)
+        search_timeout = self._get_search_timeout()
+        if search_timeout and "timeout" not in aggregation_dsl:
+            aggregation_dsl["timeout"] = "{0:d}s".format(search_timeout)
+        opaque_id = self._get_opaque_id(search_id)
+        with self._guard_search(indices, aggregation_dsl, opaque_id):
+            # pylint: disable=unexpected-keyword-arg
+            result = self.client.search(
+                index=indices,
+                body=aggregation_dsl,
+                size=0,
+                **self._get_request_params(opaque_id)
+            )
+        METRICS["search_requests"].labels(type="aggregation").inc()
+        return result
+
+    def cancel_search(self, search_id):
+        """Cancels the running searches of the user with a search ID.
+
+        Args:
+            search_id: ID of the search, as passed to search().
+
+        Returns:
+            Number of OpenSearch tasks that were cancelled.
+        """
+        return self._cancel_tasks(self._get_opaque_id(search_id))
+
+    def _cancel_tasks(self, opaque_id):
+        """Cancels the running search tasks with an opaque ID.
+
+        Args:
+            opaque_id: X-Opaque-Id header the searches were sent with.
+
+        Returns:
+            Number of OpenSearch tasks that were cancelled.
+        """
+        try:
+            # pylint: disable=unexpected-keyword-arg
+            result = self.client.tasks.list(actions="*search*", detailed=True)
+        except (ConnectionError, RequestError) as e:
+            es_logger.error("Unable to list search tasks: {0!s}".format(e))
+            return 0
+
+        cancelled = 0
+        for node in result.get("nodes", {}).values():
+            for task_id, task in node.get("tasks", {}).items():
+                if task.get("headers", {}).get("X-Opaque-Id") != opaque_id:
+                    continue
+                # Child tasks are cancelled together with their parent.
+                if task.get("parent_task_id"):
+                    continue
+                try:
+                    self.client.tasks.cancel(task_id=task_id)
+                except NotFoundError:
+                    # The task finished in the meantime.
+                    continue
+                cancelled += 1
+
+        if cancelled:
+            METRICS["search_cancelled"].inc(cancelled)
+            es_logger.info(
+                "Cancelled {0:d} search task(s) of: {1:s}".format(cancelled, opaque_id)
+            )
+        return cancelled
+
+    def _get_opaque_id(self, search_id=None):
+        """Returns the X-Opaque-Id of a search.
+
+        The ID identifies the user, or the task type outside of requests, so
+        that a user can only cancel their own searches.
+
+        Args:
+            search_id: Optional ID of the search, a random ID is used if
+                not provided.
+        """
+        owner = self._get_username() or self.task_type or "timesketch"
+        return "timesketch/{0:s}/{1:s}".format(owner, search_id or uuid4().hex)
+
+    def _get_request_params(self, opaque_id):
+        """Returns the client parameters of a search request.
+
+        Args:
+            opaque_id: X-Opaque-Id header of the search.
+        """
+        params = {"opaque_id": opaque_id}
+        search_timeout = self._get_search_timeout()
+        if search_timeout:
+            params["request_timeout"] = search_timeout + self.SEARCH_TIMEOUT_GRACE
+        return params
+
+    def _get_search_timeout(self):
+        """Returns the seconds a search may take, 0 for no timeout.
+
+        Only searches of web requests have a timeout. Analyzers, exports in
+        tasks and other background work need complete results, which a
+        search that times out does not return.
+        """
+        if not has_request_context():
+            return 0
+        return self._search_timeout
+
+    @contextlib.contextmanager
+    def _guard_search(self, indices, query_dsl, opaque_id):
+        """Admits a search and cancels it if the client times out.
+
+        Args:
+            indices: List of indices to search.
+            query_dsl: Dict with the OpenSearch query, including aggregations.
+            opaque_id: X-Opaque-Id header of the search.
+
+        Raises:
+            SearchRejectedError: If the search is not admitted.
+            ValueError: If the search timed out.
+        """
+        with admission.SearchAdmission(
+            self,
+            indices,
+            query_dsl,
+            self._get_username(),
+            max_cost=self._search_max_cost,
+            max_concurrent=self._search_max_concurrent,
+        ):
+            try:
+                yield
+            except ConnectionTimeout as e:
+                METRICS["search_timeouts"].inc()
+                # The search keeps running on the cluster unless cancelled.
+                self._cancel_tasks(opaque_id)
+                raise ValueError(
+                    "The search did not finish in time and was cancelled, "
+                    "narrow down the query or search fewer timelines."
+                ) from e
+
+    @staticmethod
+    def _get_username():
+        """Returns the name of the user of the request, or None."""
+        if not has_request_context():
+            return None
+        if not getattr(current_user, "is_authenticated", False):
+            return None
+        return current_user.username
+
+    def _log_slow_query(
+        self,
+        search_type,
+        sketch_id,
+        indices,
+        query_dsl,
+        duration,
+        result=None,
+        hits=None,
+    ):
+        """Logs a search that took longer than the slow query threshold.
+
+        Only a sample of the slow searches is logged if a sample rate is
+        configured, all of them are counted.
+
+        Args:
+            search_type: Type of the search, eg. single or count.
+            sketch_id: Integer of sketch primary key.
+            indices: List of indices that were searched.
+            query_dsl: Dict with the OpenSearch DSL query that was sent.
+            duration: Seconds the search took, including the network.
+            result: Optional dict with the search result.
+            hits: Optional number of hits, if there is no search result.
+        """
+        if not self._slow_query_threshold:
+            return
+
+        result = result or {}
+        took = result.get("took", int(duration * 1000))
+        if took < self._slow_query_threshold:
+            return
+
+        METRICS["search_slow_queries"].labels(type=search_type).inc()
+        if random.random() >= self._slow_query_sample_rate:
+            return
+
+        if hits is None:
+            hits = result.get("hits", {}).get("total", 0)
+            # Elasticsearch version 7.x returns total hits as a dictionary.
+            if isinstance(hits, dict):
+                hits = hits.get("value", 0)
+
+        record = {
+            "type": search_type,
+            "took_ms": took,
+            "duration_ms": int(duration * 1000),
+            "sketch_id": sketch_id,
+            "user": self._get_username(),
+            "task_type": self.task_type,
+            "indices": sorted(indices),
+            "hits": hits,
+            "timed_out": result.get("timed_out", False),
+            "shards": result.get("_shards", {}),
+            "query_dsl": query_dsl,
+        }
+        if result.get("profile"):
+            record["profile"] = summarize_profile(result["profile"])
+        slow_query_logger.warning(
+            "Slow query: {0:s}".format(json.dumps(record, default=str))
+        )
+
     # pylint: disable=too-many-arguments
     def search_stream(
         self,
@@ -594,6 +1005,7 @@ class OpenSearchDataStore(object):
         return_fields=None,
         enable_scroll=True,
         timeline_ids=None,
+        search_id=None,
     ):
         """Search OpenSearch. This will take a query string from the UI
         together with a filter definition. Based on this it will execute the
@@ -609,12 +1021,15 @@ class OpenSearchDataStore(object):
             enable_scroll: Boolean determining whether scrolling is enabled.
             timeline_ids: Optional list of IDs of Timeline objects that should
                 be queried as part of the search.
+            search_id: Optional ID of the search, used to cancel it.
 
         Returns:
             Generator of event documents in JSON format
         """
         # Make sure that the list of index names is uniq.
         indices = list(set(indices))
+        # The scroll requests share the ID, to cancel them with the search.
+        search_id = search_id or uuid4().hex
 
         METRICS["search_requests"].labels(type="stream").inc()
 
@@ -633,6 +1048,7 @@ class OpenSearchDataStore(object):
             return_fields=return_fields,
             enable_scroll=enable_scroll,
             timeline_ids=timeline_ids,
+            search_id=search_id,
         )
 
         if enable_scroll:
@@ -647,17 +1063,56 @@ class OpenSearchDataStore(object):
         if isinstance(scroll_size, dict):
             scroll_size = scroll_size.get("value", 0)
 
+        self._check_stream_timed_out(result)
         for event in result["hits"]["hits"]:
             yield event
 
+        scroll_duration = METRICS["search_scroll_duration"].labels(
+            task_type=self.task_type
+        )
+        opaque_id = self._get_opaque_id(search_id)
+        request_params = self._get_request_params(opaque_id)
         while scroll_size > 0:
-            # pylint: disable=unexpected-keyword-arg
-            result = self.client.scroll(scroll_id=scroll_id, scroll="5m")
+            start_time = time.time()
+            try:
+                # pylint: disable=unexpected-keyword-arg
+                result = self.client.scroll(
+                    scroll_id=scroll_id, scroll="5m", **request_params
+                )
+            except ConnectionTimeout as e:
+                METRICS["search_timeouts"].inc()
+                self._cancel_tasks(opaque_id)
+                raise ValueError(
+                    "Scrolling the search did not finish in time and was cancelled."
+                ) from e
+            scroll_duration.observe(time.time() - start_time)
+            self._check_stream_timed_out(result)
             scroll_id = result["_scroll_id"]
             scroll_size = len(result["hits"]["hits"])
             for event in result["hits"]["hits"]:
                 yield event
 
+    @staticmethod
+    def _check_stream_timed_out(result):
+        """Raises if a page of streamed results is incomplete.
+
+        Args:
+            result: Dict with the result of a search or scroll request.
+
+        Raises:
+            ValueError: If the search timed out and the results are partial.
+        """
+        if not result.get("timed_out", False):
+            return
+        es_logger.error(
+            "Streamed search timed out, the results are incomplete "
+            "(shards: {0!s})".format(result.get("_shards", {}))
+        )
+        raise ValueError(
+            "The search timed out and only returned partial results, narrow "
+            "down the query or search fewer timelines."
+        )
+
     def get_filter_labels(self, sketch_id, indices):
         """Aggregate labels for a sketch.
 
@@ -879,8 +1334,52 @@ class OpenSearchDataStore(object):
 
         return None
 
+    def get_bulk_load_settings(self, data_size=0):
+        """Get index settings tuned for bulk loading a timeline.
+
+        While events are being imported the index is not refreshed and no
+        replicas are kept, see finalize_index() for restoring them. Documents
+        are sorted by time on disk so time sorted searches can terminate
+        early, and the number of primary shards is chosen from the size of
+        the data that is imported.
+
+        Args:
+            data_size: Size in bytes of the data that is going to be imported.
+
+        Returns:
+            Dict with index settings or None if bulk load settings are
+            disabled in the configuration.
+        """
+        if not current_app.config.get("OPENSEARCH_INDEX_BULK_LOAD", True):
+            return None
+
+        shard_size = current_app.config.get(
+            "OPENSEARCH_INDEX_SHARD_SIZE", self.DEFAULT_INDEX_SHARD_SIZE
+        )
+        max_shards = current_app.config.get(
+            "OPENSEARCH_INDEX_MAX_SHARDS", self.DEFAULT_INDEX_MAX_SHARDS
+        )
+        number_of_shards = 1
+        if data_size and shard_size:
+            number_of_shards = int(math.ceil(data_size / shard_size))
+        number_of_shards = max(1, min(number_of_shards, max_shards))
+
+        return {
+            "index": {
+                "number_of_shards": number_of_shards,
+                "number_of_replicas": 0,
+                "refresh_interval": "-1",
+                "sort.field": self.DEFAULT_INDEX_SORT_FIELD,
+                "sort.order": "asc",
+            }
+        }
+
     def create_index(
-        self, index_name=uuid4().hex, doc_type="generic_event", mappings=None
+        self,
+        index_name=uuid4().hex,
+        doc_type="generic_event",
+        mappings=None,
+        settings=None,
     ):
         """Create index with Timesketch settings.
 
@@ -888,6 +1387,9 @@ class OpenSearchDataStore(object):
             index_name: Name of the index. Default is a generated UUID.
             doc_type: Name of the document type. Default id generic_event.
             mappings: Optional dict with the document mapping for OpenSearch.
+            settings: Optional dict with index settings for OpenSearch, eg.
+                from get_bulk_load_settings(). Settings are only applied
+                when the index is created.
 
         Returns:
             Index name in string format.
@@ -907,15 +1409,34 @@ class OpenSearchDataStore(object):
         if self.version.startswith("6"):
             _document_mapping = {doc_type: _document_mapping}
 
+        body = {"mappings": _document_mapping}
+        if settings:
+            body["settings"] = settings
+
         if not self.client.indices.exists(index_name):
             try:
-                self.client.indices.create(
-                    index=index_name, body={"mappings": _document_mapping}
-                )
+                self.client.indices.create(index=index_name, body=body)
             except ConnectionError as e:
                 raise RuntimeError("Unable to connect to Timesketch backend.") from e
-            except RequestError:
+            except RequestError as e:
                 index_exists = self.client.indices.exists(index_name)
+                index_settings = (settings or {}).get("index", {})
+                if not index_exists and index_settings.get("sort.field"):
+                    # Index sorting is not supported with all mappings,
+                    # e.g. on older clusters with nested fields.
+                    es_logger.warning(
+                        "Unable to create index {0:s} with index sorting, "
+                        "creating it without: {1!s}".format(index_name, e)
+                    )
+                    settings = copy.deepcopy(settings)
+                    settings["index"].pop("sort.field", None)
+                    settings["index"].pop("sort.order", None)
+                    return self.create_index(
+                        index_name=index_name,
+                        doc_type=doc_type,
+                        mappings=mappings,
+                        settings=settings,
+                    )
                 es_logger.warning(
                     "Attempting to create an index that already exists "
                     "({0:s} - {1:s})".format(index_name, str(index_exists))
@@ -923,6 +1444,48 @@ class OpenSearchDataStore(object):
 
         return index_name, doc_type
 
+    def finalize_index(self, index_name):
+        """Prepare an index for searching after events have been imported.
+
+        Refreshes the index and restores the refresh interval and replicas
+        that were turned off by the bulk load settings. Optionally force
+        merges the index down to a single segment.
+
+        Args:
+            index_name: Name of the index.
+
+        Raises:
+            RuntimeError: If unable to connect to the backend.
+        """
+        replicas = current_app.config.get(
+            "OPENSEARCH_INDEX_REPLICAS", self.DEFAULT_INDEX_REPLICAS
+        )
+        try:
+            self.client.indices.refresh(index=index_name)
+            if not current_app.config.get("OPENSEARCH_INDEX_BULK_LOAD", True):
+                return
+
+            # Setting the refresh interval to None restores the default.
+            self.client.indices.put_settings(
+                index=index_name,
+                body={
+                    "index": {
+                        "refresh_interval": None,
+                        "number_of_replicas": replicas,
+                    }
+                },
+            )
+            if current_app.config.get("OPENSEARCH_INDEX_FORCE_MERGE", False):
+                self.client.indices.forcemerge(
+                    index=index_name,
+                    max_num_segments=1,
+                    request_timeout=self.DEFAULT_FORCE_MERGE_TIMEOUT,
+                )
+        except ConnectionError as e:
+            raise RuntimeError(
+                "Unable to connect to Timesketch backend: {}".format(e)
+            ) from e
+
     def delete_index(self, index_name):
         """Delete OpenSearch index.
 
@@ -953,7 +1516,8 @@ class OpenSearchDataStore(object):
             event_type: Type of event (e.g. plaso_event)
             event: Event dictionary
             event_id: Event OpenSearch ID
-            flush_interval: Number of events to queue up before indexing
+            flush_interval: Number of events to queue up before they are
+                handed to the background writer for indexing.
             timeline_id: Optional ID number of a Timeline object this event
                 belongs to. If supplied an additional field will be added to
                 the store indicating the timeline this belongs to.
@@ -975,7 +1539,13 @@ class OpenSearchDataStore(object):
                     "_index": index_name,
                 }
             }
-            update_header = {"update": {"_index": index_name, "_id": event_id}}
+            update_header = {
+                "update": {
+                    "_index": index_name,
+                    "_id": event_id,
+                    "retry_on_conflict": self.DEFAULT_UPDATE_RETRY_ON_CONFLICT,
+                }
+            }
 
             # TODO: Remove when we deprecate Elasticsearch version 6.x
             if self.version.startswith("6"):
@@ -993,118 +1563,110 @@ class OpenSearchDataStore(object):
             if timeline_id:
                 event["__ts_timeline_id"] = timeline_id
 
-            self.import_events.append(header)
-            self.import_events.append(event)
+            self._bulk_writer.add(header, event)
             self.import_counter["events"] += 1
 
             if self.import_counter["events"] % int(flush_interval) == 0:
-                _ = self.flush_queued_events()
-                self.import_events = []
+                self._bulk_writer.submit()
         else:
             # Import the remaining events in the queue.
-            if self.import_events:
-                _ = self.flush_queued_events()
+            _ = self.flush_queued_events()
 
         return self.import_counter["events"]
 
-    def flush_queued_events(self, retry_count=0):
-        """Flush all queued events.
+    def _record_import_error(self, result):
+        """Records an action that could not be indexed.
 
-        Returns:
-            dict: A dict object that contains the number of events
-                that were sent to OpenSearch as well as information
-                on whether there were any errors, and what the
-                details of these errors if any.
-            retry_count: optional int indicating whether this is a retry.
+        Args:
+            result: Dict with the result of the action in a bulk response.
         """
-        if not self.import_events:
-            return {}
+        index_name = result.get("_index", "N/A")
 
-        return_dict = {
-            "number_of_events": len(self.import_events) / 2,
-            "total_events": self.import_counter["events"],
-        }
+        _ = self._error_container.setdefault(
+            index_name, {"errors": [], "types": Counter(), "details": Counter()}
+        )
 
-        try:
-            # pylint: disable=unexpected-keyword-arg
-            results = self.client.bulk(
-                body=self.import_events, timeout=self._request_timeout
-            )
-        except (ConnectionTimeout, socket.timeout):
-            if retry_count >= self.DEFAULT_FLUSH_RETRY_LIMIT:
-                es_logger.error(
-                    "Unable to add events, reached recount max.", exc_info=True
-                )
-                return {}
+        error_counter = self._error_container[index_name]["types"]
+        error_detail_counter = self._error_container[index_name]["details"]
+        error_list = self._error_container[index_name]["errors"]
 
-            es_logger.error(
-                "Unable to add events (retry {0:d}/{1:d})".format(
-                    retry_count, self.DEFAULT_FLUSH_RETRY_LIMIT
-                )
-            )
-            return self.flush_queued_events(retry_count + 1)
+        error = result.get("error", {})
+        status_code = result.get("status", 0)
+        doc_id = result.get("_id", "(unable to get doc id)")
+        caused_by = error.get("caused_by", {})
 
-        errors_in_upload = results.get("errors", False)
-        return_dict["errors_in_upload"] = errors_in_upload
+        caused_reason = caused_by.get("reason", "Unkown Detailed Reason")
 
-        if errors_in_upload:
-            items = results.get("items", [])
-            return_dict["errors"] = []
-
-            es_logger.error("Errors while attempting to upload events.")
-            for item in items:
-                index = item.get("index", {})
-                index_name = index.get("_index", "N/A")
+        error_counter[error.get("type")] += 1
+        detail_msg = "{0:s}/{1:s}".format(
+            caused_by.get("type", "Unknown Detailed Type"),
+            " ".join(caused_reason.split()[:5]),
+        )
+        error_detail_counter[detail_msg] += 1
 
-                _ = self._error_container.setdefault(
-                    index_name, {"errors": [], "types": Counter(), "details": Counter()}
-                )
+        error_msg = "<{0:s}> {1:s} [{2:s}/{3:s}]".format(
+            error.get("type", "Unknown Type"),
+            error.get("reason", "No reason given"),
+            caused_by.get("type", "Unknown Type"),
+            caused_reason,
+        )
+        error_list.append(error_msg)
+        try:
+            es_logger.error(
+                "Unable to upload document: {0:s} to index {1:s} - "
+                "[{2:d}] {3:s}".format(doc_id, index_name, status_code, error_msg)
+            )
+        # We need to catch all exceptions here, since this is a crucial
+        # call that we do not want to break operation.
+        except Exception:  # pylint: disable=broad-except
+            es_logger.error(
+                "Unable to upload document, and unable to log the " "error itself.",
+                exc_info=True,
+            )
 
-                error_counter = self._error_container[index_name]["types"]
-                error_detail_counter = self._error_container[index_name]["details"]
-                error_list = self._error_container[index_name]["errors"]
+    def flush_queued_events(self):
+        """Flush all queued events.
 
-                error = index.get("error", {})
-                status_code = index.get("status", 0)
-                doc_id = index.get("_id", "(unable to get doc id)")
-                caused_by = error.get("caused_by", {})
+        Waits until all events handed to the background writer have been
+        sent to OpenSearch.
 
-                caused_reason = caused_by.get("reason", "Unkown Detailed Reason")
+        Returns:
+            dict: A dict object that contains the number of events
+                that were sent to OpenSearch as well as information
+                on whether there were any errors, and what the
+                details of these errors if any.
+        """
+        if not self.import_counter["events"]:
+            return {}
 
-                error_counter[error.get("type")] += 1
-                detail_msg = "{0:s}/{1:s}".format(
-                    caused_by.get("type", "Unknown Detailed Type"),
-                    " ".join(caused_reason.split()[:5]),
-                )
-                error_detail_counter[detail_msg] += 1
+        failed = self._bulk_writer.counters["failed"]
+        number_of_events = self._bulk_writer.pending
+        with tracing.span("flush_queued_events", {"events": number_of_events}):
+            self._bulk_writer.flush()
 
-                error_msg = "<{0:s}> {1:s} [{2:s}/{3:s}]".format(
-                    error.get("type", "Unknown Type"),
-                    error.get("reason", "No reason given"),
-                    caused_by.get("type", "Unknown Type"),
-                    caused_reason,
-                )
-                error_list.append(error_msg)
-                try:
-                    es_logger.error(
-                        "Unable to upload document: {0:s} to index {1:s} - "
-                        "[{2:d}] {3:s}".format(
-                            doc_id, index_name, status_code, error_msg
-                        )
-                    )
-                # We need to catch all exceptions here, since this is a crucial
-                # call that we do not want to break operation.
-                except Exception:  # pylint: disable=broad-except
-                    es_logger.error(
-                        "Unable to upload document, and unable to log the "
-                        "error itself.",
-                        exc_info=True,
-                    )
+        bulk_stats = self._bulk_writer.get_stats()
+        es_logger.debug("Bulk writer statistics: {0!s}".format(bulk_stats))
+        return {
+            "number_of_events": number_of_events,
+            "total_events": self.import_counter["events"],
+            "errors_in_upload": bulk_stats.get("failed", 0) > failed,
+            "error_container": self._error_container,
+            "bulk_stats": bulk_stats,
+        }
 
-        return_dict["error_container"] = self._error_container
+    def get_bulk_stats(self):
+        """Returns a dict with throughput and latency counters of imports."""
+        return self._bulk_writer.get_stats()
 
-        self.import_events = []
-        return return_dict
+    @property
+    def task_type(self):
+        """Type of the task using the datastore, used to label metrics."""
+        return self._bulk_writer.task_type
+
+    @task_type.setter
+    def task_type(self, task_type):
+        """Sets the type of the task using the datastore, eg. csv or analyzer."""
+        self._bulk_writer.task_type = task_type
 
     @property
     def version(self):
@@ -0,0 +1,377 @@
+# Copyright 2022 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the OpenSearch datastore."""
+
+from __future__ import unicode_literals
+
+import json
+
+import mock
+from opensearchpy.exceptions import ConnectionTimeout
+
+from timesketch.lib.testlib import BaseTest
+from timesketch.lib.datastores import opensearch
+from timesketch.lib.datastores.opensearch import OpenSearchDataStore
+
+
+TIMELINE_FILTER = {
+    "bool": {
+        "should": [
+            {"bool": {"must_not": [{"exists": {"field": "__ts_timeline_id"}}]}},
+            {"terms": {"__ts_timeline_id": [1, 2]}},
+        ],
+        "minimum_should_match": 1,
+    }
+}
+
+LABEL_FILTER = {
+    "bool": {
+        "filter": [
+            {
+                "nested": {
+                    "query": {
+                        "bool": {
+                            "filter": [
+                                {
+                                    "term": {
+                                        "timesketch_label.name.keyword": "__ts_star"
+                                    }
+                                },
+                                {"term": {"timesketch_label.sketch_id": 1}},
+                            ]
+                        }
+                    },
+                    "path": "timesketch_label",
+                }
+            }
+        ]
+    }
+}
+
+
+class TestOpenSearchDataStore(BaseTest):
+    """Tests for the OpenSearchDataStore class."""
+
+    def setUp(self):
+        """Set up the tests."""
+        super().setUp()
+        self.datastore = OpenSearchDataStore()
+
+    def test_build_query_string(self):
+        """Test that a query string is compiled into filter context."""
+        query_dsl = self.datastore.build_query(
+            sketch_id=1,
+            query_string="foo:bar",
+            query_filter={"from": 10, "size": 20, "order": "desc"},
+            timeline_ids=[1, 2],
+        )
+        expected = {
+            "query": {
+                "bool": {
+                    "must": [],
+                    "must_not": [],
+                    "filter": [
+                        {
+                            "query_string": {
+                                "query": "foo:bar",
+                                "default_operator": "AND",
+                            }
+                        },
+                        TIMELINE_FILTER,
+                    ],
+                }
+            },
+            "from": 10,
+            "size": 20,
+            "sort": {"datetime": "desc"},
+            "track_scores": False,
+        }
+        self.assertDictEqual(query_dsl, expected)
+
+    def test_build_query_chips(self):
+        """Test that chips are compiled into filter context."""
+        query_filter = {
+            "chips": [
+                {"type": "label", "value": "__ts_star", "active": True},
+                {
+                    "type": "term",
+                    "field": "data_type",
+                    "value": "fs:stat",
+                    "operator": "must",
+                },
+                {
+                    "type": "term",
+                    "field": "source_short",
+                    "value": "LOG",
+                    "operator": "must_not",
+                },
+                {
+                    "type": "datetime_range",
+                    "value": "2020-01-01T00:00:00,2020-01-02T00:00:00",
+                },
+                {"type": "label", "value": "disabled", "active": False},
+            ]
+        }
+        query_dsl = self.datastore.build_query(
+            sketch_id=1,
+            query_string="",
+            query_filter=query_filter,
+            aggregations={"my_agg": {"terms": {"field": "data_type"}}},
+        )
+        expected = {
+            "query": {
+                "bool": {
+                    "must": [],
+                    "must_not": [{"match_phrase": {"source_short": {"query": "LOG"}}}],
+                    "filter": [
+                        {"match_phrase": {"data_type": {"query": "fs:stat"}}},
+                        LABEL_FILTER,
+                        {
+                            "bool": {
+                                "should": [
+                                    {
+                                        "range": {
+                                            "datetime": {
+                                                "gte": "2020-01-01T00:00:00",
+                                                "lte": "2020-01-02T00:00:00",
+                                            }
+                                        }
+                                    }
+                                ],
+                                "minimum_should_match": 1,
+                            }
+                        },
+                    ],
+                }
+            },
+            "sort": {"datetime": "asc"},
+            "track_scores": False,
+            "aggregations": {"my_agg": {"terms": {"field": "data_type"}}},
+        }
+        self.assertDictEqual(query_dsl, expected)
+
+    def test_build_query_dsl(self):
+        """Test that a raw DSL query is wrapped with the timeline filter."""
+        raw_query = {"query": {"match": {"message": "foo"}}, "size": 5}
+        query_dsl = self.datastore.build_query(
+            sketch_id=1,
+            query_string="",
+            query_filter={},
+            query_dsl=raw_query,
+            timeline_ids=[1, 2],
+        )
+        expected = {
+            "query": {
+                "bool": {
+                    "must": [{"match": {"message": "foo"}}],
+                    "filter": [TIMELINE_FILTER],
+                }
+            },
+            "size": 5,
+        }
+        self.assertDictEqual(query_dsl, expected)
+
+    def test_get_bulk_load_settings(self):
+        """Test the index settings used when importing timelines."""
+        settings = self.datastore.get_bulk_load_settings()
+        expected = {
+            "index": {
+                "number_of_shards": 1,
+                "number_of_replicas": 0,
+                "refresh_interval": "-1",
+                "sort.field": "datetime",
+                "sort.order": "asc",
+            }
+        }
+        self.assertDictEqual(settings, expected)
+
+        shard_size = self.datastore.DEFAULT_INDEX_SHARD_SIZE
+        settings = self.datastore.get_bulk_load_settings(shard_size * 2 + 1)
+        self.assertEqual(settings["index"]["number_of_shards"], 3)
+
+        settings = self.datastore.get_bulk_load_settings(shard_size * 100)
+        self.assertEqual(
+            settings["index"]["number_of_shards"],
+            self.datastore.DEFAULT_INDEX_MAX_SHARDS,
+        )
+
+        self.app.config["OPENSEARCH_INDEX_BULK_LOAD"] = False
+        self.assertIsNone(self.datastore.get_bulk_load_settings())
+        self.app.config["OPENSEARCH_INDEX_BULK_LOAD"] = True
+
+    def test_summarize_profile(self):
+        """Test summarizing the profile of a search."""
+        profile = {
+            "shards": [
+                {
+                    "id": "[node][index-a][0]",
+                    "searches": [
+                        {
+                            "query": [
+                                {
+                                    "type": "BooleanQuery",
+                                    "description": "+message:*foo* +x" * 50,
+                                    "time_in_nanos": 3000000,
+                                    "children": [
+                                        {
+                                            "type": "TermQuery",
+                                            "description": "x",
+                                            "time_in_nanos": 500000,
+                                        },
+                                        {
+                                            "type": "WildcardQuery",
+                                            "description": "message:*foo*",
+                                            "time_in_nanos": 2500000,
+                                        },
+                                    ],
+                                }
+                            ],
+                            "rewrite_time": 1000000,
+                            "collector": [{"time_in_nanos": 1000000}],
+                        }
+                    ],
+                    "aggregations": [],
+                },
+                {"id": "[node][index-b][0]", "searches": [], "aggregations": []},
+            ]
+        }
+        summary = opensearch.summarize_profile(profile, max_children=1)
+        self.assertEqual([shard["id"] for shard in summary][0], "[node][index-a][0]")
+        self.assertEqual(summary[0]["time_ms"], 5)
+        self.assertEqual(summary[1]["time_ms"], 0)
+
+        query = summary[0]["queries"][0]
+        self.assertTrue(query["description"].endswith("..."))
+        self.assertEqual(len(query["children"]), 1)
+        self.assertEqual(query["children"][0]["type"], "WildcardQuery")
+        self.assertEqual(query["omitted_children"], 1)
+
+    def test_slow_query_log(self):
+        """Test that slow searches are logged with their query."""
+        self.app.config["SLOW_QUERY_LOG_THRESHOLD"] = 1000
+        datastore = OpenSearchDataStore()
+        datastore.client = mock.Mock()
+        datastore.client.search.return_value = {
+            "took": 1500,
+            "timed_out": False,
+            "_shards": {"total": 1, "successful": 1},
+            "hits": {"total": {"value": 3}, "hits": []},
+        }
+
+        with self.assertLogs("timesketch.slow_query", level="WARNING") as logs:
+            datastore.search(
+                sketch_id=1,
+                query_string="message:*foo*",
+                query_filter={},
+                query_dsl=None,
+                indices=["test"],
+                profile=True,
+            )
+        self.assertEqual(len(logs.records), 1)
+        record = json.loads(logs.records[0].getMessage()[len("Slow query: ") :])
+        self.assertEqual(record["took_ms"], 1500)
+        self.assertEqual(record["hits"], 3)
+        self.assertEqual(record["indices"], ["test"])
+        self.assertTrue(record["query_dsl"]["profile"])
+
+        body = datastore.client.search.call_args[1]["body"]
+        self.assertTrue(body["profile"])
+
+        datastore.client.search.return_value["took"] = 10
+        with mock.patch.object(opensearch.slow_query_logger, "warning") as warning:
+            datastore.search(
+                sketch_id=1,
+                query_string="*",
+                query_filter={},
+                query_dsl=None,
+                indices=["test"],
+            )
+        warning.assert_not_called()
+        self.app.config["SLOW_QUERY_LOG_THRESHOLD"] = 0
+
+    def test_search_timeout(self):
+        """Test that searches have a timeout and are cancelled after it."""
+        self.app.config["SEARCH_TIMEOUT"] = 30
+        datastore = OpenSearchDataStore()
+        datastore.client = mock.Mock()
+        datastore.client.search.side_effect = ConnectionTimeout(
+            "TIMEOUT", "Read timed out", None
+        )
+        datastore.client.tasks.list.return_value = {
+            "nodes": {
+                "node": {
+                    "tasks": {
+                        "node:1": {
+                            "headers": {"X-Opaque-Id": "timesketch/test/abc"},
+                        },
+                        "node:2": {
+                            "headers": {"X-Opaque-Id": "timesketch/test/abc"},
+                            "parent_task_id": "node:1",
+                        },
+                        "node:3": {
+                            "headers": {"X-Opaque-Id": "timesketch/test/other"},
+                        },
+                    }
+                }
+            }
+        }
+        datastore.task_type = "test"
+
+        with self.app.test_request_context():
+            with self.assertRaises(ValueError):
+                datastore.search(
+                    sketch_id=1,
+                    query_string="*",
+                    query_filter={},
+                    query_dsl=None,
+                    indices=["test"],
+                    search_id="abc",
+                )
+        kwargs = datastore.client.search.call_args[1]
+        self.assertEqual(kwargs["body"]["timeout"], "30s")
+        self.assertEqual(kwargs["opaque_id"], "timesketch/test/abc")
+        self.assertEqual(kwargs["request_timeout"], 40)
+        datastore.client.tasks.cancel.assert_called_once_with(task_id="node:1")
+
+        # Searches outside of web requests, eg. of analyzers, need complete
+        # results and have no timeout.
+        datastore.client.search.side_effect = None
+        datastore.client.search.return_value = {"hits": {"hits": [], "total": 0}}
+        with mock.patch.object(opensearch, "has_request_context", return_value=False):
+            datastore.search(
+                sketch_id=1,
+                query_string="*",
+                query_filter={},
+                query_dsl=None,
+                indices=["test"],
+            )
+        kwargs = datastore.client.search.call_args[1]
+        self.assertNotIn("timeout", kwargs["body"])
+        self.assertNotIn("request_timeout", kwargs)
+
+    def test_search_stream_timed_out(self):
+        """Test that streaming partial results of a search raises."""
+        datastore = OpenSearchDataStore()
+        datastore.client = mock.Mock()
+        datastore.client.search.return_value = {
+            "_scroll_id": "scroll",
+            "timed_out": True,
+            "hits": {"hits": [{"_id": "1"}], "total": {"value": 2}},
+        }
+        with self.assertRaises(ValueError):
+            list(
+                datastore.search_stream(
+                    query_string="*", query_filter={}, indices=["test"]
+                )
+            )
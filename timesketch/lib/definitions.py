@@ -23,6 +23,7 @@ HTTP_STATUS_CODE_BAD_REQUEST = 400
 HTTP_STATUS_CODE_UNAUTHORIZED = 401
 HTTP_STATUS_CODE_FORBIDDEN = 403
 HTTP_STATUS_CODE_NOT_FOUND = 404
+HTTP_STATUS_CODE_TOO_MANY_REQUESTS = 429
 
 # Time and date
 MICROSECONDS_PER_SECOND = 1000000
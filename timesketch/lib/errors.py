@@ -49,3 +49,25 @@ class ApiHTTPError(Error):
 
 class DataIngestionError(Error):
     """Raised when unable to ingest data."""
+
+
+class DataTooLargeError(Error):
+    """Raised when a result set exceeds a configured size limit."""
+
+
+class SearchRejectedError(Error):
+    """Raised when a search is not admitted, eg. because it is too expensive.
+
+    Attributes:
+        reason: Why the search was rejected, "cost" or "concurrency".
+    """
+
+    def __init__(self, message, reason):
+        """Initialize the error.
+
+        Args:
+            message: Description of the error.
+            reason: Why the search was rejected, "cost" or "concurrency".
+        """
+        super().__init__(message)
+        self.reason = reason
@@ -15,18 +15,43 @@
 
 from __future__ import unicode_literals
 
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import inspect
+import logging
 import re
+import struct
 
 from six.moves import filter
 
+import numpy as np
 from datasketch.minhash import MinHash
 from datasketch.lsh import MinHashLSH
+from datasketch.lean_minhash import LeanMinHash
 
 
+logger = logging.getLogger("timesketch.similarity")
+
 # Parameters for Jaccard and Minhash calculations.
 DEFAULT_DELIMITERS = [" ", "-", "/"]
 DEFAULT_THRESHOLD = 0.5
 DEFAULT_PERMUTATIONS = 128
+DEFAULT_SEED = 1
+
+# Number of texts that minhashes are calculated for at a time.
+DEFAULT_BATCH_SIZE = 1000
+
+# Constants of the permutation functions used by MinHash.
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+# Newer versions of datasketch support several hashing schemes and need to
+# be told which one minhash values were calculated with.
+_MINHASH_KWARGS = {}
+if "scheme" in inspect.signature(MinHash).parameters:
+    _MINHASH_KWARGS["scheme"] = "legacy"
 
 
 def _shingles_from_text(text, delimiters):
@@ -64,7 +89,206 @@ def minhash_from_text(text, num_perm, delimiters):
     return minhash
 
 
-def new_lsh_index(events, field, delimiters=None, num_perm=None, threshold=None):
+def _sha1_hash32(data):
+    """Returns a 32-bit integer hash of data, the default hash of MinHash."""
+    return struct.unpack("<I", hashlib.sha1(data).digest()[:4])[0]
+
+
+@functools.lru_cache(maxsize=8)
+def _get_permutations(num_perm, seed):
+    """Returns the parameters of the permutation functions of MinHash.
+
+    Args:
+        num_perm: number of random permutation functions.
+        seed: seed for the random number generator.
+
+    Returns:
+        A numpy array with two rows, the a and b parameters of the
+        permutation functions (a * hash + b) % prime.
+    """
+    generator = np.random.RandomState(seed)
+    return np.array(
+        [
+            (
+                generator.randint(1, _MERSENNE_PRIME, dtype=np.uint64),
+                generator.randint(0, _MERSENNE_PRIME, dtype=np.uint64),
+            )
+            for _ in range(num_perm)
+        ],
+        dtype=np.uint64,
+    ).T
+
+
+def _hashvalues_from_texts(texts, num_perm, delimiters, seed=DEFAULT_SEED):
+    """Calculate minhash values of a batch of texts.
+
+    Every distinct word in the batch is hashed and permuted once, and the
+    minimum of the permuted hashes of the words of each text is calculated
+    with a single vectorized reduction over the batch.
+
+    Args:
+        texts: list of strings to calculate minhash values of.
+        num_perm: number of random permutation functions.
+        delimiters: list of strings used as delimiters for splitting text
+            into words.
+        seed: seed for the permutation functions.
+
+    Returns:
+        A numpy array with a row of minhash values for each text.
+    """
+    word_indices = {}
+    text_words = []
+    offsets = []
+    for text in texts:
+        offsets.append(len(text_words))
+        for word in _shingles_from_text(text, delimiters):
+            text_words.append(word_indices.setdefault(word, len(word_indices)))
+
+    hashvalues = np.full((len(texts), num_perm), _MAX_HASH, dtype=np.uint64)
+    if not word_indices:
+        return hashvalues
+
+    word_hashes = np.array(
+        [_sha1_hash32(word.encode("utf8")) for word in word_indices],
+        dtype=np.uint64,
+    )
+    a, b = _get_permutations(num_perm, seed)
+    permuted = np.bitwise_and(
+        (word_hashes[:, np.newaxis] * a + b) % _MERSENNE_PRIME, _MAX_HASH
+    )
+
+    # Texts without any words keep the initial values.
+    offsets = np.array(offsets)
+    lengths = np.diff(np.append(offsets, len(text_words)))
+    non_empty = lengths > 0
+    hashvalues[non_empty] = np.minimum.reduceat(
+        permuted[np.array(text_words)], offsets[non_empty], axis=0
+    )
+    return hashvalues
+
+
+def minhashes_from_texts(texts, num_perm, delimiters, seed=DEFAULT_SEED):
+    """Calculate minhashes of a batch of texts.
+
+    The minhash values are calculated the same way as MinHash.update does
+    (the "legacy" scheme of newer datasketch versions), but a lot faster for
+    a large number of texts.
+
+    Args:
+        texts: list of strings to calculate minhashes of.
+        num_perm: number of random permutation functions used by MinHash to
+            be indexed.
+        delimiters: list of strings used as delimiters for splitting text
+            into words.
+        seed: seed for the permutation functions.
+
+    Returns:
+        A list of minhashes (instances of datasketch.LeanMinHash)
+    """
+    hashvalues = _hashvalues_from_texts(texts, num_perm, delimiters, seed=seed)
+    return _lean_minhashes(hashvalues, seed)
+
+
+def _lean_minhashes(hashvalues, seed):
+    """Returns a list of LeanMinHash objects from rows of minhash values."""
+    permutations = _get_permutations(hashvalues.shape[1], seed)
+    return [
+        LeanMinHash(
+            MinHash(
+                hashvalues.shape[1],
+                seed=seed,
+                hashvalues=values,
+                permutations=permutations,
+                **_MINHASH_KWARGS,
+            )
+        )
+        for values in hashvalues
+    ]
+
+
+def _event_batches(events, field, batch_size):
+    """Groups events into batches of keys and texts.
+
+    Args:
+        events: list or an iterator of Event objects.
+        field: string denoting the event field to use for the text.
+        batch_size: number of events in each batch.
+
+    Yields:
+        A tuple with a list of event keys and a list of texts.
+    """
+    keys = []
+    texts = []
+    for event in events:
+        keys.append((event.event_id, event.event_type, event.index_name))
+        texts.append(event.source[field])
+        if len(keys) >= batch_size:
+            yield keys, texts
+            keys = []
+            texts = []
+    if keys:
+        yield keys, texts
+
+
+def _hashvalue_batches(batches, num_perm, delimiters, processes=None):
+    """Calculates minhash values of batches of texts.
+
+    If more than one process is requested the batches are calculated in a
+    process pool, otherwise in this process.
+
+    Args:
+        batches: iterator of tuples with a list of keys and a list of texts.
+        num_perm: number of random permutation functions.
+        delimiters: list of strings used as delimiters for splitting text
+            into words.
+        processes: optional number of processes to use.
+
+    Yields:
+        A tuple with a list of keys and a numpy array of minhash values.
+    """
+    executor = None
+    if processes and processes > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+
+    pending = collections.deque()
+    try:
+        for keys, texts in batches:
+            if executor:
+                try:
+                    future = executor.submit(
+                        _hashvalues_from_texts, texts, num_perm, delimiters
+                    )
+                    pending.append((keys, future))
+                # Worker processes of some task runners are not allowed to
+                # start child processes, in which case the texts are hashed
+                # here.
+                except (AssertionError, OSError, RuntimeError) as exception:
+                    logger.warning(
+                        "Unable to calculate minhashes in a process pool, "
+                        "calculating in process instead: {0!s}".format(exception)
+                    )
+                    executor.shutdown(wait=False)
+                    executor = None
+
+            if not executor:
+                yield keys, _hashvalues_from_texts(texts, num_perm, delimiters)
+
+            # Limit the number of batches waiting to be calculated.
+            while pending and (not executor or len(pending) > processes * 2):
+                keys, future = pending.popleft()
+                yield keys, future.result()
+
+        while pending:
+            keys, future = pending.popleft()
+            yield keys, future.result()
+    finally:
+        if executor:
+            executor.shutdown()
+
+
+def new_lsh_index(
+    events, field, delimiters=None, num_perm=None, threshold=None, processes=None
+):
     """Create a new LSH from a set of Timesketch events.
 
     Args:
@@ -77,6 +301,7 @@ def new_lsh_index(events, field, delimiters=None, num_perm=None, threshold=None)
         threshold: a float for the Jaccard similarity threshold between 0.0 and
             1.0. The initialized MinHash LSH will be optimized for the
             threshold by minizing the false positive and false negative.
+        processes: optional number of processes used to calculate minhashes.
 
     Returns:
         A tuple with an LSH (instance of datasketch.lsh.LSH) and a
@@ -92,13 +317,15 @@ def new_lsh_index(events, field, delimiters=None, num_perm=None, threshold=None)
     minhashes = {}
     lsh = MinHashLSH(threshold, num_perm)
 
+    batches = _event_batches(events, field, DEFAULT_BATCH_SIZE)
     with lsh.insertion_session() as lsh_session:
-        for event in events:
-            # Insert minhash in LSH index.
-            key = (event.event_id, event.event_type, event.index_name)
-            minhash = minhash_from_text(event.source[field], num_perm, delimiters)
-            minhashes[key] = minhash
-            lsh_session.insert(key, minhash)
+        for keys, hashvalues in _hashvalue_batches(
+            batches, num_perm, delimiters, processes=processes
+        ):
+            # Insert minhashes in LSH index.
+            for key, minhash in zip(keys, _lean_minhashes(hashvalues, DEFAULT_SEED)):
+                minhashes[key] = minhash
+                lsh_session.insert(key, minhash)
 
     return lsh, minhashes
 
@@ -121,3 +348,27 @@ def calculate_score(lsh, minhash, total_num_events):
     """
     neighbours = lsh.query(minhash)
     return float(len(neighbours)) / float(total_num_events)
+
+
+def calculate_scores(lsh, minhashes, total_num_events):
+    """Calculate scores for a batch of minhashes.
+
+    Events with the same minhash have the same neighbours, so the LSH is
+    only queried once for each distinct minhash.
+
+    Args:
+        lsh: instance of datasketch.lsh.MinHashLSH
+        minhashes: dict with event keys as keys and minhashes as values.
+        total_num_events: integer of how many events in the LSH
+
+    Returns:
+        A dict with event keys as keys and a float between 0 and 1 as values.
+    """
+    scores = {}
+    distinct_scores = {}
+    for key, minhash in minhashes.items():
+        digest = hashlib.sha1(minhash.hashvalues.tobytes()).digest()
+        if digest not in distinct_scores:
+            distinct_scores[digest] = calculate_score(lsh, minhash, total_num_events)
+        scores[key] = distinct_scores[digest]
+    return scores
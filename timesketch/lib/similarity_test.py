@@ -18,6 +18,7 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import mock
+from datasketch import LeanMinHash
 from datasketch import MinHash
 
 from timesketch.lib import similarity
@@ -50,3 +51,39 @@ class TestSimilarityLibScorer(BaseTest):
             self.test_text, similarity.DEFAULT_PERMUTATIONS, self.delimiters
         )
         self.assertIsInstance(minhash, MinHash)
+
+    def test_minhashes_from_texts(self):
+        """Test calculating minhashes of a batch of texts."""
+        texts = [self.test_text, "", "a b c", "a b c d", self.test_text]
+        minhashes = similarity.minhashes_from_texts(
+            texts, similarity.DEFAULT_PERMUTATIONS, self.delimiters
+        )
+        self.assertEqual(len(minhashes), len(texts))
+        self.assertIsInstance(minhashes[0], LeanMinHash)
+        self.assertEqual(minhashes[0].jaccard(minhashes[4]), 1.0)
+        self.assertGreater(minhashes[2].jaccard(minhashes[3]), 0.5)
+        self.assertLess(minhashes[0].jaccard(minhashes[2]), 0.5)
+
+        # The values match minhashes calculated one word at a time.
+        # pylint: disable=protected-access
+        minhash = MinHash(similarity.DEFAULT_PERMUTATIONS, **similarity._MINHASH_KWARGS)
+        for word in ["a", "b", "c", "d"]:
+            minhash.update(word.encode("utf8"))
+        self.assertTrue((minhashes[3].hashvalues == minhash.hashvalues).all())
+
+    def test_new_lsh_index(self):
+        """Test creating an LSH and scoring events in batches."""
+        events = []
+        for index, text in enumerate(["a b c d", "a b c d", "x y z"] * 3):
+            event = mock.Mock(event_id=str(index), event_type="t", index_name="i")
+            event.source = {"message": text}
+            events.append(event)
+
+        for processes in (None, 2):
+            lsh, minhashes = similarity.new_lsh_index(
+                events, "message", processes=processes
+            )
+            self.assertEqual(len(minhashes), 9)
+            scores = similarity.calculate_scores(lsh, minhashes, len(minhashes))
+            self.assertAlmostEqual(scores[("0", "t", "i")], 6 / 9)
+            self.assertAlmostEqual(scores[("2", "t", "i")], 3 / 9)
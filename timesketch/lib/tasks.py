@@ -18,6 +18,7 @@ from __future__ import unicode_literals
 import os
 import logging
 import subprocess
+import time
 import traceback
 
 import codecs
@@ -33,6 +34,8 @@ from flask import current_app
 from celery import chain
 from celery import group
 from celery import signals
+import prometheus_client
+from prometheus_client import multiprocess
 from sqlalchemy import create_engine
 
 # To be able to determine plaso's version.
@@ -45,8 +48,10 @@ from timesketch.app import configure_logger
 from timesketch.app import create_celery_app
 from timesketch.lib import datafinder
 from timesketch.lib import errors
+from timesketch.lib import tracing
 from timesketch.lib.analyzers import manager
 from timesketch.lib.datastores.opensearch import OpenSearchDataStore
+from timesketch.lib.definitions import METRICS_NAMESPACE
 from timesketch.lib.utils import read_and_validate_csv
 from timesketch.lib.utils import read_and_validate_jsonl
 from timesketch.lib.utils import send_email
@@ -62,6 +67,43 @@ from timesketch.models.user import User
 logger = logging.getLogger("timesketch.tasks")
 celery = create_celery_app()
 
+# Seconds an analyzer waits for indexing to complete before it fails.
+DEFAULT_DEFERRED_TIMEOUT = 3600
+
+# Metrics definitions
+METRICS = {
+    "ingest_events": prometheus_client.Counter(
+        "ingest_events",
+        "Number of events read from uploaded files",
+        ["task_type"],
+        namespace=METRICS_NAMESPACE,
+    ),
+    "ingest_duration": prometheus_client.Histogram(
+        "ingest_duration_seconds",
+        "Duration of indexing uploaded files",
+        ["task_type"],
+        buckets=[1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200, 14400, 43200],
+        namespace=METRICS_NAMESPACE,
+    ),
+    "task_queue_wait": prometheus_client.Histogram(
+        "celery_task_queue_wait_seconds",
+        "Time tasks wait in the queue before a worker starts them",
+        ["task_type"],
+        buckets=[0.1, 0.5, 1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200],
+        namespace=METRICS_NAMESPACE,
+    ),
+    "task_duration": prometheus_client.Histogram(
+        "celery_task_duration_seconds",
+        "Duration of tasks",
+        ["task_type"],
+        buckets=[0.1, 0.5, 1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200, 14400],
+        namespace=METRICS_NAMESPACE,
+    ),
+}
+
+# Start times of the tasks running in this worker process.
+_task_start_times = {}
+
 
 PLASO_MINIMUM_VERSION = 20201228
 
@@ -73,6 +115,82 @@ def setup_loggers(*args, **kwargs):
     configure_logger()
 
 
+def _get_multiprocess_dir():
+    """Returns the directory of multiprocess metrics, or None if not set."""
+    return os.environ.get("PROMETHEUS_MULTIPROC_DIR") or os.environ.get(
+        "prometheus_multiproc_dir"
+    )
+
+
+def _get_task_type(task):
+    """Returns the type of a task used to label metrics, eg. run_plaso."""
+    return task.name.rsplit(".", 1)[-1]
+
+
+@signals.worker_init.connect
+def start_metrics_server(*args, **kwargs):
+    """Expose the metrics of the worker, if a metrics port is configured.
+
+    With a process pool the metrics of all worker processes are only
+    collected if a multiprocess metrics directory is set in the environment.
+    """
+    port = celery.conf.get("PROMETHEUS_WORKER_METRICS_PORT")
+    if not port:
+        return
+
+    registry = prometheus_client.REGISTRY
+    if _get_multiprocess_dir():
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    prometheus_client.start_http_server(int(port), registry=registry)
+    logger.info("Worker metrics server listening on port {0:d}".format(int(port)))
+
+
+@signals.worker_process_shutdown.connect
+def mark_metrics_process_dead(*args, pid=None, **kwargs):
+    """Remove the live metrics of a worker process that is shut down."""
+    if _get_multiprocess_dir():
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
+@signals.before_task_publish.connect
+def add_publish_time(*args, headers=None, **kwargs):
+    """Add the time a task is sent to the message headers."""
+    if headers is not None:
+        headers["ts_published"] = time.time()
+        tracing.inject_headers(headers)
+
+
+@signals.task_prerun.connect
+def observe_queue_wait(*args, task_id=None, task=None, **kwargs):
+    """Record how long a task waited in the queue."""
+    if task is None:
+        return
+    now = time.time()
+    _task_start_times[task_id] = now
+    tracing.start_task_span(task_id, task.name, task.request)
+
+    published = getattr(task.request, "ts_published", None)
+    if published is None:
+        published = (getattr(task.request, "headers", None) or {}).get("ts_published")
+    if published:
+        METRICS["task_queue_wait"].labels(task_type=_get_task_type(task)).observe(
+            max(0.0, now - published)
+        )
+
+
+@signals.task_postrun.connect
+def observe_task_duration(*args, task_id=None, task=None, state=None, **kwargs):
+    """Record how long a task ran."""
+    tracing.end_task_span(task_id, state=state)
+    start_time = _task_start_times.pop(task_id, None)
+    if task is None or start_time is None:
+        return
+    METRICS["task_duration"].labels(task_type=_get_task_type(task)).observe(
+        time.time() - start_time
+    )
+
+
 def get_import_errors(error_container, index_name, total_count):
     """Returns a string with error message or an empty string if no errors.
 
@@ -164,6 +282,24 @@ def _close_index(index_name, data_store, timeline_id):
         )
 
 
+def _get_upload_size(timeline_id):
+    """Returns the total size of the latest upload to a timeline.
+
+    Args:
+        timeline_id: Timeline ID.
+
+    Returns:
+        Size in bytes of the upload, or 0 if it is not known.
+    """
+    if not timeline_id:
+        return 0
+
+    timeline = Timeline.query.get(timeline_id)
+    if not timeline or not timeline.datasources:
+        return 0
+    return timeline.datasources[-1].file_size or 0
+
+
 def _set_timeline_status(timeline_id, status, error_msg=None):
     """Helper function to set status for searchindex and all related timelines.
 
@@ -200,6 +336,79 @@ def _set_timeline_status(timeline_id, status, error_msg=None):
     db_session.add(timeline)
     db_session.commit()
 
+    _run_deferred_analyses(timeline.searchindex)
+
+
+def _run_deferred_analyses(searchindex):
+    """Helper function to enqueue analyses that waited for indexing to end.
+
+    Analyzers that are started before the search index is ready are marked
+    as deferred instead of waiting for the index. Once indexing has completed
+    they are enqueued again, or marked as failed if the indexing failed.
+
+    Args:
+        searchindex: Instance of timesketch.models.sketch.SearchIndex.
+    """
+    status = searchindex.get_status.status.lower()
+    if status not in ("ready", "fail"):
+        return
+
+    deferred_analyses = _get_deferred_analyses(searchindex)
+    if not deferred_analyses:
+        return
+
+    tasks = []
+    for analysis in deferred_analyses:
+        # The analyzer task may also have seen that indexing completed, only
+        # the one that claims the analysis gets to run it.
+        if status == "fail":
+            if analysis.compare_and_set_status("DEFERRED", "ERROR"):
+                analysis.result = "Unable to run analyzer on a failed index."
+                db_session.add(analysis)
+                db_session.commit()
+        elif analysis.compare_and_set_status("DEFERRED", "PENDING"):
+            tasks.append(
+                run_sketch_analyzer.s(
+                    analysis.sketch_id,
+                    analysis.id,
+                    analysis.analyzer_name,
+                    timeline_id=analysis.timeline_id,
+                    **json.loads(analysis.parameters or "{}")
+                )
+            )
+
+    if not tasks:
+        return
+
+    if current_app.config.get("ENABLE_EMAIL_NOTIFICATIONS"):
+        tasks.append(run_email_result_task.s(deferred_analyses[0].sketch_id))
+
+    logger.info(
+        "Enqueuing {0:d} deferred analyzers for index {1:s}".format(
+            len(tasks), searchindex.index_name
+        )
+    )
+    pipeline = run_sketch_init.s([searchindex.index_name]) | chain(tasks)
+    pipeline.apply_async()
+
+
+def _get_deferred_analyses(searchindex):
+    """Returns the analyses on a search index that wait for indexing to end.
+
+    Args:
+        searchindex: Instance of timesketch.models.sketch.SearchIndex.
+
+    Returns:
+        List of deferred analyses (instances of
+        timesketch.models.sketch.Analysis).
+    """
+    deferred_analyses = []
+    for timeline in searchindex.timelines:
+        for analysis in timeline.analysis:
+            if analysis.get_status.status == "DEFERRED":
+                deferred_analyses.append(analysis)
+    return deferred_analyses
+
 
 def _get_index_task_class(file_extension):
     """Get correct index task function for the supplied file type.
@@ -222,6 +431,7 @@ def _get_index_task_class(file_extension):
     return index_class
 
 
+@tracing.traced("build_index_pipeline")
 def build_index_pipeline(
     file_path="",
     events="",
@@ -259,8 +469,20 @@ def build_index_pipeline(
     sketch_analyzer_chain = None
     searchindex = SearchIndex.query.filter_by(index_name=index_name).first()
 
+    index_task_kwargs = {}
+    if only_index and index_task_class is run_csv_jsonl:
+        # More chunks of the upload follow, the index is prepared for
+        # searching once the last chunk is imported.
+        index_task_kwargs["finalize"] = False
+
     index_task = index_task_class.s(
-        file_path, events, timeline_name, index_name, file_extension, timeline_id
+        file_path,
+        events,
+        timeline_name,
+        index_name,
+        file_extension,
+        timeline_id,
+        **index_task_kwargs
     )
 
     # TODO: Check if a scenario is set or an investigative question
@@ -287,6 +509,7 @@ def build_index_pipeline(
     return chain(index_task)
 
 
+@tracing.traced("build_sketch_analysis_pipeline")
 def build_sketch_analysis_pipeline(
     sketch_id,
     searchindex_id,
@@ -337,19 +560,23 @@ def build_sketch_analysis_pipeline(
     sketch = Sketch.query.get(sketch_id)
     analysis_session = AnalysisSession(user, sketch)
 
+    # The search index and timeline are the same for all analyzers, so
+    # look them up once instead of for every analyzer.
+    searchindex = SearchIndex.query.get(searchindex_id)
+
+    timeline = None
+    if timeline_id:
+        timeline = Timeline.query.get(timeline_id)
+
+    if not timeline:
+        timeline = Timeline.query.filter_by(
+            sketch=sketch, searchindex=searchindex
+        ).first()
+
+    analyses = []
     analyzers = manager.AnalysisManager.get_analyzers(analyzer_names)
     for analyzer_name, analyzer_class in analyzers:
         base_kwargs = analyzer_kwargs.get(analyzer_name, {})
-        searchindex = SearchIndex.query.get(searchindex_id)
-
-        timeline = None
-        if timeline_id:
-            timeline = Timeline.query.get(timeline_id)
-
-        if not timeline:
-            timeline = Timeline.query.filter_by(
-                sketch=sketch, searchindex=searchindex
-            ).first()
 
         additional_kwargs = analyzer_class.get_kwargs()
         if isinstance(additional_kwargs, dict):
@@ -373,23 +600,28 @@ def build_sketch_analysis_pipeline(
                 sketch=sketch,
                 timeline=timeline,
             )
-            analysis.set_status("PENDING")
+            # Not set_status(), that commits the session for every analysis.
+            analysis.status.append(Analysis.Status(user=None, status="PENDING"))
             analysis_session.analyses.append(analysis)
-            db_session.add(analysis)
-            db_session.commit()
+            analyses.append((analysis, kwargs))
 
-            tasks.append(
-                run_sketch_analyzer.s(
-                    sketch_id,
-                    analysis.id,
-                    analyzer_name,
-                    timeline_id=timeline_id,
-                    **kwargs
-                )
+    # Insert all analyses in a single transaction, the flush assigns the
+    # IDs that are needed for the tasks before anything is committed.
+    db_session.add(analysis_session)
+    db_session.add_all([analysis for analysis, _ in analyses])
+    db_session.flush()
+
+    for analysis, kwargs in analyses:
+        tasks.append(
+            run_sketch_analyzer.s(
+                sketch_id,
+                analysis.id,
+                analysis.analyzer_name,
+                timeline_id=timeline_id,
+                **kwargs
             )
+        )
 
-    # Commit the analysis session to the database.
-    db_session.add(analysis_session)
     db_session.commit()
 
     if current_app.config.get("ENABLE_EMAIL_NOTIFICATIONS"):
@@ -439,6 +671,14 @@ def run_email_result_task(index_name, sketch_id=None):
         searchindex = SearchIndex.query.filter_by(index_name=index_name).first()
         sketch = None
 
+        # The email is sent once the deferred analyzers have run.
+        if searchindex and _get_deferred_analyses(searchindex):
+            logger.info(
+                "Analyzers on index {0:s} are deferred, not sending "
+                "email.".format(index_name)
+            )
+            return ""
+
         try:
             to_username = searchindex.user.username
         except AttributeError:
@@ -502,9 +742,46 @@ def run_sketch_analyzer(
 
     result = analyzer.run_wrapper(analysis_id)
     logger.info("[{0:s}] result: {1:s}".format(analyzer_name, result))
+
+    analysis = Analysis.query.get(analysis_id)
+    status = analysis.get_status
+    if status.status == "DEFERRED":
+        # Fail the analysis if indexing never completes, eg. if the
+        # indexing worker died.
+        expire_deferred_analysis.apply_async(
+            (analysis_id, status.id),
+            countdown=current_app.config.get(
+                "ANALYZERS_DEFERRED_TIMEOUT", DEFAULT_DEFERRED_TIMEOUT
+            ),
+        )
     return index_name
 
 
+@celery.task(track_started=True, base=SqlAlchemyTask)
+def expire_deferred_analysis(analysis_id, status_id):
+    """Create a Celery task that fails an analysis deferred for too long.
+
+    Args:
+        analysis_id: ID of the analysis.
+        status_id: ID of the status the analysis was deferred with, the
+            analysis is not changed if it was deferred again since.
+    """
+    analysis = Analysis.query.get(analysis_id)
+    if not analysis or analysis.get_status.id != status_id:
+        return
+
+    if not analysis.compare_and_set_status("DEFERRED", "ERROR"):
+        return
+
+    logger.error(
+        "Indexing has taken too long time, aborting run of analyzer "
+        "{0:s}".format(analysis.analyzer_name)
+    )
+    analysis.result = "Indexing has taken too long time, analyzer was not run."
+    db_session.add(analysis)
+    db_session.commit()
+
+
 @celery.task(track_started=True, base=SqlAlchemyTask)
 def run_plaso(file_path, events, timeline_name, index_name, source_type, timeline_id):
     """Create a Celery task for processing Plaso storage file.
@@ -573,10 +850,15 @@ def run_plaso(file_path, events, timeline_name, index_name, source_type, timelin
         )
 
     opensearch = OpenSearchDataStore(host=opensearch_server, port=opensearch_port)
+    opensearch.task_type = "plaso"
+    start_time = time.time()
 
     try:
         opensearch.create_index(
-            index_name=index_name, doc_type=event_type, mappings=mappings
+            index_name=index_name,
+            doc_type=event_type,
+            mappings=mappings,
+            settings=opensearch.get_bulk_load_settings(os.path.getsize(file_path)),
         )
     except errors.DataIngestionError as e:
         _set_timeline_status(timeline_id, status="fail", error_msg=str(e))
@@ -658,6 +940,30 @@ def run_plaso(file_path, events, timeline_name, index_name, source_type, timelin
         )
         return e.output
 
+    try:
+        opensearch.finalize_index(index_name)
+    except RuntimeError as e:
+        _set_timeline_status(timeline_id, status="fail", error_msg=str(e))
+        raise
+
+    METRICS["ingest_duration"].labels(task_type="plaso").observe(
+        time.time() - start_time
+    )
+    count_query = None
+    if timeline_id:
+        count_query = {"query": {"term": {"__ts_timeline_id": timeline_id}}}
+    # The count is only used for metrics, errors must not fail the import.
+    try:
+        event_count = opensearch.client.count(index=index_name, body=count_query)
+        METRICS["ingest_events"].labels(task_type="plaso").inc(
+            event_count.get("count", 0)
+        )
+    except Exception:  # pylint: disable=broad-except
+        logger.warning(
+            "Unable to count the events in index {0:s}".format(index_name),
+            exc_info=True,
+        )
+
     # Mark the searchindex and timelines as ready
     _set_timeline_status(timeline_id, status="ready")
 
@@ -666,7 +972,13 @@ def run_plaso(file_path, events, timeline_name, index_name, source_type, timelin
 
 @celery.task(track_started=True, base=SqlAlchemyTask)
 def run_csv_jsonl(
-    file_path, events, timeline_name, index_name, source_type, timeline_id
+    file_path,
+    events,
+    timeline_name,
+    index_name,
+    source_type,
+    timeline_id,
+    finalize=True,
 ):
     """Create a Celery task for processing a CSV or JSONL file.
 
@@ -677,6 +989,9 @@ def run_csv_jsonl(
         index_name: Name of the datastore index.
         source_type: Type of file, csv or jsonl.
         timeline_id: ID of the timeline object this data belongs to.
+        finalize: Whether to prepare the index for searching once the events
+            are imported. Set to False for all but the last chunk of events
+            uploaded in chunks.
 
     Returns:
         Name (str) of the index.
@@ -684,8 +999,14 @@ def run_csv_jsonl(
     if events:
         file_handle = io.StringIO(events)
         source_type = "jsonl"
+        data_size = len(events)
     else:
         file_handle = codecs.open(file_path, "r", encoding="utf-8", errors="replace")
+        data_size = os.path.getsize(file_path)
+
+    # Events uploaded in chunks are sized by the whole upload, not the chunk
+    # that happens to create the index.
+    data_size = max(data_size, _get_upload_size(timeline_id))
 
     event_type = "generic_event"  # Document type for OpenSearch
     validators = {
@@ -722,6 +1043,8 @@ def run_csv_jsonl(
         host=current_app.config["OPENSEARCH_HOST"],
         port=current_app.config["OPENSEARCH_PORT"],
     )
+    opensearch.task_type = source_type
+    start_time = time.time()
 
     # Reason for the broad exception catch is that we want to capture
     # all possible errors and exit the task.
@@ -730,16 +1053,26 @@ def run_csv_jsonl(
     error_count = 0
     try:
         opensearch.create_index(
-            index_name=index_name, doc_type=event_type, mappings=mappings
+            index_name=index_name,
+            doc_type=event_type,
+            mappings=mappings,
+            settings=opensearch.get_bulk_load_settings(data_size),
         )
+        ingested_events = METRICS["ingest_events"].labels(task_type=source_type)
         for event in read_and_validate(file_handle):
             opensearch.import_event(
                 index_name, event_type, event, timeline_id=timeline_id
             )
+            ingested_events.inc()
             final_counter += 1
 
         # Import the remaining events
         results = opensearch.flush_queued_events()
+        if finalize:
+            opensearch.finalize_index(index_name)
+        METRICS["ingest_duration"].labels(task_type=source_type).observe(
+            time.time() - start_time
+        )
 
         error_container = results.get("error_container", {})
         error_msg = get_import_errors(
@@ -747,6 +1080,10 @@ def run_csv_jsonl(
             index_name=index_name,
             total_count=results.get("total_events", 0),
         )
+        # Events that could not be indexed are lost, the timeline would be
+        # incomplete. Batches sent before the final flush count as well.
+        if results.get("bulk_stats", {}).get("failed"):
+            raise errors.DataIngestionError(error_msg or "Unable to index all events.")
 
     except errors.DataIngestionError as e:
         _set_timeline_status(timeline_id, status="fail", error_msg=str(e))
@@ -186,6 +186,15 @@ class MockDataStore(object):
             return 4711
         return self.search_result_dict
 
+    def aggregate(self, indices, aggregation_dsl, search_id=None):
+        """Mock an aggregation, that is run by the client."""
+        return self.client.search(index=indices, body=aggregation_dsl, size=0)
+
+    @staticmethod
+    def cancel_search(search_id):
+        """Mock cancelling a search, no searches are running."""
+        return 0
+
     def get_event(self, searchindex_id, event_id):
         """Mock returning a single event from the datastore.
 
@@ -264,6 +273,10 @@ class MockDataStore(object):
         }
         self.event_store[event_id] = new_event
 
+    def flush_queued_events(self):
+        """Mock flushing the queued events, all events are stored directly."""
+        return {}
+
     @property
     def version(self):
         """Get MockOpenSearch version.
@@ -0,0 +1,369 @@
+# Copyright 2022 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tracing of web requests, Celery tasks, OpenSearch and SQL calls.
+
+Spans are created with OpenTelemetry, which is an optional dependency.
+Tracing is disabled unless TRACING_ENABLED is set in the configuration,
+in which case the helpers in this module do nothing beyond checking a
+module level variable.
+"""
+
+import contextlib
+import functools
+import logging
+import os
+
+from flask import g
+from flask import request
+from sqlalchemy import event as sqlalchemy_event
+from sqlalchemy.engine import Engine
+
+try:
+    from opentelemetry import context as otel_context
+    from opentelemetry import propagate
+    from opentelemetry import trace
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+    from opentelemetry.sdk.trace.sampling import ParentBasedTraceIdRatio
+except ImportError:
+    trace = None
+
+
+logger = logging.getLogger("timesketch.tracing")
+
+DEFAULT_SERVICE_NAME = "timesketch"
+DEFAULT_TRACING_FILE = "/var/log/timesketch/traces.jsonl"
+# Maximum number of characters of a SQL statement added to a span.
+MAX_STATEMENT_LENGTH = 1000
+
+# Shared context manager returned when tracing is disabled.
+_NOOP_SPAN = contextlib.nullcontext()
+
+# Tracer of the process, None while tracing is disabled.
+_tracer = None
+
+# Spans of running Celery tasks, keyed by task ID.
+_task_spans = {}
+
+
+def _get_exporter(config):
+    """Returns the span exporter configured, or None if not available.
+
+    Args:
+        config: Dict with the Timesketch configuration.
+    """
+    exporter_name = config.get("TRACING_EXPORTER", "file")
+    if exporter_name == "otlp":
+        try:
+            # pylint: disable=import-outside-toplevel
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+                OTLPSpanExporter,
+            )
+        except ImportError:
+            logger.warning(
+                "The OTLP exporter (opentelemetry-exporter-otlp-proto-http) "
+                "is not installed, tracing is disabled."
+            )
+            return None
+        endpoint = config.get("TRACING_OTLP_ENDPOINT") or None
+        return OTLPSpanExporter(endpoint=endpoint)
+
+    if exporter_name != "file":
+        logger.warning(
+            "Unknown tracing exporter: {0:s}, tracing is disabled.".format(
+                exporter_name
+            )
+        )
+        return None
+
+    path = config.get("TRACING_FILE", DEFAULT_TRACING_FILE)
+    # The file is kept open for the lifetime of the process.
+    # pylint: disable=consider-using-with
+    out = open(path, "a", encoding="utf-8")
+    return ConsoleSpanExporter(
+        out=out, formatter=lambda span: span.to_json(indent=None) + os.linesep
+    )
+
+
+def configure_tracing(config):
+    """Sets up tracing of the process from the Timesketch configuration.
+
+    Tracing is only set up once per process, later calls return whether
+    tracing is enabled.
+
+    Args:
+        config: Dict with the Timesketch configuration.
+
+    Returns:
+        Boolean indicating whether tracing is enabled.
+    """
+    global _tracer  # pylint: disable=global-statement
+    if _tracer is not None:
+        return True
+    if not config.get("TRACING_ENABLED", False):
+        return False
+    if trace is None:
+        logger.warning("OpenTelemetry is not installed, tracing is disabled.")
+        return False
+
+    exporter = _get_exporter(config)
+    if exporter is None:
+        return False
+
+    provider = TracerProvider(
+        resource=Resource.create(
+            {"service.name": config.get("TRACING_SERVICE_NAME", DEFAULT_SERVICE_NAME)}
+        ),
+        sampler=ParentBasedTraceIdRatio(float(config.get("TRACING_SAMPLE_RATIO", 1.0))),
+    )
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    _tracer = provider.get_tracer("timesketch")
+
+    sqlalchemy_event.listen(Engine, "before_cursor_execute", _start_sql_span)
+    sqlalchemy_event.listen(Engine, "after_cursor_execute", _end_sql_span)
+    sqlalchemy_event.listen(Engine, "handle_error", _end_failed_sql_span)
+    return True
+
+
+def is_enabled():
+    """Returns a boolean indicating whether tracing is enabled."""
+    return _tracer is not None
+
+
+def span(name, attributes=None):
+    """Returns a context manager that records a span.
+
+    Args:
+        name: Name of the span.
+        attributes: Optional dict with attributes of the span.
+
+    Returns:
+        Context manager of the span, that does nothing if tracing is
+        disabled.
+    """
+    if _tracer is None:
+        return _NOOP_SPAN
+    return _tracer.start_as_current_span(name, attributes=attributes)
+
+
+def traced(name):
+    """Decorator that records a span for each call of the function.
+
+    Args:
+        name: Name of the span.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return function(*args, **kwargs)
+            with _tracer.start_as_current_span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _start_span(name, carrier=None, kind=None, attributes=None):
+    """Starts a span and makes it the current span.
+
+    Args:
+        name: Name of the span.
+        carrier: Optional mapping with the propagated parent context, eg.
+            HTTP or message headers.
+        kind: Optional trace.SpanKind of the span.
+        attributes: Optional dict with attributes of the span.
+
+    Returns:
+        Tuple with the span and the token to detach its context.
+    """
+    parent = propagate.extract(carrier) if carrier else None
+    new_span = _tracer.start_span(
+        name,
+        context=parent,
+        kind=kind or trace.SpanKind.INTERNAL,
+        attributes=attributes,
+    )
+    token = otel_context.attach(trace.set_span_in_context(new_span))
+    return new_span, token
+
+
+def _end_span(span_and_token, error=None):
+    """Ends a span started with _start_span.
+
+    Args:
+        span_and_token: Tuple returned by _start_span.
+        error: Optional exception that ended the span.
+    """
+    ended_span, token = span_and_token
+    otel_context.detach(token)
+    if error is not None:
+        ended_span.record_exception(error)
+        ended_span.set_status(trace.Status(trace.StatusCode.ERROR, str(error)))
+    ended_span.end()
+
+
+def start_request_span():
+    """Starts the span of the current Flask request."""
+    if _tracer is None:
+        return
+    rule = request.url_rule.rule if request.url_rule else request.path
+    g.tracing_span = _start_span(
+        "{0:s} {1:s}".format(request.method, rule),
+        carrier=dict(request.headers),
+        kind=trace.SpanKind.SERVER,
+        attributes={
+            "http.method": request.method,
+            "http.route": rule,
+            "http.target": request.full_path,
+        },
+    )
+
+
+def record_response(response):
+    """Adds the status of a response to the span of the Flask request.
+
+    Args:
+        response: Flask response object.
+
+    Returns:
+        The response, unchanged.
+    """
+    span_and_token = g.get("tracing_span")
+    if span_and_token:
+        span_and_token[0].set_attribute("http.status_code", response.status_code)
+    return response
+
+
+def end_request_span(error=None):
+    """Ends the span of the current Flask request.
+
+    Args:
+        error: Optional exception raised while handling the request.
+    """
+    span_and_token = g.pop("tracing_span", None)
+    if span_and_token:
+        _end_span(span_and_token, error=error)
+
+
+def inject_headers(headers):
+    """Adds the context of the current span to message headers.
+
+    Args:
+        headers: Dict with the headers of a message, eg. a Celery task.
+    """
+    if _tracer is None or headers is None:
+        return
+    propagate.inject(headers)
+
+
+def start_task_span(task_id, task_name, task_request):
+    """Starts the span of a Celery task.
+
+    Args:
+        task_id: ID of the task.
+        task_name: Name of the task.
+        task_request: Celery request of the task, custom message headers
+            are attributes of the request.
+    """
+    if _tracer is None:
+        return
+    carrier = dict(getattr(task_request, "headers", None) or {})
+    for field in propagate.get_global_textmap().fields:
+        value = getattr(task_request, field, None)
+        if value:
+            carrier[field] = value
+    _task_spans[task_id] = _start_span(
+        "celery {0:s}".format(task_name),
+        carrier=carrier,
+        kind=trace.SpanKind.CONSUMER,
+        attributes={"celery.task_id": task_id, "celery.task_name": task_name},
+    )
+
+
+def end_task_span(task_id, state=None):
+    """Ends the span of a Celery task.
+
+    Args:
+        task_id: ID of the task.
+        state: Optional string with the final state of the task.
+    """
+    span_and_token = _task_spans.pop(task_id, None)
+    if not span_and_token:
+        return
+    if state:
+        span_and_token[0].set_attribute("celery.state", state)
+    _end_span(span_and_token)
+
+
+def trace_opensearch_client(client):
+    """Records a span for each request of an OpenSearch client.
+
+    Args:
+        client: OpenSearch client, changed in place if tracing is enabled.
+    """
+    if _tracer is None:
+        return
+    transport = client.transport
+    perform_request = transport.perform_request
+
+    @functools.wraps(perform_request)
+    def traced_perform_request(method, url, *args, **kwargs):
+        # The last part of the URL is the API called, eg. _search or _bulk.
+        api = url.rstrip("/").rsplit("/", 1)[-1] or "/"
+        with _tracer.start_as_current_span(
+            "opensearch {0:s} {1:s}".format(method, api),
+            kind=trace.SpanKind.CLIENT,
+            attributes={"db.system": "opensearch", "http.method": method, "url": url},
+        ):
+            return perform_request(method, url, *args, **kwargs)
+
+    transport.perform_request = traced_perform_request
+
+
+# pylint: disable=unused-argument
+def _start_sql_span(conn, cursor, statement, parameters, context, executemany):
+    """Starts a span before a SQL statement is executed."""
+    operation = statement.split(None, 1)[0].upper() if statement else "SQL"
+    context.tracing_span = _start_span(
+        "sql {0:s}".format(operation),
+        kind=trace.SpanKind.CLIENT,
+        attributes={
+            "db.system": conn.engine.name,
+            "db.statement": statement[:MAX_STATEMENT_LENGTH],
+        },
+    )
+
+
+# pylint: disable=unused-argument
+def _end_sql_span(conn, cursor, statement, parameters, context, executemany):
+    """Ends the span of a SQL statement that was executed."""
+    span_and_token = getattr(context, "tracing_span", None)
+    if span_and_token:
+        context.tracing_span = None
+        _end_span(span_and_token)
+
+
+def _end_failed_sql_span(exception_context):
+    """Ends the span of a SQL statement that failed."""
+    context = exception_context.execution_context
+    span_and_token = getattr(context, "tracing_span", None)
+    if span_and_token:
+        context.tracing_span = None
+        _end_span(span_and_token, error=exception_context.original_exception)
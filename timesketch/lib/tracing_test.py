@@ -0,0 +1,61 @@
+# Copyright 2022 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for tracing."""
+
+import mock
+
+from timesketch.lib import tracing
+from timesketch.lib.testlib import BaseTest
+
+
+class TestTracing(BaseTest):
+    """Tests for the tracing helpers."""
+
+    def test_disabled(self):
+        """Test that the helpers do nothing while tracing is disabled."""
+        self.assertFalse(tracing.configure_tracing({"TRACING_ENABLED": False}))
+        self.assertFalse(tracing.is_enabled())
+
+        with tracing.span("test", {"key": "value"}) as span:
+            self.assertIsNone(span)
+        self.assertIs(tracing.span("other"), tracing.span("test"))
+
+        @tracing.traced("test")
+        def add(first, second):
+            return first + second
+
+        self.assertEqual(add(1, second=2), 3)
+
+        headers = {"ts_published": 1}
+        tracing.inject_headers(headers)
+        self.assertEqual(headers, {"ts_published": 1})
+
+        client = mock.Mock()
+        perform_request = client.transport.perform_request
+        tracing.trace_opensearch_client(client)
+        self.assertIs(client.transport.perform_request, perform_request)
+
+        tracing.start_task_span("task_id", "test", mock.Mock())
+        tracing.end_task_span("task_id")
+        # pylint: disable=protected-access
+        self.assertEqual(tracing._task_spans, {})
+
+        response = self.client.get("/login/")
+        self.assertEqual(response.status_code, 200)
+
+    def test_missing_dependency(self):
+        """Test that tracing stays disabled without OpenTelemetry."""
+        with mock.patch.object(tracing, "trace", None):
+            self.assertFalse(tracing.configure_tracing({"TRACING_ENABLED": True}))
+        self.assertFalse(tracing.is_enabled())
@@ -364,6 +364,32 @@ class StatusMixin(object):
         self.status.append(self.Status(user=None, status=status))
         db_session.commit()
 
+    def compare_and_set_status(self, expected_status, status):
+        """Set status on object, if it has the expected status.
+
+        The status is changed with a single conditional update, so when
+        more than one process changes the status at the same time only one
+        of them succeeds.
+
+        Args:
+            expected_status: Name of the status the object needs to have.
+            status: Name of the new status.
+
+        Returns:
+            Boolean indicating whether the status was changed.
+        """
+        changed = (
+            db_session.query(self.Status)
+            .filter(
+                self.Status.parent_id == self.id,
+                self.Status.status == expected_status,
+            )
+            .update({"status": status}, synchronize_session=False)
+        )
+        db_session.commit()
+        db_session.expire(self, ["status"])
+        return bool(changed)
+
     @property
     def get_status(self):
         """Get the current status.
@@ -164,7 +164,7 @@ class Sketch(AccessControlMixin, LabelMixin, StatusMixin, CommentMixin, BaseMode
         active_sessions = []
         for session in self.analysissessions:
             for analysis in session.analyses:
-                if analysis.get_status.status in ("PENDING", "STARTED"):
+                if analysis.get_status.status in ("PENDING", "DEFERRED", "STARTED"):
                     active_sessions.append(session)
                     # Break early on first running analysis as this is enough
                     # to mark the session as active.